@@ -5,6 +5,7 @@ from .source import *
 from .block_source import *
 from .templates import *
 from .likelihood import *
+from .distributed import *
 from .inference import *
 from .bounds import *
 from .mu_estimation import *
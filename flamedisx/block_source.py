@@ -1,3 +1,6 @@
+import collections
+from contextlib import contextmanager
+import string
 import typing as ty
 
 import numpy as np
@@ -111,7 +114,10 @@ class Block:
         """Shorthand for self.source.gimme_numpy"""
         return self.source.gimme_numpy(*args, **kwargs)
 
-    def compute(self, data_tensor, ptensor, **kwargs):
+    def compute(self, data_tensor, ptensor, log_space=False, **kwargs):
+        """Return (n_batch_events, ...dimensions...) tensor with the block
+        result, or its natural logarithm if log_space.
+        """
         if len(self.bonus_dimensions) == 0:
             # We don't have any bonus_dimensions; construct domains as normal for
             # this block
@@ -121,20 +127,23 @@ class Block:
             # We have bonus_dimensions; need to construct domains manually
             # for this block
             kwargs.update(self._domain_dict_bonus(data_tensor))
-        result = self._compute(data_tensor, ptensor, **kwargs)
+        if log_space:
+            result = self._log_compute(data_tensor, ptensor, **kwargs)
+        else:
+            result = self._compute(data_tensor, ptensor, **kwargs)
         assert result.dtype == fd.float_type(), \
             f"{self}._compute returned tensor of wrong dtype!"
         assert len(result.shape) == len(self.dimensions) + 1, \
             f"{self}._compute returned tensor of wrong rank!"
         return result
 
-    def simulate(self, d: pd.DataFrame):
-        return_value = self._simulate(d)
+    def simulate(self, d: ty.Dict[str, np.ndarray]):
+        return_value = self.source._call_with_columns(self._simulate, d)
         assert return_value is None, f"_simulate of {self} should return None"
         # Check necessary columns were actually added
         for dim in self.dimensions:
-            assert dim in d.columns, f"_simulate of {self} must set {dim}"
-            assert np.all(np.isfinite(d[dim].values)),\
+            assert dim in d, f"_simulate of {self} must set {dim}"
+            assert np.all(np.isfinite(d[dim])),\
                 f"_simulate of {self} returned non-finite values of {dim}"
 
     def annotate(self, d: pd.DataFrame):
@@ -177,9 +186,19 @@ class Block:
         """Return (n_batch_events, ...dimensions...) tensor"""
         raise NotImplementedError
 
+    def _log_compute(self, data_tensor, ptensor, **kwargs):
+        """Return natural logarithm of the _compute result.
+        Override to compute this directly, e.g. to avoid underflow.
+        """
+        return fd.safe_log(self._compute(data_tensor, ptensor, **kwargs))
+
     def _simulate(self, d):
         """Simulate extra columns in place.
 
+        :param d: dictionary of numpy arrays, one per column. Blocks
+            whose _simulate is defined outside flamedisx get a DataFrame,
+            but the dictionary is faster.
+
         Use the p_accepted column to modify acceptances; do not remove
         events here.
         """
@@ -241,6 +260,46 @@ class BlockModelSource(fd.Source):
     #: Dimensions provided by the first block
     initial_dimensions: tuple
 
+    #: If True, compute the blocks whose results do not depend on any
+    #: fitted parameter only once per batch, when the data is set, and reuse
+    #: these results in differential rate computations. This costs memory:
+    #: the cached results of all batches are kept, padded to the same shape.
+    #: If a differential rate is requested at other values of a cached
+    #: block's parameters than the defaults, all blocks are computed
+    #: instead, without tracing.
+    cache_fixed_blocks = False
+
+    #: If True, compute and multiply block results as natural logarithms,
+    #: with the largest values shifted to one before each multiplication,
+    #: and return log differential rates to the likelihood.
+    #: This avoids underflow in events far in the tails of the model.
+    log_space = False
+
+    #: In log_space, before multiplying block results, drop elements of
+    #: summed dimensions at which both results are more than this
+    #: (natural log) below the event's maximum. Block results are batched,
+    #: so an element is only dropped if this holds for every event in the
+    #: batch: one event for which it matters keeps it for all.
+    #: None to keep all.
+    log_prune_threshold = None
+
+    #: Block index -> (padded results of all batches, result shape of each
+    #: batch), as tf.Variables. See cache_fixed_blocks.
+    _block_cache: ty.Dict[int, ty.Tuple[tf.Variable, tf.Variable]]
+
+    #: Block index -> (result, names of model functions used), filled
+    #: while recording block computations for the cache.
+    _block_recording: ty.Optional[dict] = None
+
+    #: Whether the cached block results are natural logarithms
+    _block_cache_log_space = False
+
+    #: If True, do not update the block cache when defaults change
+    _block_cache_frozen = False
+
+    #: If True, compute all blocks rather than using the block cache
+    _block_cache_bypassed = False
+
     def __init__(self, *args, **kwargs):
         if isinstance(self.model_blocks[0], FirstBlock):
             # Blocks have already been instantiated
@@ -342,28 +401,90 @@ class BlockModelSource(fd.Source):
         self.exclude_data_tensor = tuple([
             d for d in collected['exclude_data_tensor']])
 
+        self._block_cache = dict()
+        self._block_cache_defaults = dict()
+        self._typical_dimsizes = dict()
+
         super().__init__(*args, **kwargs)
 
-    @staticmethod
-    def _find_block(blocks,
-                    has_dim: ty.Union[list, tuple, set],
-                    exclude: Block = None):
-        """Find a block with a dimension in has_dim, other than the block in
-        exclude. Return (dimensions, b), or raises BlockNotFoundError.
-        """
-        for dims, b in blocks.items():
-            if b is exclude:
-                continue
-            for d in dims:
-                if d in has_dim:
-                    return dims, b
-        raise BlockNotFoundError(f"No block with {has_dim} found!")
+    def extra_needed_columns(self):
+        # Blocks fill array columns to _fetch them later
+        result = super().extra_needed_columns() + list(self.array_columns)
+        if self.cache_fixed_blocks:
+            # To find the cached block results of the batch
+            result = result + ['batch_index']
+        return result
 
     def _differential_rate(self, data_tensor, ptensor):
-        results = {}
+        result = self._block_differential_rate(data_tensor, ptensor)
+        if self.log_space:
+            result = tf.exp(result)
+        return result
+
+    def _log_differential_rate(self, data_tensor, ptensor):
+        if not self.log_space:
+            return super()._log_differential_rate(data_tensor, ptensor)
+        return self._block_differential_rate(data_tensor, ptensor)
+
+    def differential_rate(self, data_tensor=None, autograph=True, **kwargs):
+        with self._bypass_block_cache_if_needed(kwargs) as bypassed:
+            return super().differential_rate(
+                data_tensor, autograph=autograph and not bypassed, **kwargs)
+
+    def log_differential_rate(self, data_tensor=None, autograph=True,
+                              **kwargs):
+        with self._bypass_block_cache_if_needed(kwargs) as bypassed:
+            return super().log_differential_rate(
+                data_tensor, autograph=autograph and not bypassed, **kwargs)
+
+    def differential_rate_vjp(self, data_tensor, output_gradient,
+                              log=False, autograph=True, **kwargs):
+        with self._bypass_block_cache_if_needed(kwargs) as bypassed:
+            return super().differential_rate_vjp(
+                data_tensor, output_gradient, log=log,
+                autograph=autograph and not bypassed, **kwargs)
+
+    @contextmanager
+    def _bypass_block_cache_if_needed(self, params):
+        """Bypass the block cache while in the context if params has other
+        values of cached blocks' parameters than the cached results are for.
+        Yields whether the cache is bypassed; the traced differential rate
+        uses the cache, so it must not be used then.
+        """
+        changed = []
+        for cached_params in self._block_cache_defaults.values():
+            for pname, value in cached_params.items():
+                if pname not in params or pname in changed:
+                    continue
+                if tf.is_symbolic_tensor(params[pname]):
+                    raise ValueError(
+                        f"Cannot pass {pname} as a tensor while tracing: "
+                        f"blocks whose results are cached use it. "
+                        f"Add {pname} to fit_params.")
+                if fd.tf_to_np(tf.cast(params[pname],
+                                       fd.float_type())) != value:
+                    changed.append(pname)
+        if not changed:
+            yield False
+            return
+        self._block_cache_bypassed = True
+        try:
+            yield True
+        finally:
+            self._block_cache_bypassed = False
+
+    def _block_differential_rate(self, data_tensor, ptensor):
+        """Return differential rate computed from the block results,
+        or its natural logarithm if log_space"""
+        # Block results connected by shared dimensions form a component:
+        # a list [dims, operands], with dims the dimensions left after
+        # contracting the operands, and operands a list of
+        # (dimensions, block result) tuples. Components are contracted
+        # only when their result is needed, in the cheapest order we find.
+        components = []
         already_stepped = ()  # Avoid double-multiplying to account for stepping
 
-        for b in self.model_blocks:
+        for block_i, b in enumerate(self.model_blocks):
             b_dims = b.dimensions
             # These are the the dimensions we will do variable stepping over
             scaling_dims = b.dimensions + tuple([bonus_dimension[0] for
@@ -373,15 +494,20 @@ class BlockModelSource(fd.Source):
             # Gather extra compute arguments.
             kwargs = dict()
             for dependency_dims, dependency_name in b.depends_on:
-                if dependency_dims not in results:
+                matches = [c for c in components
+                           if set(c[0]) == set(dependency_dims)]
+                if not matches:
                     raise ValueError(
                         f"Block {b} depends on {dependency_dims}, but that has "
                         f"not yet been computed")
-                kwargs[dependency_name] = results[dependency_dims]
+                kwargs[dependency_name] = self._contract_component(
+                    matches[0], dependency_dims)
+                if self.log_space:
+                    kwargs[dependency_name] = tf.exp(kwargs[dependency_name])
                 kwargs.update(self._domain_dict(dependency_dims, data_tensor))
 
             # Compute the block
-            r = b.compute(data_tensor, ptensor, **kwargs)
+            r = self._compute_block(block_i, data_tensor, ptensor, **kwargs)
 
             # Scale the block by stepped dimensions, if not already done in
             # another block
@@ -390,91 +516,331 @@ class BlockModelSource(fd.Source):
                         (dim not in self.no_step_dimensions) and \
                         (dim not in already_stepped):
                     steps = self._fetch(dim+'_steps', data_tensor=data_tensor)
-                    step_mul = tf.repeat(steps[:, o], tf.shape(r)[1], axis=1)
-                    step_mul = tf.repeat(step_mul[:, :, o],
-                                         tf.shape(r)[2], axis=2)
-                    r *= step_mul
+                    if isinstance(r, fd.BandedTensor):
+                        # Banded results are only made in linear space
+                        r = r.with_band(r.band * steps[:, o, o])
+                    else:
+                        step_mul = tf.repeat(steps[:, o], tf.shape(r)[1], axis=1)
+                        step_mul = tf.repeat(step_mul[:, :, o],
+                                             tf.shape(r)[2], axis=2)
+                        if self.log_space:
+                            r += tf.math.log(step_mul)
+                        else:
+                            r *= step_mul
                     already_stepped += (dim,)
 
-            results[b_dims] = r
-
-            # Try to matrix multiply with earlier blocks, until we cannot
-            # do so anymore.
-            try:
-                while True:
-                    b2_dims, r2 = self._find_block(
-                        results, has_dim=b_dims, exclude=r)
-
-                    new_dims, r = self.multiply_block_results(
-                        b_dims, b2_dims, r, r2)
-                    results[new_dims] = r
-                    del results[b_dims]
-                    del results[b2_dims]
-
-            except BlockNotFoundError:
-                continue
-
-        # The result should have a tensor with only final dimensions
-        result = None
-        for dims, result in results.items():
-            if all([d in self.final_dimensions for d in dims]):
+            # Join the components with which we share a dimension,
+            # until we cannot do so anymore.
+            dims, operands = b_dims, [(b_dims, r)]
+            while True:
+                joinable = [c_i for c_i, c in enumerate(components)
+                            if set(dims).intersection(set(c[0]))]
+                if not joinable:
+                    break
+                c_dims, c_operands = components.pop(joinable[0])
+                shared_dims = set(dims).intersection(set(c_dims))
+                dims = tuple([d for d in dims if d not in shared_dims]
+                             + [d for d in c_dims if d not in shared_dims])
+                operands = operands + c_operands
+            components.append([dims, operands])
+
+        # The result should be a component with only final dimensions
+        component = None
+        for component in components:
+            if all([d in self.final_dimensions for d in component[0]]):
                 break
-        if result is None:
+        if component is None:
             raise ValueError("Result was not computed!")
+        result = self._contract_component(component, component[0])
         return tf.reshape(tf.squeeze(result), (self.batch_size,))
 
-    def multiply_block_results(self, b_dims, b2_dims, r, r2):
-        """Return result of matrix-multiplying two block results
+    def _contract_component(self, component, dims):
+        """Return result of contracting a component of block results
+        (see _differential_rate), with its dimensions ordered as dims.
+        The component is replaced by its result.
+        """
+        c_dims, operands = component
+        if len(operands) > 1:
+            # Plan with the sizes of dimensions in the results, or,
+            # if these are only known at runtime, their typical sizes
+            dimsizes = dict()
+            for r_dims, r in operands:
+                for d, size in zip(r_dims, r.shape[1:]):
+                    if size is None:
+                        size = self._typical_dimsizes.get(
+                            d, self.max_dim_sizes.get(
+                                d, self.default_max_dim_size))
+                    dimsizes[d] = size
+            operands = list(operands)
+            path = contraction_path([r_dims for r_dims, _ in operands],
+                                    dimsizes)
+            if self.log_space:
+                multiply = self.log_multiply_block_results
+            else:
+                multiply = self.multiply_block_results
+            for i, j, new_dims in path:
+                operands.append(multiply(
+                    operands[i][0], operands[j][0],
+                    operands[i][1], operands[j][1],
+                    new_dims=new_dims))
+            component[:] = [operands[-1][0], [operands[-1]]]
+
+        c_dims, r = component[1][0]
+        if isinstance(r, fd.BandedTensor):
+            r = r.to_dense()
+        if tuple(c_dims) != tuple(dims):
+            r = tf.transpose(r, [0] + [1 + c_dims.index(d) for d in dims])
+        return r
+
+    def _compute_block(self, block_i, data_tensor, ptensor, **kwargs):
+        """Return result of the block_i'th block, from the cache if possible
+        """
+        b = self.model_blocks[block_i]
+        if self._block_recording is not None:
+            # Note which model functions the block uses
+            self._gimme_calls = set()
+            r = b.compute(data_tensor, ptensor,
+                          log_space=self.log_space, **kwargs)
+            self._block_recording[block_i] = (r, self._gimme_calls)
+            self._gimme_calls = None
+            return r
+
+        if (block_i not in self._block_cache
+                or self._block_cache_bypassed
+                or self._block_cache_log_space != self.log_space):
+            return b.compute(data_tensor, ptensor,
+                             log_space=self.log_space, **kwargs)
+
+        values, shapes = self._block_cache[block_i]
+        batch_i = tf.cast(self._fetch('batch_index', data_tensor)[0],
+                          dtype=fd.int_type())
+        shape = tf.concat([[self.batch_size], shapes[batch_i]], axis=0)
+        r = tf.slice(values[batch_i], tf.zeros_like(shape), shape)
+        return tf.ensure_shape(r, [None] * (len(b.dimensions) + 1))
+
+    def _populate_tensor_cache(self):
+        super()._populate_tensor_cache()
+
+        # Typical size of each dimension, to plan contractions with
+        self._typical_dimsizes = {
+            column[:-len('_dimsizes')]:
+                self.data[column].values.reshape(
+                    self.n_batches, self.batch_size).max(axis=1).mean()
+            for column in self.data.columns
+            if column.endswith('_dimsizes')}
+
+        if self.cache_fixed_blocks:
+            self._cache_fixed_block_results()
+
+    def _cache_fixed_block_results(self):
+        """Compute and store the results of all blocks that do not depend on
+        fitted parameters, for all batches. See cache_fixed_blocks.
+        """
+        ptensor = self.ptensor_from_kwargs()
+        batch_results = []
+        self._block_recording = dict()
+        try:
+            for batch_i in range(self.n_batches):
+                self._differential_rate(self.data_tensor[batch_i], ptensor)
+                batch_results.append({
+                    block_i: (r.to_dense() if isinstance(r, fd.BandedTensor)
+                              else r)
+                    for block_i, (r, _) in self._block_recording.items()})
+        finally:
+            gimme_calls = {block_i: fnames
+                           for block_i, (_, fnames)
+                           in self._block_recording.items()}
+            self._block_recording = None
+
+        if not self._block_cache_defaults:
+            # Find the blocks to cache. Blocks that depend on others are
+            # only cached if all earlier blocks are.
+            for block_i, b in enumerate(self.model_blocks):
+                params = set(sum([self.f_params.get(fname, [])
+                                  for fname in gimme_calls[block_i]], []))
+                if params.intersection(self.fit_params):
+                    if b.depends_on:
+                        break
+                    continue
+                if b.depends_on and len(self._block_cache_defaults) < block_i:
+                    break
+                self._block_cache_defaults[block_i] = {
+                    pname: None for pname in params}
+            for block_i in self._block_cache_defaults:
+                self._block_cache[block_i] = (
+                    tf.Variable(tf.zeros(0, dtype=fd.float_type()),
+                                shape=tf.TensorShape(None),
+                                trainable=False),
+                    tf.Variable(tf.zeros(0, dtype=fd.int_type()),
+                                shape=tf.TensorShape(None), trainable=False))
+
+        for block_i, (values, shapes) in self._block_cache.items():
+            results = [r[block_i] for r in batch_results]
+            batch_shapes = np.array([r.shape[1:] for r in results])
+            max_shape = batch_shapes.max(axis=0)
+            values.assign(tf.stack([
+                tf.pad(r, [[0, 0]] + [[0, n - m] for n, m
+                                      in zip(max_shape, r.shape[1:])])
+                for r in results]))
+            shapes.assign(tf.convert_to_tensor(batch_shapes,
+                                               dtype=fd.int_type()))
+            self._block_cache_defaults[block_i] = {
+                pname: self.defaults[pname].numpy()
+                for pname in self._block_cache_defaults[block_i]}
+        # Cached results are logarithms if log_space was on
+        self._block_cache_log_space = self.log_space
+
+    def set_data(self, *args, **kwargs):
+        # set_data fills the block cache (in _populate_tensor_cache)
+        # for the new data and defaults, no need to update it before.
+        # Annotation and simulation (through _set_temporarily) do not use
+        # the cache, and restore the defaults it was made for afterwards.
+        self._block_cache_frozen = True
+        try:
+            super().set_data(*args, **kwargs)
+        finally:
+            self._block_cache_frozen = False
+
+    @contextmanager
+    def _set_columns_temporarily(self, *args, **kwargs):
+        # Simulation does not use the block cache, and restores the
+        # defaults it was made for afterwards.
+        was_frozen = self._block_cache_frozen
+        self._block_cache_frozen = True
+        try:
+            with super()._set_columns_temporarily(*args, **kwargs):
+                yield
+        finally:
+            self._block_cache_frozen = was_frozen
+
+    def set_defaults(self, *, config=None, **params):
+        super().set_defaults(config=config, **params)
+        # Cached block results must be recomputed if the defaults
+        # of their parameters changed, or other settings were changed.
+        if (self._block_cache
+                and not self._block_cache_frozen
+                and (config is not None
+                     or any([k not in self.defaults for k in params])
+                     or any([self.defaults[pname].numpy() != value
+                             for ps in self._block_cache_defaults.values()
+                             for pname, value in ps.items()]))):
+            self._cache_fixed_block_results()
+
+    def multiply_block_results(self, b_dims, b2_dims, r, r2, new_dims=None):
+        """Return result of multiplying two block results, summing over
+        the dimensions they share.
         :param b_dims: tuple, dimension specification of r
         :param b2_dims: tuple, dimension specification of r2
         :param r: tensor , first block result to be multiplier
         :param r2: tensor, second block result to be multiplied
+        :param new_dims: tuple, dimension specification of the result.
+            Dimensions not in new_dims are summed over. Defaults to the
+            dimensions not shared by r and r2.
         :return: (dimension specification, tensor) of results
         """
-        shared_dim = set(b_dims).intersection(set(b2_dims))
-        if len(shared_dim) != 1:
-            raise ValueError(f"Expected one shared dimension, "
-                             f"found {len(shared_dim)}!")
-        shared_dim = list(shared_dim)[0]
-
-        # Figure out dimensions of result
-        new_dims = tuple([d for d in b_dims if d != shared_dim]
-                         + [d for d in b2_dims if d != shared_dim])
-
-        # TODO: can we generalize to rank > 2?
-        assert len(b_dims) in [1, 2]
-        assert len(b2_dims) in [1, 2]
-
-        # Due to the batch dimension, tf.matmul requires that the
-        # ranks of arguments to tf.matmul match exactly.
-        dummy_axis = None
-        if len(b_dims) == 1 and len(b2_dims) == 2:
-            dummy_axis = 1
-            r = r[:, o, :]
-        elif len(b_dims) == 2 and len(b2_dims) == 1:
-            dummy_axis = 2
-            r2 = r2[:, :, o]
-        elif len(b_dims) == 2 and len(b2_dims) == 2:
-            # Ensure the shared dimension is in the right position
-            # for matrix multiplication
-            if b_dims.index(shared_dim) != 1:
-                assert len(b_dims) == 2
-                r = tf.transpose(r, [0, 2, 1])
-            if b2_dims.index(shared_dim) != 0:
-                assert len(b2_dims) == 2
-                r2 = tf.transpose(r2, [0, 2, 1])
-        else:
-            raise ValueError(
-                "Unsupported ranks {len(b_dims)}, {len(b2_dims)}")
-
-        # Multiply the matching index to get a new block
-        r = r @ r2
-        if dummy_axis:
-            r = tf.squeeze(r, dummy_axis)
+        if isinstance(r, fd.BandedTensor) or isinstance(r2, fd.BandedTensor):
+            new_dims, _ = self._multiplication_equation(
+                b_dims, b2_dims, new_dims)
+            if not isinstance(r, fd.BandedTensor):
+                b_dims, b2_dims, r, r2 = b2_dims, b_dims, r2, r
+            return self._multiply_banded(b_dims, b2_dims, r, r2, new_dims)
+
+        new_dims, equation = self._multiplication_equation(
+            b_dims, b2_dims, new_dims)
+        r = tf.einsum(equation, r, r2)
         assert len(r.shape) == len(new_dims) + 1
 
         return (new_dims, r)
 
+    def _multiply_banded(self, b_dims, b2_dims, r, r2, new_dims):
+        """Return result of multiplying a banded block result r
+        (a fd.BandedTensor) with r2, see multiply_block_results.
+        new_dims is required.
+        """
+        if isinstance(r2, fd.BandedTensor):
+            r2 = r2.to_dense()
+        row_dim, column_dim = b_dims
+        if (column_dim in new_dims
+                or column_dim not in b2_dims
+                or row_dim in b2_dims):
+            # Cannot sum over the band only
+            return self.multiply_block_results(
+                b_dims, b2_dims, r.to_dense(), r2, new_dims=new_dims)
+
+        # Take the elements of r2 in the band of each row, then
+        # sum over the band
+        band_dim = column_dim + '_band'
+        axis = 1 + b2_dims.index(column_dim)
+        r2 = tf.gather(r2, r.column_indices(), axis=axis, batch_dims=1)
+        b2_dims = (b2_dims[:axis - 1] + (row_dim, band_dim)
+                   + b2_dims[axis:])
+        return self.multiply_block_results(
+            (row_dim, band_dim), b2_dims, r.band, r2, new_dims=new_dims)
+
+    def log_multiply_block_results(self, b_dims, b2_dims, r, r2,
+                                   new_dims=None):
+        """Return result of multiplying two block results, given and
+        returned as natural logarithms. See multiply_block_results.
+        """
+        new_dims, equation = self._multiplication_equation(
+            b_dims, b2_dims, new_dims)
+        summed_dims = [d for d in b_dims if d in b2_dims and d not in new_dims]
+
+        if self.log_prune_threshold is not None:
+            for d in summed_dims:
+                axis, axis2 = 1 + b_dims.index(d), 1 + b2_dims.index(d)
+                keep = tf.where(
+                    _significant_indices(r, axis, self.log_prune_threshold)
+                    | _significant_indices(r2, axis2,
+                                           self.log_prune_threshold))[:, 0]
+                r = tf.gather(r, keep, axis=axis)
+                r2 = tf.gather(r2, keep, axis=axis2)
+
+        # Shift the largest values to one before multiplying.
+        # The shifts cancel, so they need no gradient.
+        shifts = []
+        for dims, x in ((b_dims, r), (b2_dims, r2)):
+            axes = [1 + dims.index(d) for d in summed_dims]
+            shift = tf.stop_gradient(tf.reduce_max(x, axis=axes,
+                                                   keepdims=True))
+            shifts.append(tf.where(tf.math.is_finite(shift),
+                                   shift,
+                                   tf.zeros_like(shift)))
+        result = fd.safe_log(tf.einsum(equation,
+                                       tf.exp(r - shifts[0]),
+                                       tf.exp(r2 - shifts[1])))
+
+        # Undo the shifts
+        for dims, shift in zip((b_dims, b2_dims), shifts):
+            axes = [1 + dims.index(d) for d in summed_dims]
+            kept_dims = [d for d in dims if d not in summed_dims]
+            shift = tf.squeeze(shift, axis=axes) if axes else shift
+            result += _align_dims(shift, kept_dims, new_dims)
+        assert len(result.shape) == len(new_dims) + 1
+
+        return (new_dims, result)
+
+    @staticmethod
+    def _multiplication_equation(b_dims, b2_dims, new_dims=None):
+        """Return (new_dims, tf.einsum equation) for multiplying
+        block results, see multiply_block_results.
+        """
+        shared_dims = set(b_dims).intersection(set(b2_dims))
+        if not shared_dims:
+            raise ValueError(f"Blocks with {b_dims} and {b2_dims} "
+                             f"share no dimension!")
+        if new_dims is None:
+            new_dims = tuple([d for d in b_dims if d not in shared_dims]
+                             + [d for d in b2_dims if d not in shared_dims])
+
+        # First subscript is for the batch dimension
+        letters = dict(zip(
+            sorted(set(b_dims).union(set(b2_dims))), string.ascii_letters[1:]))
+        equation = '{},{}->{}'.format(*[
+            'a' + ''.join([letters[d] for d in dims])
+            for dims in (b_dims, b2_dims, new_dims)])
+        return new_dims, equation
+
     def random_truth(self, n_events, fix_truth=None, **params):
         # First block provides the 'deep' truth (energies, positions, time)
         return self.model_blocks[0].random_truth(
@@ -484,6 +850,10 @@ class BlockModelSource(fd.Source):
         return self.model_blocks[0].validate_fix_truth(fix_truth)
 
     def _check_data(self):
+        if self.cache_fixed_blocks:
+            # Data is now padded, and about to be split into batches
+            self.data['batch_index'] = (
+                np.arange(len(self.data)) // self.batch_size)
         super()._check_data()
         for b in self.model_blocks:
             b.check_data()
@@ -491,7 +861,8 @@ class BlockModelSource(fd.Source):
     def _simulate_response(self):
         # All blocks after the first help to simulate the response
         d = self.data
-        d['p_accepted'] = 1.   # Cut on p_accepted is made in Source.simulate
+        # Cut on p_accepted is made in Source.simulate
+        d['p_accepted'] = np.ones(self.n_events)
         for b in self.model_blocks[1:]:
             b.simulate(d)
         return d
@@ -509,6 +880,8 @@ class BlockModelSource(fd.Source):
         if self.mc_reservoir.empty:
             return
 
+        self.prior_PDFs_LB = dict()
+        self.prior_PDFs_UB = dict()
         for set in self.prior_dimensions:
             prior_dims = set[0]
             filter_dims = set[1]
@@ -519,18 +892,19 @@ class BlockModelSource(fd.Source):
             for dim in filter_dims:
                 filter_data_columns.append(self.mc_reservoir.columns.get_loc(dim))
 
-            for batch in range(self.n_batches):
-                df_batch = data[batch * self.batch_size:(batch + 1) * self.batch_size]
-
-                filter_dims_min, filter_dims_max = [], []
-                for dim in filter_dims:
-                    filter_dims_min.append(min(df_batch[dim + '_min']))
-                for dim in filter_dims:
-                    filter_dims_max.append(max(df_batch[dim + '_max']))
+            # Extremal bounds of the filter dimensions, (n_batches, n_filter_dims)
+            filter_dims_min = np.stack([
+                fd.batch_reduce(data[dim + '_min'].values, self.batch_size,
+                                np.minimum, broadcast=False)
+                for dim in filter_dims], axis=1)
+            filter_dims_max = np.stack([
+                fd.batch_reduce(data[dim + '_max'].values, self.batch_size,
+                                np.maximum, broadcast=False)
+                for dim in filter_dims], axis=1)
 
-                fd.bounds.get_priors(self, self.mc_reservoir.values, prior_dims,
-                                     prior_data_columns, filter_data_columns,
-                                     filter_dims_min, filter_dims_max)
+            fd.bounds.get_priors(self, self.mc_reservoir.values, prior_dims,
+                                 prior_data_columns, filter_data_columns,
+                                 filter_dims_min, filter_dims_max)
 
     def _annotate(self, _skip_bounds_computation=False):
         d = self.data
@@ -585,5 +959,123 @@ class BlockModelSource(fd.Source):
             b._calculate_dimsizes_special()
 
 
-class BlockNotFoundError(Exception):
-    pass
+def _significant_indices(log_r, axis, threshold):
+    """Return boolean mask along axis of log_r, an (n_events, ...) tensor,
+    True where, for some event, log_r is within threshold of the
+    event's maximum.
+    """
+    rank = len(log_r.shape)
+    event_max = tf.reduce_max(log_r, axis=list(range(1, rank)), keepdims=True)
+    return tf.reduce_any(
+        log_r >= event_max - threshold,
+        axis=[i for i in range(rank) if i != axis])
+
+
+def _align_dims(x, x_dims, new_dims):
+    """Return (n_events, ...x_dims...) tensor x transposed and expanded
+    to broadcast against (n_events, ...new_dims...) tensors.
+    """
+    order = sorted(range(len(x_dims)), key=lambda i: new_dims.index(x_dims[i]))
+    x = tf.transpose(x, [0] + [1 + i for i in order])
+    for i, d in enumerate(new_dims):
+        if d not in x_dims:
+            x = tf.expand_dims(x, 1 + i)
+    return x
+
+
+@export
+def contraction_path(operand_dims, dimsizes, max_optimal=10):
+    """Return a cheap order in which to multiply tensors, summing over
+    dimensions when no other tensor has them. Dimensions that occur in only
+    one tensor are kept.
+
+    The cost of each multiplication is the number of elements in the
+    union of the dimensions of the two tensors.
+
+    :param operand_dims: list of dimension specifications (tuples)
+        of the tensors
+    :param dimsizes: dictionary mapping dimensions to their (typical) size
+    :param max_optimal: For more tensors than this, choose the cheapest
+        multiplication at each step rather than the cheapest order overall.
+    :return: list of (i, j, dims) tuples. Each multiplies tensors i and j
+        to a new tensor with dimension specification dims, that gets the
+        next index after the tensors (and products) before it.
+    """
+    n = len(operand_dims)
+    counts = collections.Counter([d for dims in operand_dims
+                                  for d in set(dims)])
+
+    subset_dims = dict()
+
+    def get_dims(subset):
+        """Return dimensions of the product of tensors in subset (bitmask)
+        """
+        if subset not in subset_dims:
+            members = [i for i in range(n) if subset >> i & 1]
+            inside = collections.Counter([d for i in members
+                                          for d in set(operand_dims[i])])
+            result = []
+            for i in members:
+                for d in operand_dims[i]:
+                    if d not in result and (inside[d] < counts[d]
+                                            or counts[d] == 1):
+                        result.append(d)
+            subset_dims[subset] = tuple(result)
+        return subset_dims[subset]
+
+    def get_cost(subset, subset2):
+        """Return cost of multiplying the products of subset and subset2,
+        or None if they share no dimension"""
+        dims, dims2 = get_dims(subset), get_dims(subset2)
+        if not set(dims).intersection(set(dims2)):
+            return None
+        return np.prod([dimsizes[d] for d in set(dims).union(set(dims2))])
+
+    # Subset -> (total cost, (subset, subset2) it is the product of)
+    best = {1 << i: (0, None) for i in range(n)}
+    if n <= max_optimal:
+        # Try all ways to build each subset from two smaller ones
+        for subset in sorted(range(1, 1 << n),
+                             key=lambda x: bin(x).count('1')):
+            part = (subset - 1) & subset
+            while part:
+                other = subset ^ part
+                if part < other and part in best and other in best:
+                    cost = get_cost(part, other)
+                    if cost is not None:
+                        cost += best[part][0] + best[other][0]
+                        if subset not in best or cost < best[subset][0]:
+                            best[subset] = (cost, (part, other))
+                part = (part - 1) & subset
+    else:
+        remaining = list(best.keys())
+        while len(remaining) > 1:
+            options = [(get_cost(part, other), part, other)
+                       for i, part in enumerate(remaining)
+                       for other in remaining[i + 1:]]
+            options = [x for x in options if x[0] is not None]
+            if not options:
+                break
+            cost, part, other = min(options, key=lambda x: x[0])
+            best[part | other] = (cost, (part, other))
+            remaining = [x for x in remaining if x not in (part, other)]
+            remaining.append(part | other)
+
+    if (1 << n) - 1 not in best:
+        raise ValueError(f"Tensors with {operand_dims} are not connected "
+                         f"by shared dimensions")
+
+    # Convert to a list of multiplications
+    path = []
+    index = {1 << i: i for i in range(n)}
+
+    def add_to_path(subset):
+        if subset not in index:
+            part, other = best[subset][1]
+            path.append((add_to_path(part), add_to_path(other),
+                         get_dims(subset)))
+            index[subset] = n + len(path) - 1
+        return index[subset]
+
+    add_to_path((1 << n) - 1)
+    return path
@@ -65,13 +65,16 @@ def bayes_bounds_priors(source, batch, df, in_dim, bounds_prob, bound, bound_typ
     assert (bound_type in ('binomial',)), "bound_type must be binomial"
 
     if bound == 'upper':
-        prior_pdfs = source.prior_PDFs_UB[batch]
+        edges, densities = source.prior_PDFs_UB[in_dim]
     elif bound == 'lower':
-        prior_pdfs = source.prior_PDFs_LB[batch]
+        edges, densities = source.prior_PDFs_LB[in_dim]
+
+    def prior_pdf(x):
+        return histogram_pdf(x, edges[batch], densities[batch])
 
     # We will calculate bounds with the prior and also with a flat prior. Take
     # the tightest set of bounds at the end
-    cdfs_prior = bayes_bounds_binomial(supports, prior_pdf=prior_pdfs[in_dim], **kwargs)
+    cdfs_prior = bayes_bounds_binomial(supports, prior_pdf=prior_pdf, **kwargs)
     cdfs_no_prior = bayes_bounds_binomial(supports, **kwargs)
 
     if bound == 'lower':
@@ -101,50 +104,107 @@ def bayes_bounds_priors(source, batch, df, in_dim, bounds_prob, bound, bound_typ
 
 def get_priors(source, reservoir, prior_dims,
                prior_data_cols, filter_data_cols,
-               filter_dims_min, filter_dims_max):
+               filter_dims_min, filter_dims_max, n_bins=10,
+               sort_min_batches=50):
     """Obtain priors on certain hidden variable dimensions, to obtain more
     accurate Bayes bounds. Separate priors calculated for estimating upper and
     lower bounds.
 
+    The priors are histograms of the filtered MC reservoir, stored for each
+    prior dimension in source.prior_PDFs_LB and source.prior_PDFs_UB as
+    (bin edges, densities) arrays of shape (n_batches, n_bins + 1)
+    and (n_batches, n_bins).
+
     :param reservoir: MC reservoir filtered for prior estimation
     :param prior_dims: tuple of dimensions we are obtaining priors for
     :param prior_data_cols: column numbers in reservoir corresponding to prior_dims
     :param filter_data_cols: column numbers in reservoir corresponding to dimensions
     we are filtering reservoir by to obtain the priors
     :param filter_dims_min: lower bounds of the dimensions we are filtering by, for
-    obtaining lower bound priors
+    obtaining lower bound priors, shape (n_batches, len(filter_data_cols))
     :param filter_dims_max: upper bounds of the dimensions we are filtering by, for
-    obtaining upper bound priors
+    obtaining upper bound priors, shape (n_batches, len(filter_data_cols))
+    :param n_bins: number of histogram bins
+    :param sort_min_batches: minimum number of batches for which to sort the
+    reservoir, see below. Sorting takes about as long as filtering the full
+    reservoir for a few tens of batches.
     """
-    prior_dict = {}
-
-    for prior_dim, prior_data_col in zip(prior_dims, prior_data_cols):
-        prior_data_filter = [True] * len(reservoir[:, 0])
-
-        for filter_data_col, filter_dim_min in zip(filter_data_cols, filter_dims_min):
-            prior_data_filter = prior_data_filter * (reservoir[:, filter_data_col] >= filter_dim_min)
-
-        prior_data = reservoir[:, prior_data_col][prior_data_filter]
-        prior_hist = np.histogram(prior_data)
-        prior_pdf = stats.rv_histogram(prior_hist)
-        prior_dict[prior_dim] = prior_pdf
-
-    source.prior_PDFs_LB += (prior_dict,)
-
-    prior_dict = {}
-
-    for prior_dim, prior_data_col in zip(prior_dims, prior_data_cols):
-        prior_data_filter = [True] * len(reservoir[:, 0])
-
-        for filter_data_col, filter_dim_max in zip(filter_data_cols, filter_dims_max):
-            prior_data_filter = prior_data_filter * (reservoir[:, filter_data_col] <= filter_dim_max)
-
-        prior_data = reservoir[:, prior_data_col][prior_data_filter]
-        prior_hist = np.histogram(prior_data)
-        prior_pdf = stats.rv_histogram(prior_hist)
-        prior_dict[prior_dim] = prior_pdf
-
-    source.prior_PDFs_UB += (prior_dict,)
+    # Sort the reservoir once by each filter column. The events passing a
+    # bound on that column are then a contiguous slice, found by bisection.
+    # For few batches, just filter the full (unsorted) reservoir.
+    if len(filter_dims_min) >= sort_min_batches:
+        orders = [np.argsort(reservoir[:, col], kind='stable')
+                  for col in filter_data_cols]
+    else:
+        orders = [None]
+
+    def column(c, order):
+        # Contiguous columns are much faster to filter than the 2d reservoir
+        if order is None:
+            return np.ascontiguousarray(reservoir[:, c])
+        return reservoir[order, c]
+
+    sorted_reservoirs = [
+        ([column(c, order) for c in filter_data_cols],
+         [column(c, order) for c in prior_data_cols])
+        for order in orders]
+
+    for priors, filter_dims_bounds, keep, side in (
+            (source.prior_PDFs_LB, filter_dims_min, np.greater_equal, 'left'),
+            (source.prior_PDFs_UB, filter_dims_max, np.less_equal, 'right')):
+        filter_dims_bounds = np.asarray(filter_dims_bounds)
+        n_batches = len(filter_dims_bounds)
+        edges = np.zeros((len(prior_dims), n_batches, n_bins + 1))
+        densities = np.zeros((len(prior_dims), n_batches, n_bins))
+
+        # Slice of the reservoir sorted by each filter column that passes
+        # the bound on that column, (len(orders), n_batches)
+        starts, stops = [], []
+        for i, (filter_columns, _) in enumerate(sorted_reservoirs):
+            if orders[i] is None:
+                starts.append(np.zeros(n_batches, dtype=int))
+                stops.append(np.full(n_batches, len(reservoir)))
+                continue
+            i_bound = np.searchsorted(filter_columns[i], filter_dims_bounds[:, i], side=side)
+            if side == 'left':
+                starts.append(i_bound)
+                stops.append(np.full(n_batches, len(reservoir)))
+            else:
+                starts.append(np.zeros(n_batches, dtype=int))
+                stops.append(i_bound)
+        starts, stops = np.array(starts), np.array(stops)
+
+        for batch, batch_bounds in enumerate(filter_dims_bounds):
+            # Use the sorting that gives the smallest slice,
+            # and apply all bounds within it (this also drops NaNs)
+            i_sorted = np.argmin(stops[:, batch] - starts[:, batch])
+            batch_slice = slice(starts[i_sorted, batch], stops[i_sorted, batch])
+            filter_columns, prior_columns = sorted_reservoirs[i_sorted]
+            mask = np.ones(batch_slice.stop - batch_slice.start, dtype=bool)
+            for filter_column, bound in zip(filter_columns, batch_bounds):
+                mask &= keep(filter_column[batch_slice], bound)
+
+            for i, prior_column in enumerate(prior_columns):
+                counts, edges[i, batch] = np.histogram(prior_column[batch_slice][mask], bins=n_bins)
+                if counts.sum() > 0:
+                    # Normalized as in scipy.stats.rv_histogram
+                    widths = np.diff(edges[i, batch])
+                    density = counts / widths
+                    densities[i, batch] = density / np.sum(density * widths)
+
+        for i, prior_dim in enumerate(prior_dims):
+            priors[prior_dim] = (edges[i], densities[i])
+
+
+def histogram_pdf(x, edges, densities):
+    """Return the density of a histogram at x; zero outside the bins.
+
+    :param edges: bin edges
+    :param densities: density in each bin
+    """
+    i = np.searchsorted(edges, x, side='right') - 1
+    inside = (i >= 0) & (i < len(densities))
+    return np.where(inside, densities[np.clip(i, 0, len(densities) - 1)], 0.)
 
 
 def bayes_bounds_binomial(supports, rvs_binom, ns_binom, ps_binom, prior_pdf=None):
@@ -158,7 +218,8 @@ def bayes_bounds_binomial(supports, rvs_binom, ns_binom, ps_binom, prior_pdf=Non
     must be the same shape as supports
     :param ps_binom: Variable the block uses as the success probability of the binomial calculation;
     must be the same shape as supports
-    :param prior_pdf: if we are using a non-flat prior, pass in the PDF to be used
+    :param prior_pdf: if we are using a non-flat prior, pass in the PDF to be used,
+    as a function of the 'in' variable
     """
     assert (np.shape(rvs_binom) == np.shape(ns_binom) == np.shape(ps_binom) == np.shape(supports)), \
         "Shapes of suports, rvs_binom, ns_binom and ps_binom must be equal"
@@ -166,10 +227,10 @@ def bayes_bounds_binomial(supports, rvs_binom, ns_binom, ps_binom, prior_pdf=Non
     def prior(x):
         if prior_pdf is None:
             return 1
-        elif np.sum(prior_pdf.pdf(x)) == 0:
+        elif np.sum(prior_pdf(x)) == 0:
             return 1
         else:
-            return prior_pdf.pdf(x)
+            return prior_pdf(x)
 
     pdfs = [stats.binom.pmf(rv_binom, n_binom, p_binom) * prior(support)
             for rv_binom, n_binom, p_binom, support in zip(rvs_binom, ns_binom, ps_binom, supports)]
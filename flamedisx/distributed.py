@@ -0,0 +1,285 @@
+"""Data-parallel likelihood: events sharded over worker processes
+"""
+import multiprocessing
+from multiprocessing.connection import Client, Listener
+import traceback
+import typing as ty
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+import flamedisx as fd
+from flamedisx.likelihood import DEFAULT_DSETNAME
+
+export, __all__ = fd.exporter()
+
+
+@export
+class DistributedLogLikelihood(fd.LogLikelihood):
+    """LogLikelihood whose events are split over several worker processes.
+
+    Each worker holds its own copy of the sources, annotated with only its
+    share of the events. It computes the events' contribution to the
+    log likelihood, gradient and Hessian; this process sums these and adds
+    the expected-events and constraint terms.
+
+    Workers are started locally (with multiprocessing's spawn method),
+    or are already running elsewhere, see serve_likelihood_worker.
+    Stop them with close(), or use the likelihood as a context manager:
+
+        with fd.DistributedLogLikelihood(...) as lf:
+            lf.bestfit()
+
+    Source classes are sent to the workers by reference, so they
+    must be importable there (not e.g. defined inside a function).
+
+    The sources of the DistributedLogLikelihood itself do not get any data.
+    """
+
+    def __init__(
+            self,
+            sources,
+            arguments=None,
+            data=None,
+            n_workers=2,
+            worker_addresses=None,
+            authkey=None,
+            **kwargs):
+        """
+        :param n_workers: Number of local worker processes to start.
+            Ignored if worker_addresses is given.
+
+        :param worker_addresses: List of (host, port) addresses of workers
+            started with serve_likelihood_worker, to use instead of
+            local processes.
+
+        :param authkey: Authentication key (bytes) for the connections
+            to worker_addresses.
+
+        For the other arguments, see LogLikelihood.
+        """
+        self._connections = []
+        self._processes = []
+
+        if isinstance(data, dict):
+            no_data = {dsetname: None for dsetname in data}
+        else:
+            no_data = None
+        super().__init__(sources=sources,
+                         arguments=arguments,
+                         data=no_data,
+                         **kwargs)
+
+        # Workers rebuild the sources, but reuse our mu estimators
+        # rather than simulating new ones.
+        # The constraint does not depend on the events, we add it here.
+        worker_kwargs = {k: v for k, v in kwargs.items()
+                         if k != 'log_constraint'}
+        worker_kwargs.update(dict(
+            sources=sources,
+            arguments=arguments,
+            data={dsetname: None for dsetname in self.dsetnames},
+            mu_estimators=self.mu_estimators,
+            progress=False))
+
+        try:
+            if worker_addresses is None:
+                ctx = multiprocessing.get_context('spawn')
+                for _ in range(n_workers):
+                    conn, worker_conn = ctx.Pipe()
+                    p = ctx.Process(target=_serve, args=(worker_conn,),
+                                    daemon=True)
+                    p.start()
+                    self._connections.append(conn)
+                    self._processes.append(p)
+            else:
+                for address in worker_addresses:
+                    self._connections.append(
+                        Client(tuple(address), authkey=authkey))
+            self.n_workers = len(self._connections)
+            self._call_workers('init', worker_kwargs)
+
+            if data is not None:
+                self.set_data(data)
+        except BaseException:
+            # Do not leave workers running without anyone to stop them
+            self._terminate()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def set_data(self,
+                 data: ty.Union[pd.DataFrame, ty.Dict[str, pd.DataFrame]]):
+        """Split new data over the workers.
+        Data is passed in the same format as for __init__
+        """
+        if isinstance(data, pd.DataFrame):
+            assert len(self.dsetnames) == 1, \
+                "You passed one DataFrame but there are multiple datasets"
+            data = {DEFAULT_DSETNAME: data}
+
+        if any([d is None for d in data.values()]):
+            if self._connections:
+                raise ValueError("Cannot remove the data of the workers")
+            return super().set_data(data)
+
+        for dname in data:
+            if dname not in self.dsetnames:
+                raise ValueError(f"Unknown dataset {dname}")
+        self._guess_rate_multipliers(data)
+
+        # Split on batch boundaries, so events are batched as they would
+        # be without workers. Workers may get no events of a small dataset.
+        shards = [dict() for _ in range(self.n_workers)]
+        for dname, d in data.items():
+            batch_size = self.sources[self.sources_in_dset[dname][0]].batch_size
+            n_batches = int(np.ceil(len(d) / batch_size))
+            batch_counts = [len(x) for x in np.array_split(
+                np.arange(n_batches), self.n_workers)]
+            bounds = batch_size * np.cumsum([0] + batch_counts)
+            for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+                shards[i][dname] = d.iloc[start:stop].reset_index(drop=True)
+        self._call_workers('set_data', [dict(data=s) for s in shards])
+
+    def log_likelihood(self, second_order=False,
+                       omit_grads=tuple(), **kwargs):
+        params = self.prepare_params(kwargs)
+
+        # Get the workers started on the events...
+        self._send_workers('log_likelihood', dict(
+            params={k: v.numpy() for k, v in params.items()},
+            second_order=second_order,
+            omit_grads=omit_grads))
+
+        # ... meanwhile, compute the terms that do not depend on them
+        n_grads = len(self.param_defaults) - len(omit_grads)
+        ll = 0.
+        llgrad = np.zeros(n_grads, dtype=np.float64)
+        llgrad2 = np.zeros((n_grads, n_grads), dtype=np.float64)
+        for dsetname in self.dsetnames:
+            results = self._log_likelihood(
+                tf.constant(0, dtype=fd.int_type()),
+                dsetname=dsetname,
+                data_tensor=None,
+                batch_info=None,
+                omit_grads=omit_grads,
+                second_order=second_order,
+                empty_batch=True,
+                **params)
+            ll += results[0].numpy().astype(np.float64)
+            if self.param_names:
+                if results[1] is None:
+                    raise ValueError("TensorFlow returned None as gradient!")
+                llgrad += results[1].numpy().astype(np.float64)
+                if second_order:
+                    llgrad2 += results[2].numpy().astype(np.float64)
+
+        for worker_ll, worker_grad, worker_grad2 in self._receive_workers():
+            ll += worker_ll
+            llgrad += worker_grad
+            if second_order:
+                llgrad2 += worker_grad2
+
+        if second_order:
+            return ll, llgrad, llgrad2
+        return ll, llgrad, None
+
+    def close(self):
+        """Stop the workers"""
+        if not self._connections:
+            return
+        self._call_workers('stop', dict())
+        for conn in self._connections:
+            conn.close()
+        for p in self._processes:
+            p.join()
+        self._connections = []
+        self._processes = []
+
+    def _terminate(self):
+        """Stop the workers without waiting for them to finish
+        their current command
+        """
+        for conn in self._connections:
+            conn.close()
+        for p in self._processes:
+            p.terminate()
+            p.join()
+        self._connections = []
+        self._processes = []
+
+    def _send_workers(self, command, kwargs):
+        """Send command to all workers.
+
+        :param kwargs: dict of keyword arguments for the command,
+            or a list of such dicts, one for each worker.
+        """
+        if isinstance(kwargs, dict):
+            kwargs = [kwargs] * self.n_workers
+        for conn, worker_kwargs in zip(self._connections, kwargs):
+            conn.send((command, worker_kwargs))
+
+    def _receive_workers(self):
+        """Return list of results from all workers"""
+        results = []
+        for conn in self._connections:
+            status, result = conn.recv()
+            if status != 'ok':
+                raise RuntimeError(f"Likelihood worker failed:\n{result}")
+            results.append(result)
+        return results
+
+    def _call_workers(self, command, kwargs):
+        self._send_workers(command, kwargs)
+        return self._receive_workers()
+
+
+@export
+def serve_likelihood_worker(address, authkey=None):
+    """Serve as a worker for one DistributedLogLikelihood, until it
+    closes the connection.
+
+    :param address: (host, port) to listen on
+    :param authkey: Authentication key (bytes) the coordinator must use
+    """
+    with Listener(tuple(address), authkey=authkey) as listener:
+        with listener.accept() as conn:
+            _serve(conn)
+
+
+def _serve(conn):
+    """Execute DistributedLogLikelihood commands received over conn"""
+    lf = None
+    while True:
+        try:
+            command, kwargs = conn.recv()
+        except EOFError:
+            # Coordinator is gone
+            return
+        try:
+            if command == 'init':
+                result = None
+                lf = fd.LogLikelihood(**kwargs)
+            elif command == 'set_data':
+                result = None
+                lf.set_data(kwargs['data'])
+            elif command == 'log_likelihood':
+                result = lf._sum_log_likelihood(
+                    lf.prepare_params(kwargs['params']),
+                    second_order=kwargs['second_order'],
+                    omit_grads=kwargs['omit_grads'],
+                    data_only=True)
+            elif command == 'stop':
+                conn.send(('ok', None))
+                return
+            else:
+                raise ValueError(f"Unknown command {command}")
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+        else:
+            conn.send(('ok', result))
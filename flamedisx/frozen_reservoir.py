@@ -1,16 +1,52 @@
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import hashlib
+import multiprocessing
+import os
+from pathlib import Path
 import typing as ty
+
+import numpy as np
 import pandas as pd
+import tensorflow as tf
+from tqdm import tqdm
 
 import flamedisx as fd
 export, __all__ = fd.exporter()
 
 
 def make_event_reservoir(ntoys: int = None,
+                         rng=None,
+                         chunk_size: int = None,
+                         n_workers: int = 1,
+                         cache_dir: str = None,
+                         progress: bool = True,
+                         anchors: dict = None,
                          **sources):
     """Generate an annotated reservoir of events to be used in FrozenReservoirSource s.
 
     Arguments:
         - ntoys: number of toy MCs this reservoir will be used to generate (optional).
+        - rng: seed or numpy random Generator to simulate with, see
+            fd.random_generator (optional).
+        - chunk_size: number of events for which to compute the differential
+            rates at once (optional). By default, do all events at once.
+        - n_workers: number of processes computing the differential rates
+            of different chunks (optional). Sources are sent to the workers
+            by pickling. By default, compute them in this process.
+        - cache_dir: directory in which to save the simulated events, and the
+            differential rates of each chunk as soon as they are known (optional).
+            Whatever is already there, e.g. from an interrupted call,
+            is loaded rather than computed again. A key file identifies the
+            sources (their classes and defaults), ntoys, chunk_size and
+            anchors; reusing the directory with different ones raises
+            ValueError.
+        - progress: whether to show a progress bar over the chunks.
+        - anchors: dictionary parameter name -> (start, stop, n_anchors), to
+            also compute the differential rates at n_anchors values of each
+            parameter between start and stop, with the other parameters at
+            their defaults (optional). FrozenReservoirSource s then interpolate
+            the differential rate in these parameters.
         - sources: pass in source instances to be used to build the reservoir, like
             'source1'=source1(args, kwargs), 'source2'=source2(args, kwargs), ...
     """
@@ -20,29 +56,236 @@ def make_event_reservoir(ntoys: int = None,
 
     if ntoys is None:
         ntoys = default_ntoys
+    if anchors is None:
+        anchors = dict()
+    anchors = {pname: (float(start), float(stop), int(n_anchors))
+               for pname, (start, stop, n_anchors) in anchors.items()}
+    assert all([n_anchors > 1 for _, _, n_anchors in anchors.values()]), \
+        "Need at least two anchors per parameter"
 
-    dfs = []
-    for sname, source in sources.items():
-        n_simulate = int(ntoys * source.mu_before_efficiencies())
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        _check_cache_key(cache_dir,
+                         _reservoir_key(sources, ntoys, chunk_size, anchors))
 
-        sdata = source.simulate(n_simulate)
-        sdata['source'] = sname
-        dfs.append(sdata)
+    if cache_dir is not None and (cache_dir / 'events.npz').exists():
+        data_reservoir = _load_columns(cache_dir / 'events.npz')
+    else:
+        rng = fd.random_generator(rng)
+        dfs = []
+        for sname, source in sources.items():
+            n_simulate = int(ntoys * source.mu_before_efficiencies())
 
-    data_reservoir = pd.concat(dfs, ignore_index=True)
+            sdata = source.simulate(n_simulate, rng=rng)
+            sdata['source'] = sname
+            dfs.append(sdata)
 
-    for sname, source in sources.items():
-        source.set_data(data_reservoir)
-        data_reservoir[f'{sname}_diff_rate'] = source.batched_differential_rate()
+        data_reservoir = pd.concat(dfs, ignore_index=True)
+        if cache_dir is not None:
+            _save_columns(cache_dir / 'events.npz', data_reservoir)
+
+    n_events = len(data_reservoir)
+    if chunk_size is None:
+        chunk_size = max(n_events, 1)
+    chunks = [(start, min(start + chunk_size, n_events))
+              for start in range(0, n_events, chunk_size)]
+
+    # Differential rates of all sources for each chunk, by chunk start
+    diff_rates = dict()
+    todo = []
+    for start, stop in chunks:
+        if (cache_dir is not None
+                and _chunk_file(cache_dir, start, stop).exists()):
+            diff_rates[start] = _load_columns(
+                _chunk_file(cache_dir, start, stop))
+        else:
+            todo.append((start, stop))
+    todo_data = (data_reservoir.iloc[start:stop].reset_index(drop=True)
+                 for start, stop in todo)
+
+    with contextlib.ExitStack() as stack:
+        if n_workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(
+                n_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_reservoir_worker,
+                initargs=(sources, anchors)))
+            results = executor.map(_chunk_diff_rates, todo_data)
+        else:
+            results = (_chunk_diff_rates(d, sources, anchors)
+                       for d in todo_data)
+        if progress:
+            results = tqdm(results, total=len(todo),
+                           desc="Computing differential rates")
+
+        # Results arrive in order, save each as soon as it is known
+        for (start, stop), result in zip(todo, results):
+            if cache_dir is not None:
+                _save_columns(_chunk_file(cache_dir, start, stop), result)
+            diff_rates[start] = result
+
+    for column in _diff_rate_columns(sources, anchors):
+        if chunks:
+            data_reservoir[column] = np.concatenate(
+                [diff_rates[start][column] for start, _ in chunks])
+        else:
+            # No events were simulated
+            data_reservoir[column] = np.zeros(0)
+    data_reservoir.attrs['diff_rate_anchors'] = anchors
 
     return data_reservoir
 
 
+def anchor_column(column, pname, i):
+    """Return name of the column with differential rates in column,
+    but at the i-th anchor of the parameter pname
+    """
+    return f'{column}_{pname}_{i}'
+
+
+@export
+def save_event_reservoir(path, reservoir: pd.DataFrame):
+    """Save a reservoir from make_event_reservoir to an npz file at path,
+    including the anchors of its differential rates
+    """
+    _save_columns(Path(path), reservoir)
+
+
+@export
+def load_event_reservoir(path) -> pd.DataFrame:
+    """Return a reservoir saved with save_event_reservoir"""
+    return _load_columns(Path(path))
+
+
+def _diff_rate_columns(sources, anchors):
+    """Return names of the differential rate columns
+    make_event_reservoir adds, in the order _chunk_diff_rates makes them
+    """
+    columns = []
+    for sname, source in sources.items():
+        column = f'{sname}_diff_rate'
+        columns.append(column)
+        for pname, (_, _, n_anchors) in anchors.items():
+            if pname in source.defaults:
+                columns += [anchor_column(column, pname, i)
+                            for i in range(n_anchors)]
+    return columns
+
+
+def _reservoir_key(sources, ntoys, chunk_size, anchors):
+    """Return hash identifying the settings of make_event_reservoir"""
+    key = hashlib.sha1()
+    key.update(repr([
+        (sname,
+         type(source).__module__, type(source).__qualname__,
+         sorted([(pname, fd.tf_to_np(x).tolist())
+                 for pname, x in source.defaults.items()]))
+        for sname, source in sorted(sources.items())]).encode())
+    key.update(repr((ntoys, chunk_size, sorted(anchors.items()))).encode())
+    return key.hexdigest()
+
+
+def _check_cache_key(cache_dir, key):
+    """Raise ValueError if cache_dir has files made with another key,
+    otherwise write key to cache_dir if it is not there yet
+    """
+    key_file = cache_dir / 'key.txt'
+    if key_file.exists():
+        if key_file.read_text() != key:
+            raise ValueError(
+                f"{cache_dir} holds a reservoir made with other sources, "
+                f"ntoys, chunk_size or anchors. Use another cache_dir, "
+                f"or empty it to start over.")
+        return
+    if any(cache_dir.glob('*.npz')):
+        raise ValueError(
+            f"{cache_dir} holds files without a key, so it is unclear "
+            f"how they were made. Use another cache_dir, "
+            f"or empty it to start over.")
+    key_file.write_text(key)
+
+
+def _chunk_file(cache_dir, start, stop):
+    return cache_dir / f'diff_rates_{start}_{stop}.npz'
+
+
+def _save_columns(path, df):
+    """Save columns of df, and the anchors in its attrs if any, to an npz
+    file at path. The file only appears once it is complete,
+    so an interrupted save leaves no corrupt file.
+    """
+    columns = {k: (np.asarray(v, dtype=str) if v.dtype == object
+                   else np.asarray(v))
+               for k, v in df.items()}
+    anchors = df.attrs.get('diff_rate_anchors')
+    if anchors is not None:
+        columns['__anchor_names__'] = np.asarray(list(anchors), dtype=str)
+        columns['__anchor_specs__'] = np.asarray(
+            list(anchors.values()), dtype=float).reshape(-1, 3)
+    temp_path = path.with_suffix('.tmp')
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(temp_path, path)
+
+
+def _load_columns(path):
+    with np.load(path) as f:
+        df = pd.DataFrame({k: f[k] for k in f.files
+                           if k not in ('__anchor_names__',
+                                        '__anchor_specs__')})
+        if '__anchor_names__' in f.files:
+            df.attrs['diff_rate_anchors'] = {
+                str(pname): (start, stop, int(n_anchors))
+                for pname, (start, stop, n_anchors) in zip(
+                    f['__anchor_names__'], f['__anchor_specs__'].tolist())}
+    return df
+
+
+_worker_sources = None
+_worker_anchors = None
+
+
+def _init_reservoir_worker(sources, anchors):
+    global _worker_sources, _worker_anchors
+    _worker_sources = sources
+    _worker_anchors = anchors
+
+
+def _chunk_diff_rates(d, sources=None, anchors=None):
+    """Return dataframe with differential rates of events in d
+    under each source, at the defaults and at the anchors
+    """
+    if sources is None:
+        sources, anchors = _worker_sources, _worker_anchors
+    result = dict()
+    for sname, source in sources.items():
+        source.set_data(d)
+        column = f'{sname}_diff_rate'
+        result[column] = source.batched_differential_rate(progress=False)
+        for pname, (start, stop, n_anchors) in anchors.items():
+            if pname not in source.defaults:
+                continue
+            for i, x in enumerate(np.linspace(start, stop, n_anchors)):
+                result[anchor_column(column, pname, i)] = \
+                    source.batched_differential_rate(progress=False,
+                                                     **{pname: x})
+    result = pd.DataFrame(result)
+    result.attrs['diff_rate_anchors'] = anchors
+    return result
+
+
 @export
 class FrozenReservoirSource(fd.ColumnSource):
     """Source that looks up precomputed differential rates in a column source,
     with the added ability to simulate.
 
+    If the reservoir has differential rates at anchors of some parameters
+    (see make_event_reservoir), the source takes these parameters.
+    Like CrossInterpolatedMu, it interpolates the relative change of the
+    differential rate along each parameter, and multiplies these changes.
+    Simulated events and mu are reweighted accordingly.
+
     Arguments:
         - source_type: base flamedisx source class.
         - source_name: name given to the base source; must match the source name
@@ -75,12 +318,90 @@ class FrozenReservoirSource(fd.ColumnSource):
         self.column = f'{source_name}_diff_rate'
         self.mu = source.estimate_mu()
 
+        #: Dictionary parameter name -> (start, stop, n_anchors)
+        #: of parameters the differential rate is interpolated in
+        self.anchors = {
+            pname: spec
+            for pname, spec in reservoir.attrs.get(
+                'diff_rate_anchors', dict()).items()
+            if anchor_column(self.column, pname, 0) in reservoir.columns}
+        self._anchor_defaults = {pname: source.defaults[pname]
+                                 for pname in self.anchors}
+
         super().__init__(*args, **kwargs)
 
+    def scan_model_functions(self):
+        super().scan_model_functions()
+        self.defaults.update(self._anchor_defaults)
+
+    def extra_needed_columns(self):
+        return super().extra_needed_columns() + [
+            anchor_column(self.column, pname, i)
+            for pname, (_, _, n_anchors) in self.anchors.items()
+            for i in range(n_anchors)]
+
+    def _differential_rate(self, data_tensor, ptensor):
+        return self._fetch(self.column, data_tensor) * self._rate_ratio(
+            lambda x: self._fetch(x, data_tensor),
+            **{pname: self._fetch_param(pname, ptensor)
+               for pname in self.anchors})
+
+    def _rate_ratio(self, fetch, **params):
+        """Return ratio of the differential rates at params and
+        at the defaults, for each event
+
+        :param fetch: function returning a data column given its name
+        """
+        base_rate = fd.np_to_tf(fetch(self.column))
+        result = tf.ones_like(base_rate)
+        for pname, x in params.items():
+            start, stop, n_anchors = self.anchors[pname]
+            anchor_rates = tf.stack(
+                [fd.np_to_tf(fetch(anchor_column(self.column, pname, i)))
+                 for i in range(n_anchors)],
+                axis=1)
+            # Linear interpolation, constant beyond the outer anchors
+            i = tf.clip_by_value(
+                (tf.cast(x, fd.float_type()) - start)
+                / (stop - start) * (n_anchors - 1),
+                0., n_anchors - 1.)
+            i_left = tf.minimum(tf.floor(i), n_anchors - 2.)
+            rate = (
+                (1 - (i - i_left)) * tf.gather(
+                    anchor_rates, tf.cast(i_left, fd.int_type()), axis=1)
+                + (i - i_left) * tf.gather(
+                    anchor_rates, tf.cast(i_left, fd.int_type()) + 1, axis=1))
+            result *= tf.math.divide_no_nan(rate, base_rate)
+        return result
+
+    def _reservoir_weights(self, **params):
+        """Return this source's reservoir events, and their weights
+        for simulating at params (None if params are the defaults)
+        """
+        events = self.reservoir[self.reservoir['source'] == self.source_name]
+        unknown = set(params) - set(self.anchors)
+        if unknown:
+            raise NotImplementedError(
+                f"FrozenReservoirSource has no differential rates at "
+                f"alternative values of {unknown}")
+        if not params:
+            return events, None
+        weights = self._rate_ratio(lambda x: events[x].values, **params)
+        return events, fd.tf_to_np(weights)
+
+    def mu_before_efficiencies(self, **params):
+        _, weights = self._reservoir_weights(**params)
+        if weights is None:
+            return self.mu
+        return self.mu * np.mean(weights)
+
+    def estimate_mu(self, n_trials=None, **params):
+        return self.mu_before_efficiencies(**params)
+
     def random_truth(self, n_events, fix_truth=None, **params):
         if fix_truth is not None:
             raise NotImplementedError("FrozenReservoirSource does not yet support fix_truth")
-        if len(params):
-            raise NotImplementedError("FrozenReservoirSource does not yet support alternative parameters in simulate")
 
-        return self.reservoir[self.reservoir['source'] == self.source_name].sample(n_events, replace=True)
+        events, weights = self._reservoir_weights(**params)
+        return events.sample(n_events, replace=True, weights=weights,
+                             random_state=self.rng)
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import warnings
 
@@ -60,6 +61,7 @@ class LogLikelihood:
             progress=True,
             defaults=None,
             mu_estimators=None,
+            parallel_sources=False,
             **common_param_specs):
         """
 
@@ -108,6 +110,16 @@ class LogLikelihood:
             * a dict {source_name: mu_est}, where mu_est is one of the above two,
                 to use a different estimator for different sources.
 
+        :param parallel_sources: If True, compute the differential rates
+            (and their gradients) of the sources in a dataset concurrently,
+            each source's traced function on its own thread.
+            Only the likelihood and gradient are computed this way;
+            with second_order=True, all sources are still evaluated
+            in a single graph. Each source evaluates its differential
+            rate twice, once for the rates and once with the gradient,
+            so this only pays off with more cores than sources can use
+            on their own.
+
         :param **common_param_specs: dict {param_name: (min, max, mu_options), ...}
             specifying the parameters of the fit. Here min and max are bounds
             on the parameters, and mu_options are instructions to the mu estimator.
@@ -232,6 +244,11 @@ class LogLikelihood:
         # Not used, but useful for mu smoothness diagnosis
         self.param_specs = common_param_specs
 
+        self.parallel_sources = parallel_sources
+        if parallel_sources:
+            self._source_pool = ThreadPoolExecutor(max([
+                len(snames) for snames in self.sources_in_dset.values()]))
+
         # Add the constraint
         if log_constraint is None:
             def log_constraint(**kwargs):
@@ -252,6 +269,10 @@ class LogLikelihood:
                 "You passed one DataFrame but there are multiple datasets"
             data = {DEFAULT_DSETNAME: data}
 
+        # (dataset name, omit_grads) combinations whose functions have
+        # been traced for this data, see _parallel_sources_log_likelihood
+        self._parallel_traced = set()
+
         is_none = [d is None for d in data.values()]
         if any(is_none):
             if not all(is_none):
@@ -278,6 +299,34 @@ class LogLikelihood:
             batch_info[dset_index, :] = [
                 source.n_batches, source.batch_size, source.n_padding]
 
+        self._guess_rate_multipliers(data)
+
+        self.batch_info = tf.convert_to_tensor(batch_info, dtype=fd.int_type())
+
+        # Build a big data tensor for each dataset.
+        # Each source has an [n_batches, batch_size, n_columns] tensor.
+        # Since the number of columns are different, we must concat along
+        # axis=2 and track which indices belong to which source.
+        self.data_tensors = {
+            dsetname: tf.concat(
+                [self.sources[sname].data_tensor
+                 for sname in self.sources_in_dset[dsetname]],
+                axis=2)
+            for dsetname in self.dsetnames}
+
+        self.column_indices = dict()
+        for dsetname in self.dsetnames:
+            # Do not use len(cols_to_cache), some sources have extra columns...
+            stop_idx = np.cumsum([self.sources[sname].data_tensor.shape[2]
+                                  for sname in self.sources_in_dset[dsetname]])
+            self.column_indices[dsetname] = np.transpose([
+                np.concatenate([[0], stop_idx[:-1]]),
+                stop_idx])
+
+    def _guess_rate_multipliers(self, data):
+        """Choose sensible default rate multiplier guesses for the
+        datasets in data, a dictionary {datasetname: pd.DataFrame}
+        """
         # Choose sensible default rate multiplier guesses:
         #  (1) Assume each free source produces just 1 event
         for sname in self.sources:
@@ -307,31 +356,16 @@ class LogLikelihood:
                     self.param_defaults[rmname] *= 1 + n_observed - n_expected
                     break
 
-        self.batch_info = tf.convert_to_tensor(batch_info, dtype=fd.int_type())
-
-        # Build a big data tensor for each dataset.
-        # Each source has an [n_batches, batch_size, n_columns] tensor.
-        # Since the number of columns are different, we must concat along
-        # axis=2 and track which indices belong to which source.
-        self.data_tensors = {
-            dsetname: tf.concat(
-                [self.sources[sname].data_tensor
-                 for sname in self.sources_in_dset[dsetname]],
-                axis=2)
-            for dsetname in self.dsetnames}
-
-        self.column_indices = dict()
-        for dsetname in self.dsetnames:
-            # Do not use len(cols_to_cache), some sources have extra columns...
-            stop_idx = np.cumsum([self.sources[sname].data_tensor.shape[2]
-                                  for sname in self.sources_in_dset[dsetname]])
-            self.column_indices[dsetname] = np.transpose([
-                np.concatenate([[0], stop_idx[:-1]]),
-                stop_idx])
-
-    def simulate(self, fix_truth=None, **params):
+    def simulate(self, fix_truth=None, rng=None, **params):
         """Simulate events from sources.
+
+        :param rng: Seed or numpy random Generator to draw from,
+            see fd.random_generator. By default, seed one from numpy's
+            global random state. To simulate many toy datasets reproducibly
+            (possibly in different processes), pass each one of the
+            generators from fd.spawn_random_generators.
         """
+        rng = fd.random_generator(rng)
         params = self.prepare_params(params, free_all_rates=True)
         # Collect Source event DFs in ds
         ds = []
@@ -342,11 +376,12 @@ class LogLikelihood:
             mu = rm * s.mu_before_efficiencies(
                 **self._filter_source_kwargs(params, sname))
             # Simulate this many events from source
-            n_to_sim = np.random.poisson(mu)
+            n_to_sim = rng.poisson(mu)
             if n_to_sim == 0:
                 continue
             d = s.simulate(n_to_sim,
                            fix_truth=fix_truth,
+                           rng=rng,
                            **self._filter_source_kwargs(params,
                                                         sname))
             # If events were simulated add them to the list
@@ -359,7 +394,7 @@ class LogLikelihood:
         # Adding empty DataFrame ensures pd.concat doesn't fail if
         # n_to_sim is 0 for all sources or all sources return 0 events
         ds = pd.concat([pd.DataFrame()] + ds, sort=False)
-        return ds.sample(frac=1).reset_index(drop=True)
+        return ds.sample(frac=1, random_state=rng).reset_index(drop=True)
 
     def __call__(self, **kwargs):
         assert 'second_order' not in kwargs, 'Roep gewoon log_likelihood aan'
@@ -368,6 +403,20 @@ class LogLikelihood:
     def log_likelihood(self, second_order=False,
                        omit_grads=tuple(), **kwargs):
         params = self.prepare_params(kwargs)
+        return self._sum_log_likelihood(params,
+                                        second_order=second_order,
+                                        omit_grads=omit_grads)
+
+    def _sum_log_likelihood(self, params, second_order=False,
+                            omit_grads=tuple(), data_only=False):
+        """Return (ll, gradient, hessian or None) summed over all batches
+        of all datasets.
+
+        :param params: dictionary of parameters, see prepare_params
+        :param data_only: If True, include only the terms of the events,
+            i.e. omit the expected-events and constraint terms. Datasets
+            without events are skipped.
+        """
         n_grads = len(self.param_defaults) - len(omit_grads)
         ll = 0.
         llgrad = np.zeros(n_grads, dtype=np.float64)
@@ -376,6 +425,8 @@ class LogLikelihood:
         for dsetname in self.dsetnames:
             # Getting this from the batch_info tensor is much slower
             n_batches = self.sources[self.sources_in_dset[dsetname][0]].n_batches
+            if n_batches == 0 and data_only:
+                continue
             if n_batches == 0:
                 # Signal _log_likelihood to do a 'dummy batch' without data,
                 # just to get the mu and constraint terms
@@ -390,23 +441,37 @@ class LogLikelihood:
                     batch_data_tensor = None
                 else:
                     batch_data_tensor = self.data_tensors[dsetname][i_batch]
-                results = self._log_likelihood(
-                    tf.constant(i_batch, dtype=fd.int_type()),
-                    dsetname=dsetname,
-                    data_tensor=batch_data_tensor,
-                    batch_info=self.batch_info,
-                    omit_grads=omit_grads,
-                    second_order=second_order,
-                    empty_batch=empty_batch,
-                    **params)
-                ll += results[0].numpy().astype(np.float64)
-
-                if self.param_names:
-                    if results[1] is None:
-                        raise ValueError("TensorFlow returned None as gradient!")
-                    llgrad += results[1].numpy().astype(np.float64)
-                    if second_order:
-                        llgrad2 += results[2].numpy().astype(np.float64)
+                parallel = (self.parallel_sources
+                            and not second_order and not empty_batch)
+                results = []
+                if parallel:
+                    # Events' terms from the sources' threads,
+                    # the other terms below as for an empty batch
+                    results.append(self._parallel_sources_log_likelihood(
+                        i_batch, dsetname, batch_data_tensor,
+                        omit_grads, params))
+                if not (parallel and data_only):
+                    results.append(self._log_likelihood(
+                        tf.constant(i_batch, dtype=fd.int_type()),
+                        dsetname=dsetname,
+                        data_tensor=None if parallel else batch_data_tensor,
+                        batch_info=self.batch_info,
+                        omit_grads=omit_grads,
+                        second_order=second_order,
+                        empty_batch=empty_batch or parallel,
+                        data_only=data_only,
+                        **params))
+
+                for result in results:
+                    ll += result[0].numpy().astype(np.float64)
+
+                    if self.param_names:
+                        if result[1] is None:
+                            raise ValueError(
+                                "TensorFlow returned None as gradient!")
+                        llgrad += result[1].numpy().astype(np.float64)
+                        if second_order:
+                            llgrad2 += result[2].numpy().astype(np.float64)
 
         if second_order:
             return ll, llgrad, llgrad2
@@ -477,7 +542,7 @@ class LogLikelihood:
     def _log_likelihood(self,
                         i_batch, dsetname, data_tensor, batch_info,
                         omit_grads=tuple(), second_order=False,
-                        empty_batch=False, **params):
+                        empty_batch=False, data_only=False, **params):
         # Stack the params to create a single node
         # to differentiate with respect to.
         grad_par_stack = tf.stack([
@@ -502,12 +567,13 @@ class LogLikelihood:
 
         # Add mu once (to the first batch)
         # and constraint really only once (to first batch of first dataset)
-        ll += tf.where(
-            tf.equal(i_batch, tf.constant(0, dtype=fd.int_type())),
-            - self.mu(dataset_name=dsetname, **params_unstacked),
-            0.)
-        if dsetname == self.dsetnames[0]:
-            ll += self.log_constraint(**params_unstacked)
+        if not data_only:
+            ll += tf.where(
+                tf.equal(i_batch, tf.constant(0, dtype=fd.int_type())),
+                - self.mu(dataset_name=dsetname, **params_unstacked),
+                0.)
+            if dsetname == self.dsetnames[0]:
+                ll += self.log_constraint(**params_unstacked)
 
         # Autodifferentiation. This is why we use tensorflow:
         grad = tf.gradients(ll, grad_par_stack)[0]
@@ -529,29 +595,133 @@ class LogLikelihood:
         batch_size = batch_info[dataset_index, 1]
         n_padding = batch_info[dataset_index, 2]
 
+        # If any source computes in log space, combine the sources'
+        # log differential rates, so rates that underflow in linear space
+        # still contribute.
+        log_space = any([
+            getattr(self.sources[sname], 'log_space', False)
+            for sname in self.sources_in_dset[dsetname]])
+
         # Compute differential rates from all sources
         # drs = list[n_sources] of [n_events] tensors
         drs = tf.zeros((batch_size,), dtype=fd.float_type())
+        log_drs = []
         for source_i, sname in enumerate(self.sources_in_dset[dsetname]):
             s = self.sources[sname]
             rate_mult = self._get_rate_mult(sname, params)
 
             col_start, col_stop = self.column_indices[dsetname][source_i]
-            dr = s.differential_rate(
-                data_tensor[:, col_start:col_stop],
+            kwargs = dict(
                 # We are already tracing; if we call the traced function here
                 # it breaks the Hessian (it will give NaNs)
                 autograph=False,
                 **self._filter_source_kwargs(params, sname))
-            drs += dr * rate_mult
+            if log_space:
+                log_dr = s.log_differential_rate(
+                    data_tensor[:, col_start:col_stop], **kwargs)
+                log_drs.append(log_dr + fd.safe_log(rate_mult))
+            else:
+                dr = s.differential_rate(
+                    data_tensor[:, col_start:col_stop], **kwargs)
+                drs += dr * rate_mult
 
         # Sum over events and remove padding
         n = tf.where(tf.equal(i_batch, n_batches - 1),
                      batch_size - n_padding,
                      batch_size)
+        if log_space:
+            log_drs = tf.reduce_logsumexp(tf.stack(log_drs), axis=0)
+            return tf.reduce_sum(log_drs[:n])
         ll = tf.reduce_sum(tf.math.log(drs[:n]))
         return ll
 
+    def _parallel_sources_log_likelihood(self, i_batch, dsetname,
+                                         data_tensor, omit_grads, params):
+        """Return (ll, gradient) of the events in one batch of a dataset,
+        computing the sources' differential rates on separate threads.
+
+        Once the total rate of each event is known, each source's
+        vector-Jacobian product with the derivative of the likelihood
+        to its differential rate is again computed on its own thread.
+        """
+        # TensorFlow cannot trace several functions on different threads
+        # at once, so the first call runs the sources one after the other.
+        trace_key = (dsetname, tuple(omit_grads))
+        if trace_key in self._parallel_traced:
+            map_sources = self._source_pool.map
+        else:
+            map_sources = map
+
+        snames = self.sources_in_dset[dsetname]
+        log_space = any([getattr(self.sources[sname], 'log_space', False)
+                         for sname in snames])
+        data_tensors = [data_tensor[:, col_start:col_stop]
+                        for col_start, col_stop
+                        in self.column_indices[dsetname]]
+        source_kwargs = [self._filter_source_kwargs(params, sname)
+                         for sname in snames]
+        rate_mults = tf.stack([self._get_rate_mult(sname, params)
+                               for sname in snames])
+
+        def forward(source_i):
+            s = self.sources[snames[source_i]]
+            f = s.log_differential_rate if log_space else s.differential_rate
+            return f(data_tensors[source_i], **source_kwargs[source_i])
+
+        # drs = [n_sources, n_events] tensor of (log) differential rates
+        drs = tf.stack(list(map_sources(forward, range(len(snames)))))
+
+        # Remove padding
+        n_batches, batch_size, n_padding = \
+            self.batch_info[self.dsetnames.index(dsetname)].numpy()
+        n = batch_size - n_padding if i_batch == n_batches - 1 else batch_size
+        is_event = tf.range(batch_size) < n
+
+        # Derivative of the likelihood to each source's (log) differential
+        # rate, and to the rate multipliers
+        if log_space:
+            drs += fd.safe_log(rate_mults)[:, o]
+            total = tf.reduce_logsumexp(drs, axis=0)
+            ll = tf.reduce_sum(total[:n])
+            output_grads = tf.where(is_event[o, :], tf.exp(drs - total[o, :]),
+                                    tf.zeros_like(drs))
+            rate_mult_grads = (tf.reduce_sum(output_grads, axis=1)
+                               / rate_mults)
+        else:
+            total = tf.reduce_sum(drs * rate_mults[:, o], axis=0)
+            ll = tf.reduce_sum(tf.math.log(total[:n]))
+            weights = tf.where(is_event, 1 / total, tf.zeros_like(total))
+            rate_mult_grads = tf.reduce_sum(drs * weights[o, :], axis=1)
+            output_grads = rate_mults[:, o] * weights[o, :]
+
+        grad_names = [k for k in self.param_names if k not in omit_grads]
+        if not grad_names:
+            self._parallel_traced.add(trace_key)
+            return ll, tf.zeros(0, dtype=fd.float_type())
+
+        def backward(source_i):
+            sname = snames[source_i]
+            if not any([k in grad_names
+                        for k in self._source_kwargnames(sname)]):
+                return None
+            return self.sources[sname].differential_rate_vjp(
+                data_tensors[source_i], output_grads[source_i],
+                log=log_space, **source_kwargs[source_i])
+
+        source_grads = list(map_sources(backward, range(len(snames))))
+        self._parallel_traced.add(trace_key)
+
+        grad = {k: tf.constant(0., dtype=fd.float_type())
+                for k in grad_names}
+        for source_i, sname in enumerate(snames):
+            rmname = sname + '_rate_multiplier'
+            if rmname in grad:
+                grad[rmname] += rate_mult_grads[source_i]
+            for k in self._source_kwargnames(sname):
+                if k in grad:
+                    grad[k] += source_grads[source_i][k]
+        return ll, tf.stack(list(grad.values()))
+
     def guess(self) -> ty.Dict[str, float]:
         """Return dictionary of parameter guesses"""
         return {k: v.numpy()
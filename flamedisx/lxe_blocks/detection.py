@@ -1,7 +1,6 @@
 import typing as ty
 
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -13,13 +12,18 @@ o = tf.newaxis
 class DetectPhotonsOrElectrons(fd.Block):
     """Common code for DetectPhotons and DetectElectrons"""
 
-    model_attributes = ('check_efficiencies',)
+    model_attributes = ('check_efficiencies', 'binomial_band_sigma')
 
     # Whether to check if all events have a positive detection efficiency.
     # As with check_acceptances in MakeFinalSignals, you may have to
     # turn this off, depending on your application.
     check_efficiencies = True
 
+    # If not None, only compute and store binomial probabilities within
+    # this many standard deviations of the mean number of detected quanta,
+    # and take them to be zero elsewhere. See fd.BandedTensor.
+    binomial_band_sigma = None
+
     quanta_name: str
 
     # Prevent pycharm warnings:
@@ -29,6 +33,42 @@ class DetectPhotonsOrElectrons(fd.Block):
 
     def _compute(self, data_tensor, ptensor,
                  quanta_produced, quanta_detected):
+        p = self._detection_p(data_tensor, ptensor, quanta_produced)
+
+        if self.binomial_band_sigma is not None:
+            # Only compute and store the band
+            result = fd.banded_binomial_pmf(
+                quanta_detected, quanta_produced, p,
+                band_sigma=self.binomial_band_sigma)
+            acceptance = self.gimme(self.quanta_name + '_acceptance',
+                                    bonus_arg=result.gather(quanta_detected),
+                                    data_tensor=data_tensor, ptensor=ptensor)
+            return result.with_band(result.band * acceptance)
+
+        result = tfp.distributions.Binomial(
+                total_count=quanta_produced,
+                probs=tf.cast(p, dtype=fd.float_type())
+            ).prob(quanta_detected)
+        acceptance = self.gimme(self.quanta_name + '_acceptance',
+                                bonus_arg=quanta_detected,
+                                data_tensor=data_tensor, ptensor=ptensor)
+        return result * acceptance
+
+    def _log_compute(self, data_tensor, ptensor,
+                     quanta_produced, quanta_detected):
+        p = self._detection_p(data_tensor, ptensor, quanta_produced)
+
+        result = tfp.distributions.Binomial(
+                total_count=quanta_produced,
+                probs=tf.cast(p, dtype=fd.float_type())
+            ).log_prob(quanta_detected)
+        acceptance = self.gimme(self.quanta_name + '_acceptance',
+                                bonus_arg=quanta_detected,
+                                data_tensor=data_tensor, ptensor=ptensor)
+        return result + fd.safe_log(acceptance)
+
+    def _detection_p(self, data_tensor, ptensor, quanta_produced):
+        """Return detection probability of each quantum"""
         p = self.gimme(self.quanta_name + '_detection_eff',
                        data_tensor=data_tensor, ptensor=ptensor)[:, o, o]
 
@@ -41,32 +81,24 @@ class DetectPhotonsOrElectrons(fd.Block):
             p = p * self.gimme('electron_loss',
                                bonus_arg=quanta_produced,
                                data_tensor=data_tensor, ptensor=ptensor)
-
-        result = tfp.distributions.Binomial(
-                total_count=quanta_produced,
-                probs=tf.cast(p, dtype=fd.float_type())
-            ).prob(quanta_detected)
-        acceptance = self.gimme(self.quanta_name + '_acceptance',
-                                bonus_arg=quanta_detected,
-                                data_tensor=data_tensor, ptensor=ptensor)
-        return result * acceptance
+        return p
 
     def _simulate(self, d):
         p = self.gimme_numpy(self.quanta_name + '_detection_eff')
 
         if self.quanta_name == 'photon':
             p *= self.gimme_numpy(
-                'penning_quenching_eff', d['photons_produced'].values)
+                'penning_quenching_eff', d['photons_produced'])
         else:
             p *= self.gimme_numpy(
-                'electron_loss', d['electrons_produced'].values)
+                'electron_loss', d['electrons_produced'])
 
-        d[self.quanta_name + 's_detected'] = stats.binom.rvs(
+        d[self.quanta_name + 's_detected'] = self.source.rng.binomial(
             n=d[self.quanta_name + 's_produced'],
             p=p)
         d['p_accepted'] *= self.gimme_numpy(
             self.quanta_name + '_acceptance',
-            d[self.quanta_name + 's_detected'].values)
+            d[self.quanta_name + 's_detected'])
 
     def _annotate(self, d):
         # Get efficiency
@@ -130,6 +162,12 @@ class DetectPhotons(DetectPhotonsOrElectrons):
                                 quanta_detected=photons_detected,
                                 data_tensor=data_tensor, ptensor=ptensor)
 
+    def _log_compute(self, data_tensor, ptensor,
+                     photons_produced, photons_detected):
+        return super()._log_compute(quanta_produced=photons_produced,
+                                    quanta_detected=photons_detected,
+                                    data_tensor=data_tensor, ptensor=ptensor)
+
 
 @export
 class DetectElectrons(DetectPhotonsOrElectrons):
@@ -161,3 +199,9 @@ class DetectElectrons(DetectPhotonsOrElectrons):
         return super()._compute(quanta_produced=electrons_produced,
                                 quanta_detected=electrons_detected,
                                 data_tensor=data_tensor, ptensor=ptensor)
+
+    def _log_compute(self, data_tensor, ptensor,
+                     electrons_produced, electrons_detected):
+        return super()._log_compute(quanta_produced=electrons_produced,
+                                    quanta_detected=electrons_detected,
+                                    data_tensor=data_tensor, ptensor=ptensor)
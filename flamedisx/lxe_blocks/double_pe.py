@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -13,11 +12,17 @@ class MakeS1Photoelectrons(fd.Block):
     dimensions = ('photons_detected', 'photoelectrons_detected')
 
     model_functions = ('double_pe_fraction',)
+    model_attributes = ('binomial_band_sigma',)
 
     max_dim_size = {'photons_detected': 100}
 
     double_pe_fraction = 0.219
 
+    # If not None, only compute and store binomial probabilities within
+    # this many standard deviations of the mean number of photoelectrons,
+    # and take them to be zero elsewhere. See fd.BandedTensor.
+    binomial_band_sigma = None
+
     def _compute(self, data_tensor, ptensor,
                  photons_detected, photoelectrons_detected):
         p_dpe = self.gimme('double_pe_fraction',
@@ -28,26 +33,50 @@ class MakeS1Photoelectrons(fd.Block):
         extra_pe = photoelectrons_detected - photons_detected
         invalid = extra_pe < 0
 
-        # Negative arguments would mess up tfp's Binomial
-        extra_pe = tf.where(invalid,
-                            tf.zeros_like(extra_pe),
-                            extra_pe)
-
         # (N_pe - N_photons) distributed as Binom(N_photons, p=pdpe)
+        if self.binomial_band_sigma is not None:
+            # Only compute and store the band. It is zero for extra_pe < 0.
+            return fd.banded_binomial_pmf(
+                extra_pe, photons_detected, p_dpe,
+                band_sigma=self.binomial_band_sigma)
+
+        # Negative arguments would mess up tfp's Binomial
         result = tfp.distributions.Binomial(
                 total_count=photons_detected,
                 probs=tf.cast(p_dpe, dtype=fd.float_type())
-            ).prob(extra_pe)
+            ).prob(tf.where(invalid,
+                            tf.zeros_like(extra_pe),
+                            extra_pe))
 
         # Set probability of extra_pe < 0 cases to 0
         return tf.where(invalid,
                         tf.zeros_like(photoelectrons_detected),
                         result)
 
+    def _log_compute(self, data_tensor, ptensor,
+                     photons_detected, photoelectrons_detected):
+        p_dpe = self.gimme('double_pe_fraction',
+                           data_tensor=data_tensor, ptensor=ptensor)[:, o, o]
+
+        extra_pe = photoelectrons_detected - photons_detected
+        invalid = extra_pe < 0
+
+        # (N_pe - N_photons) distributed as Binom(N_photons, p=pdpe)
+        result = tfp.distributions.Binomial(
+                total_count=photons_detected,
+                probs=tf.cast(p_dpe, dtype=fd.float_type())
+            ).log_prob(tf.where(invalid,
+                                tf.zeros_like(extra_pe),
+                                extra_pe))
+        return tf.where(invalid,
+                        -np.inf * tf.ones_like(result),
+                        result)
+
     def _simulate(self, d):
-        d['photoelectrons_detected'] = stats.binom.rvs(
-            n=d['photons_detected'],
-            p=self.gimme_numpy('double_pe_fraction')) + d['photons_detected']
+        photons_detected = d['photons_detected']
+        d['photoelectrons_detected'] = self.source.rng.binomial(
+            n=photons_detected,
+            p=self.gimme_numpy('double_pe_fraction')) + photons_detected
 
     def _annotate(self, d):
         # TODO: this assumes the spread from the double PE effect is subdominant
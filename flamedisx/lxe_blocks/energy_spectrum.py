@@ -60,10 +60,10 @@ class EnergySpectrum(fd.FirstBlock):
         randomly drawn.
         """
         data = dict()
-        data['r'] = (np.random.rand(n_events) * self.fv_radius**2)**0.5
-        data['theta'] = np.random.uniform(0, 2*np.pi, size=n_events)
-        data['z'] = np.random.uniform(self.fv_low, self.fv_high,
-                                      size=n_events)
+        data['r'] = (self.source.rng.random(n_events) * self.fv_radius**2)**0.5
+        data['theta'] = self.source.rng.uniform(0, 2*np.pi, size=n_events)
+        data['z'] = self.source.rng.uniform(self.fv_low, self.fv_high,
+                                            size=n_events)
         data['x'], data['y'] = fd.pol_to_cart(data['r'], data['theta'])
 
         data['drift_time'] = - data['z'] / self.drift_velocity
@@ -72,7 +72,7 @@ class EnergySpectrum(fd.FirstBlock):
     def draw_time(self, n_events, **params):
         """Return n_events event_times drawn uniformaly
         between t_start and t_stop"""
-        return np.random.uniform(
+        return self.source.rng.uniform(
             self.t_start.value,
             self.t_stop.value,
             size=n_events)
@@ -92,7 +92,7 @@ class EnergySpectrum(fd.FirstBlock):
         assert len(spectrum_numpy) == len(self.energies), \
             "Energies and spectrum have different length"
 
-        data['energy'] = np.random.choice(
+        data['energy'] = self.source.rng.choice(
             fd.tf_to_np(self.energies),
             size=n_events,
             p=spectrum_numpy / spectrum_numpy.sum(),
@@ -245,7 +245,8 @@ class SpatialRateEnergySpectrum(FixedShapeEnergySpectrum):
         drawn from the spatial rate histogram.
         """
         data = dict()
-        positions = self.spatial_hist.get_random(size=n_events)
+        positions = fd.random_from_histogram(
+            self.spatial_hist, n_events, rng=self.source.rng)
         for idx, col in enumerate(self.spatial_hist.axis_names):
             data[col] = positions[:, idx]
         if self.polar:
@@ -404,10 +405,9 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
             # Time is fixed, so the energy spectrum differs.
             # (if energy is also fixed, it will just be overridden later
             #  and we're doing a bit of unnecessary work here)
-            data['energy'] = \
-                self.energy_hist \
-                    .slicesum(t, axis=0) \
-                    .get_random(n_events)
+            data['energy'] = fd.random_from_histogram(
+                self.energy_hist.slicesum(t, axis=0),
+                n_events, rng=self.source.rng)
             times = t
 
         elif 'energy' in fix_truth:
@@ -415,13 +415,13 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
             e_edges = self.energy_hist.bin_edges[1]
             assert e_edges[0] <= fix_truth['energy'] < e_edges[-1], \
                 "fix_truth energy out of bounds"
-            times = \
-                self.energy_hist \
-                    .slicesum(fix_truth['energy'], axis=1) \
-                    .get_random(n_events)
+            times = fd.random_from_histogram(
+                self.energy_hist.slicesum(fix_truth['energy'], axis=1),
+                n_events, rng=self.source.rng)
 
         else:
-            times, data['energy'] = self.energy_hist.get_random(n_events).T
+            times, data['energy'] = fd.random_from_histogram(
+                self.energy_hist, n_events, rng=self.source.rng).T
 
         data['event_time'] = fd.j2000_to_event_time(times)
 
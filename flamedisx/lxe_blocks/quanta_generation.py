@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -93,7 +92,7 @@ class MakeERQuanta(fd.Block):
 
     def _simulate(self, d):
         work = self.gimme_numpy('work')
-        d['quanta_produced'] = np.floor(d['energy'].values
+        d['quanta_produced'] = np.floor(d['energy']
                                         / work).astype(int)
 
     def _annotate(self, d):
@@ -205,11 +204,10 @@ class MakeNRQuanta(fd.Block):
         return (result_left + result_right) / 2
 
     def _simulate(self, d):
-        # If you forget the .values here, you may get a Python core dump...
-        energies = d['energy'].values
+        energies = d['energy']
         work = self.gimme_numpy('work')
         lindhard_l = self.gimme_numpy('lindhard_l', bonus_arg=energies)
-        d['quanta_produced'] = stats.poisson.rvs(energies * lindhard_l / work)
+        d['quanta_produced'] = self.source.rng.poisson(energies * lindhard_l / work)
 
     def _annotate(self, d):
         d['quanta_produced_noStep_min'] = (
@@ -281,13 +279,10 @@ def calculate_dimsizes_special(self):
            d['electrons_produced_steps']) * d['photons_produced_steps']
 
     batch_size = self.source.batch_size
-    n_batches = self.source.n_batches
 
     # Need the electrons/photons steps to be the same within a batch for the
     # averaging procedure in _compute to work correctly
-    for i in range(n_batches):
-        quanta_steps[i * batch_size: (i + 1) * batch_size + 1] = \
-            max(quanta_steps[i * batch_size: (i + 1) * batch_size + 1])
+    quanta_steps = fd.batch_reduce(quanta_steps.to_numpy(), batch_size)
 
     d['electrons_produced_steps'] = quanta_steps
     d['photons_produced_steps'] = quanta_steps
@@ -315,10 +310,8 @@ def calculate_dimsizes_special(self):
 
     # Need the quanta_produced dimsizes to be the same within a batch for the
     # averaging procedure in _compute to work correctly
-    for i in range(n_batches):
-        quanta_produced_dimsizes[i * batch_size: (i + 1) * batch_size + 1] = \
-            max(quanta_produced_dimsizes[i * batch_size:
-                (i + 1) * batch_size + 1])
+    quanta_produced_dimsizes = fd.batch_reduce(quanta_produced_dimsizes,
+                                               batch_size)
 
     self.source.dimsizes['quanta_produced'] = quanta_produced_dimsizes
 
@@ -1,3 +1,5 @@
+import functools
+
 import tensorflow as tf
 
 import flamedisx as fd
@@ -101,3 +103,36 @@ class SpatialRateNRSource(NRSource):
 @export
 class WIMPSource(NRSource):
     model_blocks = (fd.WIMPEnergySpectrum,) + NRSource.model_blocks[1:]
+
+
+@export
+class TabulatedERSource(ERSource):
+    """ERSource that looks up p_electron in a table during differential
+    rate computations, rather than evaluating it exactly. See fd.tabulated.
+    """
+
+    @staticmethod
+    @fd.tabulated(1., 1e5, n_points=100000)
+    @functools.wraps(ERSource.p_electron)
+    def p_electron(*args, **kwargs):
+        return ERSource.p_electron(*args, **kwargs)
+
+
+@export
+class TabulatedNRSource(NRSource):
+    """NRSource that looks up p_electron and lindhard_l in tables during
+    differential rate computations, rather than evaluating them exactly.
+    See fd.tabulated.
+    """
+
+    @staticmethod
+    @fd.tabulated(1., 1e5, n_points=100000)
+    @functools.wraps(NRSource.p_electron)
+    def p_electron(*args, **kwargs):
+        return NRSource.p_electron(*args, **kwargs)
+
+    @staticmethod
+    @fd.tabulated(0.1, 500., n_points=50000)
+    @functools.wraps(fd.MakeNRQuanta.lindhard_l)
+    def lindhard_l(*args, **kwargs):
+        return fd.MakeNRQuanta.lindhard_l(*args, **kwargs)
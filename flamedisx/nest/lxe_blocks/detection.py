@@ -1,7 +1,6 @@
 import typing as ty
 
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -59,12 +58,12 @@ class DetectPhotonsOrElectrons(fd.Block):
             p *= self.gimme_numpy(
                 's2_posDependence')
 
-        d[self.quanta_name + 's_detected'] = stats.binom.rvs(
+        d[self.quanta_name + 's_detected'] = self.source.rng.binomial(
             n=d[self.quanta_name + 's_produced'],
             p=p)
         d['p_accepted'] *= self.gimme_numpy(
             self.quanta_name + '_acceptance',
-            d[self.quanta_name + 's_detected'].values)
+            d[self.quanta_name + 's_detected'])
 
     def _annotate(self, d):
         # Get efficiency
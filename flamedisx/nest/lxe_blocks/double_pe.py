@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -41,9 +40,10 @@ class MakePhotoelectrons(fd.Block):
                         result)
 
     def _simulate(self, d):
-        d[self.quanta_out_name] = stats.binom.rvs(
-            n=d[self.quanta_in_name],
-            p=self.gimme_numpy('double_pe_fraction')) + d[self.quanta_in_name]
+        quanta_in = d[self.quanta_in_name]
+        d[self.quanta_out_name] = self.source.rng.binomial(
+            n=quanta_in,
+            p=self.gimme_numpy('double_pe_fraction')) + quanta_in
 
     def _annotate(self, d):
         for suffix, bound in (('_min', 'lower'),
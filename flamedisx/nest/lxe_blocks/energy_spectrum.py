@@ -1,3 +1,5 @@
+import hashlib
+
 from multihist import Histdd
 import numpy as np
 import pandas as pd
@@ -9,6 +11,61 @@ export, __all__ = fd.exporter()
 o = tf.newaxis
 
 
+@export
+def energy_quadrature_nodes(energies, rates, n_nodes, uniform_fraction=0.5):
+    """Return (indices, node_rates) of n_nodes energies representing
+    the comb spectrum (energies, rates).
+
+    The comb is split into n_nodes groups of consecutive energies, of equal
+    weight under a density that mixes the spectrum (normalized) with a
+    uniform density per energy point. Each group is represented by its
+    energy closest to the rate-weighted mean energy of the group, with the
+    total rate of the group. Groups are empty if single energies outweigh
+    them; these give repeats of the last node with zero rate.
+
+    :param energies: sorted energies of the comb
+    :param rates: rates of the comb
+    :param n_nodes: number of nodes to return. If there are not more
+        energies than this, all energies are returned.
+    :param uniform_fraction: weight of the uniform density, so flat parts
+        of the spectrum still get at least this fraction of the nodes they
+        would get under uniform stepping.
+    """
+    energies = np.asarray(energies, dtype=float)
+    rates = np.asarray(rates, dtype=float)
+    n = len(energies)
+    if n <= n_nodes:
+        return np.arange(n), rates.copy()
+
+    density = np.full(n, 1. / n)
+    if rates.sum() > 0:
+        density = (uniform_fraction * density
+                   + (1 - uniform_fraction) * rates / rates.sum())
+    cdf_mid = np.cumsum(density) - density / 2
+    group = np.minimum((cdf_mid * n_nodes).astype(int), n_nodes - 1)
+
+    group_rates = np.bincount(group, weights=rates, minlength=n_nodes)
+    group_sizes = np.bincount(group, minlength=n_nodes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_energy = np.where(
+            group_rates > 0,
+            np.bincount(group, weights=rates * energies, minlength=n_nodes)
+            / group_rates,
+            np.bincount(group, weights=energies, minlength=n_nodes)
+            / group_sizes)
+
+    # For each nonempty group, the index closest to its mean energy
+    order = np.lexsort((np.abs(energies - mean_energy[group]), group))
+    groups_present, first = np.unique(group[order], return_index=True)
+    indices = order[first]
+    node_rates = group_rates[groups_present]
+
+    n_missing = n_nodes - len(indices)
+    indices = np.concatenate([indices, np.full(n_missing, indices[-1])])
+    node_rates = np.concatenate([node_rates, np.zeros(n_missing)])
+    return indices, node_rates
+
+
 @export
 class EnergySpectrum(fd.FirstBlock):
     dimensions = ('energy',)
@@ -16,7 +73,8 @@ class EnergySpectrum(fd.FirstBlock):
         'energies',
         'radius', 'z_top', 'z_bottom', 'z_topDrift',
         'drift_velocity',
-        't_start', 't_stop')
+        't_start', 't_stop',
+        'adaptive_energy_nodes', 'energy_node_uniform_fraction')
 
     # The default boundaries are at points where the WIMP wind is at its
     # average speed.
@@ -28,9 +86,40 @@ class EnergySpectrum(fd.FirstBlock):
     energies = tf.cast(tf.linspace(0., 10., 1000),
                        dtype=fd.float_type())
 
+    #: If True, represent the spectrum in each batch by energy nodes
+    #: chosen with energy_quadrature_nodes, rather than by uniformly
+    #: stepping through the energies. Only for fixed-shape spectra;
+    #: variable spectra raise a ValueError.
+    adaptive_energy_nodes = False
+
+    #: uniform_fraction passed to energy_quadrature_nodes
+    energy_node_uniform_fraction = 0.5
+
+    # Hash of the settings for which the MC reservoir was simulated (see
+    # _settings_hash), and the reservoir columns used for the energy bounds,
+    # sorted by electrons_produced
+    _reservoir_key = None
+    _reservoir_sorted = None
+
+    def setup(self):
+        if self.adaptive_energy_nodes:
+            # Indices of the nodes in energies, padded with -1, and their rates
+            n_nodes = max(min(len(self.energies),
+                              self.source.max_dim_sizes['energy']),
+                          2)
+            self.array_columns = (('energy_node_index', n_nodes),
+                                  ('energy_node_rate', n_nodes))
+
     def domain(self, data_tensor):
         assert isinstance(self.energies, tf.Tensor)  # see WIMPsource for why
 
+        if self.adaptive_energy_nodes:
+            node_index = self.source._fetch('energy_node_index', data_tensor=data_tensor)[0, :]
+            node_index = tf.cast(tf.boolean_mask(node_index, node_index >= 0), fd.int_type())
+            return {self.dimensions[0]: tf.repeat(tf.gather(self.energies, node_index)[o, :],
+                                                  self.source.batch_size,
+                                                  axis=0)}
+
         left_bound = tf.reduce_min(self.source._fetch('energy_min', data_tensor=data_tensor))
         right_bound = tf.reduce_max(self.source._fetch('energy_max', data_tensor=data_tensor))
         bool_mask = tf.logical_and(tf.greater_equal(self.energies, left_bound),
@@ -48,51 +137,123 @@ class EnergySpectrum(fd.FirstBlock):
                                               axis=0)}
 
     def _annotate(self, d):
-        # Generate an MC reservoir for obtaining energy bounds. Also use this for Bayes bounds priors
-        self.source.mc_reservoir = self.source.simulate(int(1e6), keep_padding=True)
-        assert not self.source.mc_reservoir.empty, \
-            "MC reservoir used in energy bounds computation is empty. Are your cuts too tight?"
-
-        energy = self.source.mc_reservoir.columns.get_loc('energy')
-        electrons_produced = self.source.mc_reservoir.columns.get_loc('electrons_produced')
-        photons_produced = self.source.mc_reservoir.columns.get_loc('photons_produced')
-        res = self.source.mc_reservoir.values
+        # Generate an MC reservoir for obtaining energy bounds. Also use this for Bayes bounds priors.
+        # The reservoir only depends on the model settings, so we can reuse it for new data.
+        reservoir_key = self._settings_hash()
+        if self.source.mc_reservoir.empty or self._reservoir_key != reservoir_key:
+            self.source.mc_reservoir = self.source.simulate(int(1e6), keep_padding=True)
+            assert not self.source.mc_reservoir.empty, \
+                "MC reservoir used in energy bounds computation is empty. Are your cuts too tight?"
+
+            # Sort by electrons produced, so we can find the reservoir events
+            # in a range of electrons_produced by bisection
+            res = self.source.mc_reservoir
+            order = np.argsort(res['electrons_produced'].values, kind='stable')
+            self._reservoir_sorted = {
+                col: res[col].values[order]
+                for col in ('electrons_produced', 'photons_produced', 'energy')}
+            self._reservoir_key = reservoir_key
+        res = self._reservoir_sorted
 
         # Same energy bounds for all events within a batch
-        for batch in range(self.source.n_batches):
-            electrons_produced_min = min(d['electrons_produced_min'][
-                batch * self.source.batch_size:(batch + 1) * self.source.batch_size])
-            electrons_produced_max = max(d['electrons_produced_max'][
-                batch * self.source.batch_size:(batch + 1) * self.source.batch_size])
+        def batch_reduce(column, ufunc):
+            return fd.batch_reduce(d[column].values, self.source.batch_size, ufunc, broadcast=False)
+
+        electrons_produced_min = batch_reduce('electrons_produced_min', np.minimum)
+        electrons_produced_max = batch_reduce('electrons_produced_max', np.maximum)
+        photons_produced_min = batch_reduce('photons_produced_min', np.minimum)
+        photons_produced_max = batch_reduce('photons_produced_max', np.maximum)
 
-            photons_produced_min = min(d['photons_produced_min'][
-                batch * self.source.batch_size:(batch + 1) * self.source.batch_size])
-            photons_produced_max = max(d['photons_produced_max'][
-                batch * self.source.batch_size:(batch + 1) * self.source.batch_size])
+        i_lows = np.searchsorted(res['electrons_produced'], electrons_produced_min, side='left')
+        i_highs = np.searchsorted(res['electrons_produced'], electrons_produced_max, side='right')
 
+        energy_min = np.zeros(self.source.n_batches)
+        energy_max = np.zeros(self.source.n_batches)
+        for batch, (i_low, i_high) in enumerate(zip(i_lows, i_highs)):
             # We filter the reservoir energies by flat-prior Bayes bounds on electrons/photons produced
-            energies = res[:, energy][(res[:, electrons_produced] >= electrons_produced_min)
-                                      & (res[:, electrons_produced] <= electrons_produced_max)
-                                      & (res[:, photons_produced] >= photons_produced_min)
-                                      & (res[:, photons_produced] <= photons_produced_max)]
+            photons_produced = res['photons_produced'][i_low:i_high]
+            energies = res['energy'][i_low:i_high][
+                (photons_produced >= photons_produced_min[batch])
+                & (photons_produced <= photons_produced_max[batch])]
 
             # We use this filtered reservoir to estimate energy bounds
-            self.source.data.loc[batch * self.source.batch_size:
-                                 (batch + 1) * self.source.batch_size - 1, 'energy_min'] = \
-                np.quantile(energies, self.source.bounds_prob)
-            self.source.data.loc[batch * self.source.batch_size:
-                                 (batch + 1) * self.source.batch_size - 1, 'energy_max'] = \
-                np.quantile(energies, 1. - self.source.bounds_prob)
+            energy_min[batch], energy_max[batch] = np.quantile(
+                energies, [self.source.bounds_prob, 1. - self.source.bounds_prob])
+
+        batch_index = np.arange(len(d)) // self.source.batch_size
+        d['energy_min'] = energy_min[batch_index]
+        d['energy_max'] = energy_max[batch_index]
+
+        if self.adaptive_energy_nodes:
+            self._annotate_energy_nodes(d)
+
+    def _settings_hash(self):
+        """Return hash of the source's defaults, model functions and
+        attributes (e.g. the spectrum), and bounds settings.
+        Functions and objects other than arrays and scalars are
+        identified by their identity, so replacing them changes the hash.
+        """
+        source = self.source
+        key = hashlib.sha1()
+
+        def add(name, x):
+            key.update(name.encode())
+            if isinstance(x, (tf.Tensor, tf.Variable, np.ndarray)):
+                x = np.asarray(fd.tf_to_np(x))
+                key.update(repr((x.dtype, x.shape)).encode())
+                key.update(np.ascontiguousarray(x).tobytes())
+            elif callable(x):
+                f = getattr(x, '__func__', x)
+                key.update(repr((getattr(f, '__module__', None),
+                                 getattr(f, '__qualname__', None),
+                                 id(f))).encode())
+            elif x is None or isinstance(
+                    x, (bool, int, float, str, tuple, pd.Timestamp)):
+                key.update(repr(x).encode())
+            else:
+                key.update(repr((type(x).__qualname__, id(x))).encode())
+
+        for pname, x in sorted(source.defaults.items()):
+            add(pname, x)
+        for fname in sorted(set(source.model_functions
+                                + source.model_attributes)):
+            add(fname, getattr(source, fname))
+        add('max_sigma', source.max_sigma)
+        add('bounds_prob_outer', source.bounds_prob_outer)
+        return key.hexdigest()
+
+    def _annotate_energy_nodes(self, d):
+        energies = fd.tf_to_np(self.energies)
+        rates = fd.tf_to_np(self.rates_vs_energy)
+        n_columns = self.source.array_columns['energy_node_index']
+        node_index = np.zeros((len(d), n_columns), dtype=int)
+        node_rate = np.zeros((len(d), n_columns))
+        for batch in range(self.source.n_batches):
+            batch_rows = slice(batch * self.source.batch_size, (batch + 1) * self.source.batch_size)
+            energy_min = d['energy_min'].values[batch_rows][0]
+            energy_max = d['energy_max'].values[batch_rows][0]
+            in_bounds = np.where((energies >= energy_min) & (energies <= energy_max))[0]
+
+            indices, node_rates = energy_quadrature_nodes(
+                energies[in_bounds], rates[in_bounds],
+                self.source.max_dim_sizes['energy'],
+                uniform_fraction=self.energy_node_uniform_fraction)
+            n_pad = n_columns - len(indices)
+            node_index[batch_rows] = np.pad(in_bounds[indices], (0, n_pad), constant_values=-1)
+            node_rate[batch_rows] = np.pad(node_rates, (0, n_pad))
+
+        self.source.set_array_column('energy_node_index', node_index)
+        self.source.set_array_column('energy_node_rate', node_rate)
 
     def draw_positions(self, n_events, **params):
         """Return dictionary with x, y, z, r, theta, drift_time
         randomly drawn.
         """
         data = dict()
-        data['r'] = (np.random.rand(n_events) * self.radius**2)**0.5
-        data['theta'] = np.random.uniform(0, 2*np.pi, size=n_events)
-        data['z'] = np.random.uniform(self.z_bottom, self.z_top,
-                                      size=n_events)
+        data['r'] = (self.source.rng.random(n_events) * self.radius**2)**0.5
+        data['theta'] = self.source.rng.uniform(0, 2*np.pi, size=n_events)
+        data['z'] = self.source.rng.uniform(self.z_bottom, self.z_top,
+                                            size=n_events)
         data['x'], data['y'] = fd.pol_to_cart(data['r'], data['theta'])
 
         data['drift_time'] = (self.z_topDrift-data['z']) / self.drift_velocity
@@ -101,7 +262,7 @@ class EnergySpectrum(fd.FirstBlock):
     def draw_time(self, n_events, **params):
         """Return n_events event_times drawn uniformaly
         between t_start and t_stop"""
-        return np.random.uniform(
+        return self.source.rng.uniform(
             self.t_start.value,
             self.t_stop.value,
             size=n_events)
@@ -121,7 +282,7 @@ class EnergySpectrum(fd.FirstBlock):
         assert len(spectrum_numpy) == len(self.energies), \
             "Energies and spectrum have different length"
 
-        data['energy'] = np.random.choice(
+        data['energy'] = self.source.rng.choice(
             fd.tf_to_np(self.energies),
             size=n_events,
             p=spectrum_numpy / spectrum_numpy.sum(),
@@ -208,6 +369,15 @@ class FixedShapeEnergySpectrum(EnergySpectrum):
     energy_spectrum_rate_multiplier = 1.
 
     def _compute(self, data_tensor, ptensor, *, energy):
+        rate_multiplier = self.gimme('energy_spectrum_rate_multiplier',
+                                     data_tensor=data_tensor, ptensor=ptensor)
+
+        if self.adaptive_energy_nodes:
+            # Node rates are the summed rates the nodes represent,
+            # so no stepping correction is needed
+            spectrum = self.source._fetch('energy_node_rate', data_tensor=data_tensor)[:, :tf.shape(energy)[1]]
+            return spectrum * rate_multiplier[:, o]
+
         # We want to do the same trimming/stepping treatment to the values of the energy
         # spectrum itself as we do its domain
         left_bound = tf.reduce_min(self.source._fetch('energy_min', data_tensor=data_tensor))
@@ -224,8 +394,6 @@ class FixedShapeEnergySpectrum(EnergySpectrum):
         spectrum = tf.repeat(spectrum_trim_step[o, :] * stepping_multiplier,
                              self.source.batch_size,
                              axis=0)
-        rate_multiplier = self.gimme('energy_spectrum_rate_multiplier',
-                                     data_tensor=data_tensor, ptensor=ptensor)
         return spectrum * rate_multiplier[:, o]
 
     def mu_before_efficiencies(self, **params):
@@ -251,6 +419,7 @@ class SpatialRateEnergySpectrum(FixedShapeEnergySpectrum):
     spatial_hist: Histdd
 
     def setup(self):
+        super().setup()
         assert isinstance(self.spatial_hist, Histdd)
 
         # Are we Cartesian, polar, or in trouble?
@@ -289,7 +458,8 @@ class SpatialRateEnergySpectrum(FixedShapeEnergySpectrum):
         drawn from the spatial rate histogram.
         """
         data = dict()
-        positions = self.spatial_hist.get_random(size=n_events)
+        positions = fd.random_from_histogram(
+            self.spatial_hist, n_events, rng=self.source.rng)
         for idx, col in enumerate(self.spatial_hist.axis_names):
             data[col] = positions[:, idx]
         if self.polar:
@@ -318,6 +488,14 @@ class VariableEnergySpectrum(EnergySpectrum):
 
     model_functions = ('energy_spectrum',)
 
+    def setup(self):
+        if self.adaptive_energy_nodes:
+            # Nodes are chosen from a single spectrum per batch
+            raise ValueError(
+                "adaptive_energy_nodes is only supported for fixed-shape "
+                "energy spectra")
+        super().setup()
+
     def energy_spectrum(self, event_time):
         # Note this returns a 2d tensor!
         return tf.ones(len(event_time), len(self.energies),
@@ -363,6 +541,7 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
     array_columns = (('energy_spectrum', len(energy_edges) - 1),)
 
     def setup(self):
+        super().setup()
         wimp_kwargs = dict(mw=self.mw,
                            sigma_nucleon=self.sigma_nucleon,
                            energy_edges=self.energy_edges)
@@ -437,10 +616,9 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
             # Time is fixed, so the energy spectrum differs.
             # (if energy is also fixed, it will just be overridden later
             #  and we're doing a bit of unnecessary work here)
-            data['energy'] = \
-                self.energy_hist \
-                    .slicesum(t, axis=0) \
-                    .get_random(n_events)
+            data['energy'] = fd.random_from_histogram(
+                self.energy_hist.slicesum(t, axis=0),
+                n_events, rng=self.source.rng)
             times = t
 
         elif 'energy' in fix_truth:
@@ -448,13 +626,13 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
             e_edges = self.energy_hist.bin_edges[1]
             assert e_edges[0] <= fix_truth['energy'] < e_edges[-1], \
                 "fix_truth energy out of bounds"
-            times = \
-                self.energy_hist \
-                    .slicesum(fix_truth['energy'], axis=1) \
-                    .get_random(n_events)
+            times = fd.random_from_histogram(
+                self.energy_hist.slicesum(fix_truth['energy'], axis=1),
+                n_events, rng=self.source.rng)
 
         else:
-            times, data['energy'] = self.energy_hist.get_random(n_events).T
+            times, data['energy'] = fd.random_from_histogram(
+                self.energy_hist, n_events, rng=self.source.rng).T
 
         data['event_time'] = fd.j2000_to_event_time(times)
 
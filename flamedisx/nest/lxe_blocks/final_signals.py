@@ -1,7 +1,6 @@
 import typing as ty
 
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -28,16 +27,18 @@ class MakeFinalSignals(fd.Block):
     signal_name: str
 
     def _simulate(self, d):
-        d[self.signal_name] = stats.norm.rvs(
-            loc=(self.gimme_numpy(self.signal_name + '_spe_mean',
-                 d[self.signal_name + '_photoelectrons_detected'].values)),
-            scale=(self.gimme_numpy(self.signal_name + '_spe_smearing',
-                   d[self.signal_name + '_photoelectrons_detected'].values)))
+        photoelectrons_detected = (
+            d[self.signal_name + '_photoelectrons_detected'])
+        d[self.signal_name] = self.source.rng.normal(
+            loc=self.gimme_numpy(self.signal_name + '_spe_mean',
+                                 photoelectrons_detected),
+            scale=self.gimme_numpy(self.signal_name + '_spe_smearing',
+                                   photoelectrons_detected))
 
         # Call add_extra_columns now, since s1 and s2 are known and derived
         # observables from it (cs1, cs2) might be used in the acceptance.
         # TODO: This is a bit of a kludge
-        self.source.add_extra_columns(d)
+        self.source._call_with_columns(self.source.add_extra_columns, d)
         d['p_accepted'] *= self.gimme_numpy(self.signal_name + '_acceptance')
 
     def _annotate(self, d):
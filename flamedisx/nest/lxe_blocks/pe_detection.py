@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -33,11 +32,12 @@ class DetectS1Photoelectrons(fd.Block):
         return result
 
     def _simulate(self, d):
-        d['s1_photoelectrons_detected'] = stats.binom.rvs(
-            n=d['s1_photoelectrons_produced'],
+        photoelectrons_produced = d['s1_photoelectrons_produced']
+        d['s1_photoelectrons_detected'] = self.source.rng.binomial(
+            n=photoelectrons_produced,
             p=self.gimme_numpy(
                 'photoelectron_detection_eff',
-                d['s1_photoelectrons_produced']))
+                photoelectrons_produced))
 
     def _annotate(self, d):
         for suffix, bound in (('_min', 'lower'),
@@ -2,14 +2,34 @@ import numpy as np
 from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
-import pandas as pd
-import operator
 
 import flamedisx as fd
 export, __all__ = fd.exporter()
 o = tf.newaxis
 
 
+@export
+def uniform_step_indices(n, n_steps, width):
+    """Return (len(n), width) integer array whose rows are
+    np.round(np.linspace(0, n - 1, n_steps)), padded with zeros.
+
+    :param n: array of the lengths to step through
+    :param n_steps: array of the numbers of steps, at most width
+    :param width: width of the output
+    """
+    n = np.asarray(n)[:, None]
+    n_steps = np.asarray(n_steps)[:, None]
+    k = np.arange(width)[None, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        index_step = np.where(
+            n_steps == 1,
+            0,
+            np.where(k == n_steps - 1,
+                     n - 1,
+                     np.round(k * ((n - 1) / (n_steps - 1)))))
+    return np.where(k < n_steps, index_step, 0).astype(int)
+
+
 @export
 class MakePhotonsElectronsNR(fd.Block):
     is_ER = False
@@ -20,6 +40,17 @@ class MakePhotonsElectronsNR(fd.Block):
 
     max_dim_size = {'ions_produced': 30}
 
+    #: If not None, evaluate Owen's T function in the skew Gaussian CDF by
+    #: quadrature with this many nodes, rather than by a truncated series.
+    #: The series is inaccurate for |skewness| > 1.
+    owens_t_nodes = None
+
+    #: If not None, sum over energies in chunks of this many energies,
+    #: to bound the memory used by the per-energy 4-D tensors.
+    energy_chunk_size = None
+
+    model_attributes = ('owens_t_nodes', 'energy_chunk_size')
+
     exclude_data_tensor = ('ions_produced_max',)
 
     special_model_functions = ('mean_yields', 'yield_fano', 'recomb_prob', 'skewness',
@@ -132,12 +163,14 @@ class MakePhotonsElectronsNR(fd.Block):
             if approx:
                 p_nel = fd.tfp_files.SkewGaussian(loc=mean, scale=std_dev,
                                                   skewness=skew,
-                                                  owens_t_terms=owens_t_terms).prob(electrons_produced)
+                                                  owens_t_terms=owens_t_terms,
+                                                  owens_t_nodes=self.owens_t_nodes).prob(electrons_produced)
             else:
                 p_nel = fd.tfp_files.TruncatedSkewGaussianCC(loc=mean, scale=std_dev,
                                                              skewness=skew,
                                                              limit=_ions_produced,
-                                                             owens_t_terms=owens_t_terms).prob(electrons_produced)
+                                                             owens_t_terms=owens_t_terms,
+                                                             owens_t_nodes=self.owens_t_nodes).prob(electrons_produced)
 
             p_mult = p_nq * p_ni * p_nel
 
@@ -193,41 +226,74 @@ class MakePhotonsElectronsNR(fd.Block):
 
         # Sum the block result per energy over energies, separately for the
         # energies below the cutoff and the energies above the cutoff
-        result_full = tf.reduce_sum(tf.vectorized_map(compute_single_energy_full,
-                                                      elems=[energy_full,
-                                                             rate_vs_energy_full,
-                                                             tf.transpose(ion_bounds_min_full)]),
-                                    0)
-        result_approx = tf.reduce_sum(tf.vectorized_map(compute_single_energy_approx,
-                                                        elems=[energy_approx,
-                                                               rate_vs_energy_approx,
-                                                               tf.transpose(ion_bounds_min_approx)]),
-                                      0)
+        result_full = self._sum_over_energies(compute_single_energy_full,
+                                              [energy_full,
+                                               rate_vs_energy_full,
+                                               tf.transpose(ion_bounds_min_full)],
+                                              electrons_produced)
+        result_approx = self._sum_over_energies(compute_single_energy_approx,
+                                                [energy_approx,
+                                                 rate_vs_energy_approx,
+                                                 tf.transpose(ion_bounds_min_approx)],
+                                                electrons_produced)
 
         return (result_full + result_approx)
 
+    def _sum_over_energies(self, compute_single_energy, elems, electrons_produced):
+        """Return sum of compute_single_energy over the energies in elems
+
+        :param elems: [energies, rates, ion lower bounds], each with
+            energies along the first axis. Padding rates must be zero.
+        :param electrons_produced: domain tensor, used for the result shape
+        """
+        if self.energy_chunk_size is None:
+            return tf.reduce_sum(tf.vectorized_map(compute_single_energy, elems=elems), 0)
+
+        # Pad to a whole number of chunks. Padding energies repeat the last
+        # energy (so nothing is evaluated outside the spectrum), with zero rate.
+        chunk_size = self.energy_chunk_size
+        n_energies = tf.shape(elems[0])[0]
+        n_chunks = (n_energies + chunk_size - 1) // chunk_size
+        n_pad = n_chunks * chunk_size - n_energies
+        energies, rates, ions_min = elems
+        energies = tf.concat([energies, tf.repeat(energies[-1:], n_pad, axis=0)], 0)
+        rates = tf.concat([rates, tf.zeros([n_pad], dtype=rates.dtype)], 0)
+        ions_min = tf.concat([ions_min, tf.repeat(ions_min[-1:], n_pad, axis=0)], 0)
+
+        def add_chunk(result, chunk):
+            return result + tf.reduce_sum(
+                tf.vectorized_map(compute_single_energy, elems=list(chunk)), 0)
+
+        # parallel_iterations=1, or chunks could be evaluated concurrently
+        return tf.foldl(
+            add_chunk,
+            elems=(tf.reshape(energies, [n_chunks, chunk_size]),
+                   tf.reshape(rates, [n_chunks, chunk_size]),
+                   tf.reshape(ions_min, [n_chunks, chunk_size, -1])),
+            initializer=tf.zeros_like(electrons_produced[:, :, :, 0]),
+            parallel_iterations=1)
+
     def _simulate(self, d):
-        # If you forget the .values here, you may get a Python core dump...
         if self.is_ER:
-            nel = self.gimme_numpy('mean_yield_electron', d['energy'].values)
-            nq = self.gimme_numpy('mean_yield_quanta', (d['energy'].values, nel))
+            nel = self.gimme_numpy('mean_yield_electron', d['energy'])
+            nq = self.gimme_numpy('mean_yield_quanta', (d['energy'], nel))
             fano = self.gimme_numpy('fano_factor', nq)
 
-            nq_actual_temp = np.round(stats.norm.rvs(nq, np.sqrt(fano*nq))).astype(int)
+            nq_actual_temp = np.round(self.source.rng.normal(nq, np.sqrt(fano*nq))).astype(int)
             # Don't let number of quanta go negative
             nq_actual = np.where(nq_actual_temp < 0,
                                  nq_actual_temp * 0,
                                  nq_actual_temp)
 
-            ex_ratio = self.gimme_numpy('exciton_ratio', d['energy'].values)
+            ex_ratio = self.gimme_numpy('exciton_ratio', d['energy'])
             alpha = 1. / (1. + ex_ratio)
 
-            d['ions_produced'] = stats.binom.rvs(n=nq_actual, p=alpha)
+            d['ions_produced'] = self.source.rng.binomial(n=nq_actual, p=alpha)
 
             nex = nq_actual - d['ions_produced']
 
         else:
-            yields = self.gimme_numpy('mean_yields', d['energy'].values)
+            yields = self.gimme_numpy('mean_yields', d['energy'])
             nel = yields[0]
             nq = yields[1]
             ex_ratio = yields[2]
@@ -237,13 +303,14 @@ class MakePhotonsElectronsNR(fd.Block):
             ni_fano = yield_fano[0]
             nex_fano = yield_fano[1]
 
-            ni_temp = np.round(stats.norm.rvs(nq*alpha, np.sqrt(nq*alpha*ni_fano))).astype(int)
+            ni_temp = np.round(self.source.rng.normal(nq*alpha, np.sqrt(nq*alpha*ni_fano))).astype(int)
             # Don't let number of ions go negative
             d['ions_produced'] = np.where(ni_temp < 0,
                                           ni_temp * 0,
                                           ni_temp)
 
-            nex_temp = np.round(stats.norm.rvs(nq*alpha*ex_ratio, np.sqrt(nq*alpha*ex_ratio*nex_fano))).astype(int)
+            nex_temp = np.round(self.source.rng.normal(
+                nq*alpha*ex_ratio, np.sqrt(nq*alpha*ex_ratio*nex_fano))).astype(int)
             # Don't let number of excitons go negative
             nex = np.where(nex_temp < 0,
                            nex_temp * 0,
@@ -253,12 +320,13 @@ class MakePhotonsElectronsNR(fd.Block):
 
         recomb_p = self.gimme_numpy('recomb_prob', (nel, nq, ex_ratio))
         skew = self.gimme_numpy('skewness', nq)
-        var = self.gimme_numpy('variance', (nel, nq, recomb_p, d['ions_produced'].values))
+        var = self.gimme_numpy('variance', (nel, nq, recomb_p, d['ions_produced']))
         width_corr = self.gimme_numpy('width_correction', skew)
         mu_corr = self.gimme_numpy('mu_correction', (skew, var, width_corr))
 
         el_prod_temp1 = np.round(stats.skewnorm.rvs(skew, (1 - recomb_p) * d['ions_produced'] - mu_corr,
-                                 np.sqrt(var) / width_corr)).astype(int)
+                                 np.sqrt(var) / width_corr,
+                                 random_state=self.source.rng)).astype(int)
         # Don't let number of electrons go negative
         el_prod_temp2 = np.where(el_prod_temp1 < 0,
                                  el_prod_temp1 * 0,
@@ -316,77 +384,67 @@ class MakePhotonsElectronsNR(fd.Block):
             return (ions_produced_min, ions_produced_max)
 
         # Compute ion bounds for every energy in the full spectrum, once
+        energies = self.source.energies.numpy()
         if self.is_ER:
-            bounds = [get_bounds_ER(energy) for energy in self.source.energies.numpy()]
+            ions_produced_min_full, ions_produced_max_full = get_bounds_ER(energies)
         else:
-            bounds = [get_bounds_NR(energy) for energy in self.source.energies.numpy()]
-
-        ions_produced_min_full = [x[0] for x in bounds]
-        ions_produced_max_full = [x[1] for x in bounds]
-
-        for batch in range(self.source.n_batches):
-            d_batch = d[batch * self.source.batch_size:(batch + 1) * self.source.batch_size]
-
-            # These are the same across all events in a batch
-            energy_min = d_batch['energy_min'].iloc[0]
-            energy_max = d_batch['energy_max'].iloc[0]
-
-            energies_trim = self.source.energies.numpy()[(self.source.energies.numpy() >= energy_min) &
-                                                         (self.source.energies.numpy() <= energy_max)]
-
-            # Keep only the ion bounds corresponding to the energies in the trimmed
-            # spectrum for this batch
-            ions_produced_min_full_trim = np.asarray(ions_produced_min_full)[
-                (self.source.energies.numpy() >= energy_min) &
-                (self.source.energies.numpy() <= energy_max)]
-            ions_produced_max_full_trim = np.asarray(ions_produced_max_full)[
-                (self.source.energies.numpy() >= energy_min) &
-                (self.source.energies.numpy() <= energy_max)]
-
-            index_step = np.round(np.linspace(0, len(energies_trim) - 1,
-                                              min(len(energies_trim), self.source.max_dim_sizes['energy']))).astype(int)
-
-            # Keep only the ion bounds corresponding to the energies in the stepped + trimmed
-            # spectrum for this batch
-            ions_produced_min = list(np.take(ions_produced_min_full_trim, index_step))
-            ions_produced_max = list(np.take(ions_produced_max_full_trim, index_step))
-
-            # For the events in the dataframe that are part of this batch, save the ion bounds at each energy
-            # in the dataframe
-            indicies = np.arange(batch * self.source.batch_size, (batch + 1) * self.source.batch_size)
-            d.loc[batch * self.source.batch_size:(batch + 1) * self.source.batch_size - 1, 'ions_produced_min'] = \
-                pd.Series([ions_produced_min]*len(indicies), index=indicies)
-            d.loc[batch * self.source.batch_size:(batch + 1) * self.source.batch_size - 1, 'ions_produced_max'] = \
-                pd.Series([ions_produced_max]*len(indicies), index=indicies)
+            ions_produced_min_full, ions_produced_max_full = get_bounds_NR(energies)
 
         # If mono-energetic, one zero element at the end to get tensor dimensions
         # that match up with non-mono-energetic case; will be discarded later on
-        max_num_energies = max(min(len(self.source.energies), self.source.max_dim_sizes['energy']), 2)
+        max_num_energies = max(min(len(energies), self.source.max_dim_sizes['energy']), 2)
+
+        # Indices in energies of the energies we sum over for each batch (n_batches, max_num_energies),
+        # -1 for padding. The energy bounds are the same across all events in a batch.
+        batch_starts = np.arange(self.source.n_batches) * self.source.batch_size
+        if self.source.adaptive_energy_nodes:
+            # The energy spectrum block chose the energies for each batch
+            energy_index = self.source.array_data['energy_node_index'][batch_starts].astype(int)
+        else:
+            energy_min = d['energy_min'].values[batch_starts]
+            energy_max = d['energy_max'].values[batch_starts]
+            in_bounds = ((energies[None, :] >= energy_min[:, None])
+                         & (energies[None, :] <= energy_max[:, None]))
+            n_trim = in_bounds.sum(axis=1)
+            # Indices of the trimmed spectrum first, in order
+            trim_index = np.argsort(~in_bounds, axis=1, kind='stable')
+
+            # Step uniformly through the trimmed spectrum
+            n_steps = np.minimum(n_trim, self.source.max_dim_sizes['energy'])
+            index_step = uniform_step_indices(n_trim, n_steps, max_num_energies)
+            k = np.arange(max_num_energies)[None, :]
+            energy_index = np.where(k < n_steps[:, None],
+                                    np.take_along_axis(trim_index, index_step, axis=1),
+                                    -1)
+
         # Pad with 0s at the end to make each one the same size
-        [bounds.extend([0]*(max_num_energies - len(bounds))) for bounds in d['ions_produced_min'].values]
+        ions_produced_min = np.where(energy_index >= 0, ions_produced_min_full[energy_index], 0)
+        ions_produced_max = np.where(energy_index >= 0, ions_produced_max_full[energy_index], 0)
+
+        # For the events in the dataframe, save the ion bounds at each energy of their batch
+        batch_index = np.arange(len(d)) // self.source.batch_size
+        self.source.set_array_column('ions_produced_min', ions_produced_min[batch_index])
+        self.source.set_array_column('ions_produced_max', ions_produced_max[batch_index])
 
         return True
 
     def _calculate_dimsizes_special(self):
         d = self.source.data
 
-        ions_produced_max = d['ions_produced_max'].to_numpy()
-        ions_produced_min = d['ions_produced_min'].to_numpy()
+        ions_produced_max = self.source.array_data['ions_produced_max']
+        ions_produced_min = self.source.array_data['ions_produced_min']
 
         # Take the dimsize for ions_produced to be the largest dimsize across the energy range
-        dimsizes = [max([elem + 1 for elem in list(map(operator.sub, maxs, mins))])
-                    for maxs, mins in zip(ions_produced_max, ions_produced_min)]
+        # (padding gives 1, the smallest possible dimsize)
+        dimsizes = np.max(ions_produced_max - ions_produced_min + 1, axis=1)
         # Cap the dimsize if we are above the max_dim_size
-        self.source.dimsizes['ions_produced'] = \
-            self.source.max_dim_sizes['ions_produced'] * \
-            np.greater(dimsizes, self.source.max_dim_sizes['ions_produced']) + \
-            dimsizes * np.less_equal(dimsizes, self.source.max_dim_sizes['ions_produced'])
+        self.source.dimsizes['ions_produced'] = np.minimum(dimsizes, self.source.max_dim_sizes['ions_produced'])
 
         # Calculate the stepping across the domain
-        d['ions_produced_steps'] = tf.where(dimsizes > self.source.dimsizes['ions_produced'],
-                                            tf.math.ceil(([elem-1 for elem in dimsizes]) /
-                                            (self.source.dimsizes['ions_produced']-1)),
-                                            1).numpy()
+        d['ions_produced_steps'] = np.where(dimsizes > self.source.dimsizes['ions_produced'],
+                                            np.ceil((dimsizes - 1) /
+                                                    (self.source.dimsizes['ions_produced'] - 1)),
+                                            1)
 
     def _domain_dict_bonus(self, d):
         electrons_domain = self.source.domain('electrons_produced', d)
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -37,10 +36,11 @@ class MakeS2Photons(fd.Block):
         return result
 
     def _simulate(self, d):
-        d['s2_photons_produced'] = np.round(stats.norm.rvs(
-            loc=(d['electrons_detected']
+        electrons_detected = d['electrons_detected']
+        d['s2_photons_produced'] = np.round(self.source.rng.normal(
+            loc=(electrons_detected
                  * self.gimme_numpy('electron_gain_mean')),
-            scale=(d['electrons_detected']**0.5
+            scale=(electrons_detected**0.5
                    * self.gimme_numpy('electron_gain_std')))).astype(int)
 
     def _annotate(self, d):
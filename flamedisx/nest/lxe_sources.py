@@ -324,6 +324,18 @@ class nestERSource(nestSource):
         return recomb_p * (1. - recomb_p) * ni + omega * omega * ni * ni
 
 
+@export
+class nestTabulatedERSource(nestERSource):
+    """nestERSource that looks up mean_yield_electron in a table during
+    differential rate computations, rather than evaluating it exactly.
+    See fd.tabulated.
+    """
+
+    @fd.tabulated(0.01, 1000., n_points=100000)
+    def mean_yield_electron(self, energy):
+        return super().mean_yield_electron(energy)
+
+
 @export
 class nestNRSource(nestSource):
     def __init__(self, *args, energy_min=0.01, energy_max=150., num_energies=1000, **kwargs):
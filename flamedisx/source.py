@@ -1,5 +1,6 @@
 from copy import copy
 from contextlib import contextmanager
+import functools
 import inspect
 import typing as ty
 import warnings
@@ -7,6 +8,7 @@ import warnings
 import numpy as np
 import pandas as pd
 import tensorflow as tf
+import tensorflow_probability as tfp
 from scipy import stats
 
 from tqdm import tqdm
@@ -17,11 +19,48 @@ export, __all__ = fd.exporter()
 o = tf.newaxis
 
 
+@export
+def tabulated(x_min, x_max, n_points=1000, rtol=1e-3):
+    """Decorator for special model functions to be replaced by a lookup
+    table in the differential rate computation.
+
+    The source evaluates the function at n_points points of its bonus
+    argument between x_min and x_max, then linearly interpolates between
+    these. Outside [x_min, x_max], the value at the nearest edge is used.
+    Parameters of the function with tabulation_anchors (see Source)
+    get an extra axis in the table, and are interpolated between the
+    anchors. Other parameters are fixed at their defaults; the table is
+    rebuilt when set_defaults changes them. If one of these is fitted,
+    the function is evaluated exactly instead.
+
+    Use this for expensive functions that are smooth in their bonus
+    argument. The function may not depend on other observables.
+    Simulation and annotation always use the exact function.
+
+    :param rtol: Warn if, halfway between the grid points, the table
+        deviates from the exact function by more than rtol times the
+        maximum absolute value of the function.
+    """
+    def decorator(f):
+        f.tabulation = dict(x_min=x_min, x_max=x_max,
+                            n_points=n_points, rtol=rtol)
+        return f
+    return decorator
+
+
+def _defined_in_flamedisx(f):
+    """Return whether function or method f is defined in flamedisx"""
+    return getattr(f, '__module__', '').split('.')[0] == 'flamedisx'
+
+
 @export
 class Source:
     #: Number of event batches to use in differential rate computations
     n_batches = None
 
+    #: Number of events in the data, excluding padding
+    n_events = None
+
     #: Number of fake events that were padded to the final batch
     #: to make it match the batch size
     n_padding = None
@@ -72,6 +111,10 @@ class Source:
     #: Names of array-valued data columns
     array_columns: ty.Tuple[str] = tuple()
 
+    #: Values of array-valued data columns, as 2d arrays aligned with
+    #: self.data. Set them with set_array_column.
+    array_data: ty.Dict[str, np.ndarray]
+
     #: Any additional source attributes that should be configurable.
     model_attributes = tuple()
 
@@ -90,6 +133,27 @@ class Source:
     #: The fully annotated event data
     data: pd.DataFrame = None
 
+    #: Random generator to draw simulated events from (see simulate),
+    #: None to derive one from numpy's global random state when needed.
+    _rng = None
+
+    #: If not None, gimme adds the names of the model functions
+    #: it evaluates to this set
+    _gimme_calls: ty.Optional[ty.Set[str]] = None
+
+    @property
+    def rng(self):
+        """Random generator to draw simulated events from, see simulate.
+        Simulation code should use this rather than np.random.
+        """
+        if self._rng is None:
+            return fd.random_generator()
+        return self._rng
+
+    @rng.setter
+    def rng(self, value):
+        self._rng = value
+
     ##
     # Initialization and helpers
     ##
@@ -199,6 +263,7 @@ class Source:
                  _skip_tf_init=False,
                  _skip_bounds_computation=False,
                  fit_params=None,
+                 tabulation_anchors=None,
                  progress=False,
                  **params):
         """Initialize a flamedisx source
@@ -213,8 +278,11 @@ class Source:
         :param _skip_tf_init: If True, skip tensorflow cache initialization
         :param _skip_bounds_computation: If True, skip bounds compuation
         :param fit_params: List of parameters to fit
-        :param progress: whether to show progress bars for mu estimation
-            (if data is not None)
+        :param tabulation_anchors: Dictionary parameter name -> increasing
+            sequence of values at which to tabulate the fd.tabulated model
+            functions that take the parameter. Between these anchors,
+            the tables are interpolated linearly.
+        :param progress: Not used, kept for backwards compatibility
         :param params: New defaults to for parameters, and new values for
         constant-valued model functions.
         """
@@ -283,8 +351,8 @@ class Source:
         # A source may choose to fill these in for improved bounds computation.
         # See bounds.py for details
         self.mc_reservoir = pd.DataFrame()
-        self.prior_PDFs_LB = tuple(dict())
-        self.prior_PDFs_UB = tuple(dict())
+        self.prior_PDFs_LB = dict()
+        self.prior_PDFs_UB = dict()
 
         self.set_defaults(**params)
 
@@ -299,14 +367,34 @@ class Source:
             self.parameter_index[param_name]
             for param_name in self.fit_params])
 
+        if tabulation_anchors is None:
+            tabulation_anchors = dict()
+        #: Dictionary parameter name -> array of parameter values
+        #: at which fd.tabulated model functions are tabulated
+        self.tabulation_anchors = {
+            pname: np.asarray(values, dtype=float)
+            for pname, values in tabulation_anchors.items()
+            if pname in self.defaults}
+        for pname, values in self.tabulation_anchors.items():
+            if len(values) < 2 or np.any(np.diff(values) <= 0):
+                raise ValueError(
+                    f"Need at least two increasing anchors of {pname}")
+
+        # Lookup tables of fd.tabulated model functions
+        # fname -> list of tf.Variable, one per output of the function
+        self._tables = dict()
+        # fname -> defaults of the parameters the table was made for
+        self._table_keys = dict()
+        self._tabulate_model_functions()
+
         if data is None:
             # We're calling the source without data. Set the batch_size here
             # since we can't pass it to set_data later
             self.batch_size = batch_size
+            self.array_data = dict()
         else:
             self.batch_size = min(batch_size, len(data))
             self.set_data(data,
-                          progress=progress,
                           data_is_annotated=data_is_annotated,
                           _skip_tf_init=_skip_tf_init,
                           _skip_bounds_computation=_skip_bounds_computation)
@@ -314,6 +402,21 @@ class Source:
         if not _skip_tf_init:
             self.trace_differential_rate()
 
+    def __getstate__(self):
+        # Traced tensorflow functions cannot be pickled,
+        # trace again after unpickling instead.
+        state = self.__dict__.copy()
+        if '_differential_rate_tf' in state:
+            state['_differential_rate_tf'] = None
+            state['_log_differential_rate_tf'] = None
+            state['_differential_rate_vjp_tf'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_differential_rate_tf' in state:
+            self.trace_differential_rate()
+
     def set_defaults(self, *, config=None, **params):
         # Load new params from configuration files
         params = {**fd.load_config(config), **params}
@@ -342,6 +445,114 @@ class Source:
         if unused:
             warnings.warn(f"Defaults for unused settings ignored: {unused}")
 
+        if params and hasattr(self, '_tables'):
+            # Changed defaults are noticed by _tabulate_model_functions,
+            # other settings could affect any function
+            self._tabulate_model_functions(
+                force=any([k not in self.defaults for k in params]))
+
+    def _tabulate_model_functions(self, force=False):
+        """(Re)build lookup tables for the model functions marked with
+        fd.tabulated. Tables are only rebuilt if the defaults of the
+        function's parameters without tabulation anchors changed,
+        or if force is True.
+        """
+        for fname in self.special_model_functions:
+            f = getattr(self, fname)
+            if not callable(f) or not hasattr(f, 'tabulation'):
+                continue
+            if self.f_dims[fname]:
+                raise ValueError(
+                    f"Cannot tabulate {fname}, it depends on observables "
+                    f"{self.f_dims[fname]} besides its first argument")
+            anchored, fixed = self._tabulated_params(fname)
+            if any([p in self.fit_params for p in fixed]):
+                # The table would have to change during the fit
+                continue
+            key = tuple([float(self.defaults[p]) for p in fixed])
+            if not force and self._table_keys.get(fname) == key:
+                continue
+            self._table_keys[fname] = key
+
+            spec = f.tabulation
+            x = tf.cast(
+                tf.linspace(spec['x_min'], spec['x_max'], spec['n_points']),
+                dtype=fd.float_type())
+            # Check the accuracy halfway between the grid points,
+            # where linear interpolation is worst
+            x_mid = (x[1:] + x[:-1]) / 2
+
+            # Evaluate the function at each point of the anchor grid
+            grid_shape = tuple([len(self.tabulation_anchors[p])
+                                for p in anchored])
+            ys = []
+            max_dev = 0.
+            for grid_index in np.ndindex(*grid_shape):
+                kwargs = {p: self.defaults[p] for p in fixed}
+                for p, i in zip(anchored, grid_index):
+                    kwargs[p] = fd.np_to_tf(self.tabulation_anchors[p][i])
+                y, y_mid = [
+                    [fd.tf_to_np(fd.np_to_tf(y_)) for y_ in
+                     (res if isinstance(res, (list, tuple)) else [res])]
+                    for res in (f(x, **kwargs), f(x_mid, **kwargs))]
+                for y_exact, y_mid_exact in zip(y, y_mid):
+                    dev = np.max(np.abs(
+                        (y_exact[1:] + y_exact[:-1]) / 2 - y_mid_exact))
+                    max_dev = max(max_dev, dev / np.max(np.abs(y_exact)))
+                ys.append(y)
+            if max_dev > spec['rtol']:
+                warnings.warn(
+                    f"Lookup table for {fname} deviates up to {max_dev} "
+                    f"(relative to the function's maximum) from the exact "
+                    f"function, consider a finer grid.")
+
+            # One table per output of the function,
+            # with axes (anchors of each parameter..., x)
+            tables = [
+                np.stack([y[i] for y in ys]).reshape(grid_shape + (-1,))
+                for i in range(len(ys[0]))]
+            if fname in self._tables:
+                for var, table in zip(self._tables[fname], tables):
+                    var.assign(table)
+            else:
+                self._tables[fname] = [
+                    tf.Variable(table, trainable=False, dtype=fd.float_type())
+                    for table in tables]
+
+    def _tabulated_params(self, fname):
+        """Return lists of parameters of the tabulated function fname
+        with and without tabulation anchors"""
+        anchored = [p for p in self.f_params[fname]
+                    if p in self.tabulation_anchors]
+        fixed = [p for p in self.f_params[fname]
+                 if p not in self.tabulation_anchors]
+        return anchored, fixed
+
+    def _lookup_table(self, fname, x, ptensor=None):
+        """Return interpolated values of the model function fname
+        from its lookup table, see fd.tabulated"""
+        spec = getattr(self, fname).tabulation
+        anchored, _ = self._tabulated_params(fname)
+        result = []
+        for table in self._tables[fname]:
+            # Interpolate linearly between the parameter anchors,
+            # as in TemplateSource._morph
+            for pname in anchored:
+                i_left, frac = fd.interpolation_bracket(
+                    fd.np_to_tf(self.tabulation_anchors[pname]),
+                    tf.reshape(self._fetch_param(pname, ptensor), [1]))
+                table = ((1 - frac[0]) * tf.gather(table, i_left[0])
+                         + frac[0] * tf.gather(table, i_left[0] + 1))
+            result.append(tfp.math.interp_regular_1d_grid(
+                x=x,
+                x_ref_min=tf.constant(spec['x_min'], dtype=fd.float_type()),
+                x_ref_max=tf.constant(spec['x_max'], dtype=fd.float_type()),
+                y_ref=table,
+                fill_value='constant_extension'))
+        if len(result) == 1:
+            return result[0]
+        return tuple(result)
+
     def set_data(self,
                  data=None,
                  data_is_annotated=False,
@@ -350,6 +561,7 @@ class Source:
                  **params):
         self.set_defaults(**params)
 
+        self.array_data = dict()
         if data is None:
             self.data = self.n_batches = self.n_padding = None
             return
@@ -373,7 +585,15 @@ class Source:
                 df_pad = self.data.iloc[np.zeros(self.n_padding)]
                 self.data = pd.concat([self.data, df_pad], ignore_index=True)
             self.data = self.data.reset_index(drop=True)
-        if not data_is_annotated:
+        if data_is_annotated:
+            # Array columns may come as object columns, see annotate_data
+            array_columns = [column for column in self.array_columns
+                             if column in self.data.columns]
+            if array_columns:
+                for column in array_columns:
+                    self.set_array_column(column, np.stack(self.data[column].values))
+                self.data = self.data.drop(columns=array_columns)
+        else:
             self.add_extra_columns(self.data)
             if not _skip_bounds_computation:
                 self._annotate()
@@ -389,6 +609,7 @@ class Source:
         """
         for column in self.column_index:
             if (column not in self.data.columns
+                    and column not in self.array_data
                     and column not in self.frozen_model_functions):
                 raise ValueError(f"Data lacks required column {column}; "
                                  f"did annotation happen correctly?")
@@ -426,6 +647,20 @@ class Source:
         result = tf.concat(result, axis=1)
         self.data_tensor = tf.reshape(result, shape)
 
+    def set_array_column(self, column, values):
+        """Store values of the array-valued column for all events in self.data
+
+        :param column: name of the column, one of array_columns
+        :param values: array of shape (len(self.data), width). Rows shorter
+            than the column width must be padded.
+        """
+        values = np.asarray(values)
+        if values.ndim != 2 or len(values) != len(self.data):
+            raise ValueError(
+                f"Array column {column} should have shape "
+                f"({len(self.data)}, width), not {values.shape}")
+        self.array_data[column] = values
+
     def cap_dimsizes(self, dim, cap):
         if dim in self.no_step_dimensions:
             pass
@@ -486,23 +721,83 @@ class Source:
             else:
                 if keep_padding:
                     old_data = self.data
+                    old_array_data = self.array_data
                 else:
                     old_data = self.data[:self.n_events]  # Remove padding
+                    old_array_data = {k: v[:self.n_events]
+                                      for k, v in self.array_data.items()}
             self.set_data(data, **kwargs, _skip_tf_init=True)
         try:
             yield
         finally:
             self.defaults = old_defaults
+            if kwargs:
+                self._tabulate_model_functions()
             if old_data is not None:
                 self.set_data(
                     old_data,
                     data_is_annotated=True,
                     _skip_tf_init=True)
+                self.array_data = old_array_data
+
+    @contextmanager
+    def _set_columns_temporarily(self, columns, n_events, **params):
+        """Set data to a dictionary of numpy columns, and defaults to
+        params, temporarily, without affecting the data tensor state.
+        Used in simulation: unlike _set_temporarily, this does not annotate,
+        pad or copy the data, it only adds extra columns.
+
+        :param columns: dictionary column name -> numpy array
+        :param n_events: number of events (length of the arrays)
+        """
+        old_state = (self.data, self.array_data,
+                     self.n_events, self.n_padding)
+        old_defaults = copy(self.defaults)
+        if params:
+            self.set_defaults(**params)
+        self.data, self.array_data = columns, dict()
+        self.n_events = n_events
+        self.n_padding = 0
+        try:
+            self._call_with_columns(self.add_extra_columns, columns)
+            yield
+        finally:
+            (self.data, self.array_data,
+             self.n_events, self.n_padding) = old_state
+            if params:
+                self.defaults = old_defaults
+                self._tabulate_model_functions()
+
+    def _call_with_columns(self, f, columns):
+        """Call f with columns, a dictionary of numpy columns (self.data
+        during simulation), to change them in place.
+
+        Functions defined outside flamedisx may have been written for
+        DataFrames (e.g. using .values or .loc); they are called with a
+        DataFrame of the columns instead, which is also self.data meanwhile.
+        Its columns are then copied back into the dictionary.
+        """
+        if isinstance(columns, pd.DataFrame) or _defined_in_flamedisx(f):
+            return f(columns)
+        df = pd.DataFrame(columns, copy=False)
+        old_data = self.data
+        if old_data is columns:
+            self.data = df
+        try:
+            result = f(df)
+        finally:
+            self.data = old_data
+        columns.update({k: df[k].to_numpy() for k in df.columns})
+        return result
 
     def annotate_data(self, data, **params):
-        """Add columns to data with inference information"""
+        """Add columns to data with inference information.
+        Array columns are returned as columns of arrays.
+        """
         with self._set_temporarily(data, **params):
             self._annotate()
+            for column, values in self.array_data.items():
+                self.data[column] = list(values)
             return self.data
 
     ##
@@ -516,7 +811,10 @@ class Source:
         """
         if data_tensor is None:
             # We're inside annotate, just return the column
-            x = self.data[x].values
+            if x in self.array_data:
+                return fd.np_to_tf(self.array_data[x])
+            # self.data is a dictionary of numpy columns during simulation
+            x = np.asarray(self.data[x])
             if x.dtype == object:
                 # This will only work on homogeneous array fields
                 x = np.stack(x)
@@ -561,6 +859,8 @@ class Source:
                     "You must set_data first (and populate the tensor cache)")
 
         f = getattr(self, fname)
+        if self._gimme_calls is not None:
+            self._gimme_calls.add(fname)
 
         # Frozen data methods should not be called again,
         # just fetch them from the data tensor (if we have one)
@@ -568,7 +868,10 @@ class Source:
             if data_tensor is not None:
                 return self._fetch(fname, data_tensor)
 
-        if callable(f):
+        if callable(f) and data_tensor is not None and fname in self._tables:
+            res = self._lookup_table(fname, bonus_arg, ptensor)
+
+        elif callable(f):
             args = [self._fetch(x, data_tensor) for x in self.f_dims[fname]]
             if bonus_arg is not None:
                 if isinstance(bonus_arg, (list, tuple)):
@@ -581,7 +884,10 @@ class Source:
 
         else:
             if bonus_arg is None:
-                n = len(self.data) if data_tensor is None else data_tensor.shape[0]
+                # (n_events + n_padding is the length of self.data,
+                #  also if it is a dictionary of columns)
+                n = (self.n_events + self.n_padding if data_tensor is None
+                     else data_tensor.shape[0])
                 x = tf.ones(n, dtype=fd.float_type())
             else:
                 x = tf.ones_like(bonus_arg, dtype=fd.float_type())
@@ -629,6 +935,17 @@ class Source:
         self._differential_rate_tf = tf.function(
             self._differential_rate,
             input_signature=input_signature)
+        self._log_differential_rate_tf = tf.function(
+            self._log_differential_rate,
+            input_signature=input_signature)
+        # log -> traced function, see differential_rate_vjp
+        self._differential_rate_vjp_tf = {
+            log: tf.function(
+                functools.partial(self._differential_rate_vjp, log=log),
+                input_signature=input_signature + (
+                    tf.TensorSpec(shape=self._batch_data_tensor_shape()[:1],
+                                  dtype=fd.float_type()),))
+            for log in (False, True)}
 
     def differential_rate(self, data_tensor=None, autograph=True, **kwargs):
         ptensor = self.ptensor_from_kwargs(**kwargs)
@@ -639,6 +956,45 @@ class Source:
             return self._differential_rate(
                 data_tensor=data_tensor, ptensor=ptensor)
 
+    def log_differential_rate(self, data_tensor=None, autograph=True,
+                              **kwargs):
+        """Return natural logarithm of the differential rate,
+        see differential_rate"""
+        ptensor = self.ptensor_from_kwargs(**kwargs)
+        if autograph and self.trace_difrate:
+            return self._log_differential_rate_tf(
+                data_tensor=data_tensor, ptensor=ptensor)
+        else:
+            return self._log_differential_rate(
+                data_tensor=data_tensor, ptensor=ptensor)
+
+    def differential_rate_vjp(self, data_tensor, output_gradient,
+                              log=False, autograph=True, **kwargs):
+        """Return dictionary parameter name -> derivative of
+        sum(output_gradient * differential rate) to the parameter
+
+        :param output_gradient: (n_events,) tensor of weights of each event
+        :param log: If True, use the log differential rate instead.
+        """
+        args = (data_tensor, self.ptensor_from_kwargs(**kwargs),
+                output_gradient)
+        if autograph and self.trace_difrate:
+            grad = self._differential_rate_vjp_tf[log](*args)
+        else:
+            grad = self._differential_rate_vjp(*args, log=log)
+        return dict(zip(self.defaults.keys(), tf.unstack(grad)))
+
+    def _differential_rate_vjp(self, data_tensor, ptensor, output_gradient,
+                               log=False):
+        if log:
+            y = self._log_differential_rate(data_tensor, ptensor)
+        else:
+            y = self._differential_rate(data_tensor, ptensor)
+        grad = tf.gradients(y, ptensor, grad_ys=output_gradient)[0]
+        if grad is None:
+            return tf.zeros_like(ptensor)
+        return grad
+
     def ptensor_from_kwargs(self, **kwargs):
         return tf.convert_to_tensor([kwargs.get(k, self.defaults[k])
                                      for k in self.defaults])
@@ -679,36 +1035,67 @@ class Source:
     ##
 
     def simulate(self, n_events, fix_truth=None, full_annotate=False,
-                 keep_padding=False, **params):
+                 keep_padding=False, rng=None, **params):
         """Simulate n events.
 
         Will omit events lost due to selection/detection efficiencies
+
+        :param keep_padding: ignored. Simulation does not change the
+            data that is set, so padding is always kept.
+        :param rng: Seed or numpy random Generator to draw from,
+            see fd.random_generator. By default, seed one from numpy's
+            global random state.
         """
         assert isinstance(n_events, (int, float)), \
             f"n_events must be an int or float, not {type(n_events)}"
 
-        # Draw random "deep truth" variables (energy, position)
-        # Pass on a copy of the dict or DataFrame
-        fix_truth = self.validate_fix_truth(fix_truth.copy()
-                                            if fix_truth is not None
-                                            else None)
-        sim_data = self.random_truth(n_events, fix_truth=fix_truth, **params)
-        assert isinstance(sim_data, pd.DataFrame)
-
-        with self._set_temporarily(sim_data, _skip_bounds_computation=True,
-                                   keep_padding=keep_padding, **params):
-            # Do the forward simulation of the detector response
-            d = self._simulate_response()
-            if 'p_accepted' in d.columns:
-                # Draw which events are accepted
-                d = d.iloc[np.random.rand(len(d)) < d['p_accepted'].values].copy()
+        old_rng = self._rng
+        self.rng = fd.random_generator(rng)
+        try:
+            # Draw random "deep truth" variables (energy, position)
+            # Pass on a copy of the dict or DataFrame
+            fix_truth = self.validate_fix_truth(fix_truth.copy()
+                                                if fix_truth is not None
+                                                else None)
+            sim_data = self.random_truth(n_events, fix_truth=fix_truth,
+                                         **params)
+            assert isinstance(sim_data, pd.DataFrame)
+
+            # Simulate on a dictionary of numpy columns,
+            # and only build a dataframe of the accepted events.
+            columns = {k: sim_data[k].to_numpy() for k in sim_data.columns}
+            with self._set_columns_temporarily(columns, len(sim_data),
+                                               **params):
+                # Do the forward simulation of the detector response
+                if _defined_in_flamedisx(self._simulate_response):
+                    d = self._simulate_response()
+                else:
+                    # User code may expect a DataFrame, see
+                    # _call_with_columns
+                    self.data = pd.DataFrame(columns, copy=False)
+                    d = self._simulate_response()
+                    d = {k: np.asarray(d[k]) for k in d.keys()}
+                accepted = np.arange(len(sim_data))
+                if 'p_accepted' in d:
+                    # Draw which events are accepted
+                    accepted = np.flatnonzero(self.rng.random(len(sim_data))
+                                              < d['p_accepted'])
+                # The selected arrays are new, no need to copy them again
+                d = pd.DataFrame(
+                    {k: v[accepted] if np.ndim(v) else v
+                     for k, v in d.items()},
+                    index=sim_data.index[accepted],
+                    copy=False)
             if full_annotate:
                 # Now that we have s1 and s2 values, we can populate
                 # columns like e_vis, photon_produced_mle, etc.
                 # This is optional since it can be expensive (e.g. for
-                # the WIMPsource, where it includes the full energy spectrum!)
-                return self.annotate_data(d)
+                # the WIMPsource, where it includes the full energy
+                # spectrum!)
+                return self.annotate_data(d, **params)
             return d
+        finally:
+            self.rng = old_rng
 
     def validate_fix_truth(self, fix_truth):
         """Return checked fix truth, with extra derived variables if needed"""
@@ -741,6 +1128,11 @@ class Source:
     def _differential_rate(self, data_tensor, ptensor):
         raise NotImplementedError
 
+    def _log_differential_rate(self, data_tensor, ptensor):
+        # Sources that can compute this directly, e.g. to avoid underflow,
+        # should override this.
+        return fd.safe_log(self._differential_rate(data_tensor, ptensor))
+
     def mu_before_efficiencies(self, **params):
         """Return mean expected number of events BEFORE efficiencies/response
         using data for the evaluation of the energy spectra
@@ -758,7 +1150,9 @@ class Source:
     def add_extra_columns(self, data):
         """Add additional columns to data
 
-        :param data: pandas DataFrame
+        :param data: pandas DataFrame, or during simulation a dictionary
+            of numpy arrays. Overrides defined outside flamedisx get a
+            DataFrame during simulation too, but the dictionary is faster.
         """
 
     def random_truth(self, n_events, fix_truth=None, **params):
@@ -766,10 +1160,12 @@ class Source:
         print(f"{self.__class__.__name__} cannot generate events, skipping")
         return pd.DataFrame()
 
-    def _simulate_response(self) -> pd.DataFrame:
-        """Return a dataframe with simulated observed events
-        from simulating the detector response, using self.data.
-        Note self.data is already set to something random_truth provides.
+    def _simulate_response(self) -> ty.Dict[str, np.ndarray]:
+        """Return a dictionary of numpy columns with simulated observed
+        events from simulating the detector response, using self.data.
+        Note self.data is already set to a dictionary of numpy columns
+        from what random_truth provides (or a DataFrame of them, if
+        this method is overridden outside flamedisx).
 
         You may include a p_accepted column with probabilities
         that an event survives cuts.
@@ -1,8 +1,7 @@
-import random
-import string
-
 from multihist import Histdd
+import numpy as np
 import pandas as pd
+import tensorflow as tf
 
 import flamedisx as fd
 
@@ -10,19 +9,39 @@ export, __all__ = fd.exporter()
 
 
 @export
-class TemplateSource(fd.ColumnSource):
+class TemplateSource(fd.Source):
     """Source that looks up precomputed differential rates in a template
     (probably a histogram from a simulation).
 
+    The template is stored as a tensor, and events are looked up in it
+    during inference, so the differential rate can depend on parameters:
+    given templates at several values of some parameters (morph_params),
+    the source interpolates linearly between them bin by bin
+    ('vertical morphing'). These parameters can be fitted like any other.
+
     Arguments:
         - template: numpy array, multhist.Histdd, or (hist/boost_histogram).
             containing the differential rate.
+            If morph_params is given, a (nested) sequence of these,
+            with one level per morphing parameter, e.g.
+            template[i][j] is the template for the i-th value of the first,
+            and j-th value of the second parameter.
         - bin_edges: None, or a list of numpy arrays with bin edges.
             If None, get this info from template.
         - axis_names: None, or a sequence of axis names.
             If None, get this info from template.
         - events_per_bin: set to True if template specifies expected events per
             bin, rather than differential rate.
+        - interpolate: if True, interpolate the differential rate
+            multilinearly between bin centers, rather than using the rate
+            of the bin the event is in. Note the expected number of events
+            remains the template's sum, and simulation still draws events
+            uniformly within bins.
+        - morph_params: dictionary of parameter names -> increasing sequence
+            of values at which templates are given. The default of each
+            parameter is the middle of its range, but you can pass another
+            as for any source parameter. Beyond the outer values,
+            the outermost template is used.
 
     For other arguments, see flamedisx.source.Source
     """
@@ -33,59 +52,134 @@ class TemplateSource(fd.ColumnSource):
             bin_edges=None,
             axis_names=None,
             events_per_bin=False,
+            interpolate=False,
+            morph_params=None,
             *args,
             **kwargs):
-        # Get template, bin_edges, and axis_names
-        if bin_edges is None:
-            # Hopefully we got some kind of histogram container
-            if isinstance(template, tuple) and len(template) == 2:
-                # (hist, bin_edges) tuple, e.g. from np.histdd
-                template, bin_edges = template
-            elif hasattr(template, "to_numpy"):
-                # boost_histogram / hist
-                if not axis_names:
-                    axis_names = [ax.name for ax in template.axes]
-                template, bin_edges = template.to_numpy()
-            elif hasattr(template, "bin_edges"):
-                # multihist
-                if not axis_names:
-                    axis_names = template.axis_names
-                template, bin_edges = template.histogram, template.bin_edges
+        if morph_params is None:
+            morph_params = dict()
+        #: Dictionary parameter name -> array of parameter values
+        #: at which templates are given
+        self.morph_params = {
+            pname: np.asarray(values, dtype=float)
+            for pname, values in morph_params.items()}
+        for pname, values in self.morph_params.items():
+            if len(values) < 2 or np.any(np.diff(values) <= 0):
+                raise ValueError(
+                    f"Need at least two increasing values of {pname}")
+
+        #: Whether to interpolate between bin centers, see class docstring
+        self.interpolate = interpolate
+
+        # Get the template at each point of the parameter grid
+        grid_shape = tuple(len(v) for v in self.morph_params.values())
+        hists = []
+        for grid_index in np.ndindex(*grid_shape):
+            t = template
+            for i in grid_index:
+                t = t[i]
+            hist, _bin_edges, _axis_names = _parse_template(
+                t, bin_edges, axis_names)
+            if hists:
+                if (hist.shape != hists[0].shape
+                        or list(_axis_names) != list(self.final_dimensions)
+                        or not all([np.allclose(a, b) for a, b in zip(
+                            _bin_edges, self.bin_edges)])):
+                    raise ValueError("Templates have different binnings")
             else:
-                raise ValueError("Need histogram, bin_edges, and axis_names")
-
-        if not axis_names or len(axis_names) != len(template.shape):
-            raise ValueError("Axis names missing or mismatched")
-        self.final_dimensions = axis_names
-
-        # Build a diff rate and events/bin multihist from the template
-        _mh = Histdd.from_histogram(template, bin_edges=bin_edges)
+                self.final_dimensions = tuple(_axis_names)
+                #: List of numpy arrays with the bin edges of each dimension
+                self.bin_edges = [np.asarray(x, dtype=float)
+                                  for x in _bin_edges]
+            hists.append(hist)
+        hists = np.stack(hists).reshape(grid_shape + hists[0].shape)
+
+        # Build diff rate and events/bin templates
+        bin_volumes = Histdd.from_histogram(
+            hists[(0,) * len(grid_shape)],
+            bin_edges=self.bin_edges).bin_volumes()
         if events_per_bin:
-            self._mh_events_per_bin = _mh
-            self._mh_diff_rate = _mh / _mh.bin_volumes()
+            self._events_per_bin = hists
+            self._diff_rates = fd.np_to_tf(hists / bin_volumes)
         else:
-            self._mh_events_per_bin = _mh * _mh.bin_volumes()
-            self._mh_diff_rate = _mh
-
-        self.mu = fd.np_to_tf(self._mh_events_per_bin.n)
-
-        # Generate a random column name to use to store the diff rates
-        # of observed events
-        self.column = (
-            'template_diff_rate_'
-            + ''.join(random.choices(string.ascii_lowercase, k=8)))
+            self._events_per_bin = hists * bin_volumes
+            self._diff_rates = fd.np_to_tf(hists)
+        # Expected events at each point of the parameter grid
+        self._mus = fd.np_to_tf(self._events_per_bin.sum(
+            axis=tuple(range(len(grid_shape), hists.ndim))))
+
+        self._tf_bin_edges = [fd.np_to_tf(x) for x in self.bin_edges]
+        self._tf_bin_centers = [fd.np_to_tf(0.5 * (x[1:] + x[:-1]))
+                                for x in self.bin_edges]
+        self._tf_morph_params = {pname: fd.np_to_tf(values)
+                                 for pname, values in self.morph_params.items()}
+        self._sampling_cache = None
 
         super().__init__(*args, **kwargs)
 
-    def _annotate(self):
-        """Add columns needed in inference to self.data
+    def scan_model_functions(self):
+        super().scan_model_functions()
+        for pname, values in self.morph_params.items():
+            self.defaults[pname] = tf.convert_to_tensor(
+                (values[0] + values[-1]) / 2, dtype=fd.float_type())
+
+    def _differential_rate(self, data_tensor, ptensor):
+        diff_rate = self._morph(
+            self._diff_rates,
+            **{pname: self._fetch_param(pname, ptensor)
+               for pname in self.morph_params})
+        return self._lookup(
+            diff_rate,
+            [self._fetch(x, data_tensor) for x in self.final_dimensions])
+
+    def _morph(self, x, **params):
+        """Return x, a tensor whose leading axes run over the
+        morph_params grid, linearly interpolated to params
         """
-        self.data[self.column] = self._mh_diff_rate.lookup(
-            *[self.data[x] for x in self.final_dimensions])
+        for pname, grid in self._tf_morph_params.items():
+            i_left, f = fd.interpolation_bracket(
+                grid, tf.reshape(tf.cast(params[pname], fd.float_type()), [1]))
+            x = ((1 - f[0]) * tf.gather(x, i_left[0])
+                 + f[0] * tf.gather(x, i_left[0] + 1))
+        return x
+
+    def _lookup(self, hist, coords):
+        """Return values of hist at the events' coordinates
+
+        :param hist: tensor of histogram values
+        :param coords: list of tensors, one per dimension, with the
+            coordinates of each event
+        """
+        if not self.interpolate:
+            # Like multihist's lookup, out-of-range events get the
+            # value of the nearest bin
+            index = tf.stack([
+                tf.clip_by_value(
+                    tf.searchsorted(edges, x, side='left') - 1,
+                    0, edges.shape[0] - 2)
+                for edges, x in zip(self._tf_bin_edges, coords)], axis=1)
+            return tf.gather_nd(hist, index)
+
+        return fd.multilinear_interpolate(
+            hist, self._tf_bin_centers, coords)
+
+    def _morph_params_with_defaults(self, params):
+        return {pname: params.get(pname, self.defaults[pname])
+                for pname in self.morph_params}
+
+    def mu_before_efficiencies(self, **params):
+        return self._morph(
+            self._mus, **self._morph_params_with_defaults(params))
+
+    def estimate_mu(self, n_trials=None, **params):
+        return self.mu_before_efficiencies(**params)
 
     def simulate(self, n_events, fix_truth=None, full_annotate=False,
-                 keep_padding=False, **params):
+                 keep_padding=False, rng=None, **params):
         """Simulate n events.
+
+        :param rng: Seed or numpy random Generator to draw from,
+            see fd.random_generator.
         """
         if fix_truth:
             raise NotImplementedError("TemplateSource does not yet support fix_truth")
@@ -95,6 +189,64 @@ class TemplateSource(fd.ColumnSource):
         # TODO: all other arguments are ignored, they make no sense
         # for this source. Should we warn about this? Remove them from def?
 
-        return pd.DataFrame(dict(zip(
-            self.final_dimensions,
-            self._mh_events_per_bin.get_random(n_events).T)))
+        return self.simulate_toys([int(n_events)], rng=rng, **params)[0]
+
+    def simulate_toys(self, n_events, rng=None, **params):
+        """Return list of simulated datasets, whose events are drawn
+        all at once. Much faster than calling simulate for each.
+
+        :param n_events: Sequence with the number of events of each dataset
+        :param rng: Seed or numpy random Generator to draw from,
+            see fd.random_generator.
+        """
+        n_events = np.asarray(n_events, dtype=int)
+        hist, table = self._sampling_histogram(**params)
+        events = fd.random_from_histogram(
+            hist, n_events.sum(), rng=rng, table=table)
+        return [
+            pd.DataFrame(dict(zip(self.final_dimensions, x.T)))
+            for x in np.split(events, np.cumsum(n_events)[:-1])]
+
+    def _sampling_histogram(self, **params):
+        """Return Histdd of expected events per bin at params,
+        and its fd.alias_table. Cached for the last params used.
+        """
+        params = self._morph_params_with_defaults(params)
+        key = tuple([float(x) for x in params.values()])
+        if self._sampling_cache is None or self._sampling_cache[0] != key:
+            events_per_bin = self._events_per_bin
+            if self.morph_params:
+                events_per_bin = fd.tf_to_np(self._morph(
+                    fd.np_to_tf(events_per_bin), **params))
+            hist = Histdd.from_histogram(events_per_bin,
+                                         bin_edges=self.bin_edges)
+            self._sampling_cache = key, hist, fd.alias_table(hist.histogram)
+        return self._sampling_cache[1:]
+
+
+def _parse_template(template, bin_edges=None, axis_names=None):
+    """Return (histogram, bin_edges, axis_names) from a template,
+    see TemplateSource
+    """
+    if bin_edges is None:
+        # Hopefully we got some kind of histogram container
+        if isinstance(template, tuple) and len(template) == 2:
+            # (hist, bin_edges) tuple, e.g. from np.histdd
+            template, bin_edges = template
+        elif hasattr(template, "to_numpy"):
+            # boost_histogram / hist
+            if not axis_names:
+                axis_names = [ax.name for ax in template.axes]
+            template, bin_edges = template.to_numpy()
+        elif hasattr(template, "bin_edges"):
+            # multihist
+            if not axis_names:
+                axis_names = template.axis_names
+            template, bin_edges = template.histogram, template.bin_edges
+        else:
+            raise ValueError("Need histogram, bin_edges, and axis_names")
+
+    template = np.asarray(template, dtype=float)
+    if not axis_names or len(axis_names) != len(template.shape):
+        raise ValueError("Axis names missing or mismatched")
+    return template, bin_edges, axis_names
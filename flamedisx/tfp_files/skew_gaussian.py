@@ -26,6 +26,45 @@ import flamedisx as fd
 export, __all__ = fd.exporter()
 
 
+@export
+def owens_t(h, a, n_nodes=6):
+  """Return Owen's T function T(h, a), computed by Gauss-Legendre quadrature.
+
+  Arguments are first reduced to 0 <= a <= 1, where the integrand is smooth.
+  The absolute error is below 1e-6 for 4 nodes, and 1e-8 for 6 nodes.
+
+  Args:
+    h: Floating point tensor.
+    a: Floating point tensor, broadcastable against h.
+    n_nodes: Number of quadrature nodes.
+  """
+  h = tf.abs(h)
+  sign = tf.sign(a)
+  a = tf.abs(a)
+
+  # For a > 1, use T(h, a) = (Phi(h) + Phi(ah))/2 - Phi(h) Phi(ah) - T(ah, 1/a)
+  # (Note h >= 0 here.)
+  swap = a > 1.
+  h_reduced = tf.where(swap, a * h, h)
+  a_reduced = tf.where(swap, 1. / tf.where(swap, a, tf.ones_like(a)), a)
+
+  # T(h, a) = a / (2 pi) integral_0^1 exp(-h^2 (1 + a^2 t^2) / 2) / (1 + a^2 t^2) dt
+  nodes, weights = np.polynomial.legendre.leggauss(n_nodes)
+  integral = 0.
+  for t, w in zip((nodes + 1.) / 2., weights / 2.):
+    q = 1. + (a_reduced * t) ** 2
+    integral += w * tf.math.exp(-0.5 * h_reduced ** 2 * q) / q
+  t_reduced = a_reduced * integral / (2. * np.pi)
+
+  std_normal = normal.Normal(loc=tf.zeros([], dtype=h.dtype),
+                             scale=tf.ones([], dtype=h.dtype))
+  phi_h = std_normal.cdf(h)
+  phi_ah = std_normal.cdf(a * h)
+  return sign * tf.where(swap,
+                         0.5 * (phi_h + phi_ah) - phi_h * phi_ah - t_reduced,
+                         t_reduced)
+
+
 @export
 class SkewGaussian(distribution.Distribution):
   """The Skew Gaussian distribution with `loc`, `scale` and `skewness` parameters.
@@ -49,6 +88,7 @@ class SkewGaussian(distribution.Distribution):
                scale,
                skewness,
                owens_t_terms=2,
+               owens_t_nodes=None,
                validate_args=False,
                allow_nan_stats=True,
                name='SkewGaussian'):
@@ -63,6 +103,8 @@ class SkewGaussian(distribution.Distribution):
         Must contain only positive values.
       skewness: Floating point tensor; the skewness of the distribution(s).
       owens_t_terms: Number of terms to use in the expansion of Owen's T function
+      owens_t_nodes: If not None, compute Owen's T function with `owens_t`,
+        using this many quadrature nodes, instead of the series expansion.
       validate_args: Python `bool`, default `False`. When `True` distribution
         parameters are checked for validity despite possibly degrading runtime
         performance. When `False` invalid inputs may silently render incorrect
@@ -86,6 +128,7 @@ class SkewGaussian(distribution.Distribution):
       self._skewness = tensor_util.convert_nonref_to_tensor(
           skewness, dtype=dtype, name='skewness')
       self.owens_t_terms = owens_t_terms
+      self.owens_t_nodes = owens_t_nodes
       super(SkewGaussian, self).__init__(
           dtype=dtype,
           reparameterization_type=reparameterization.FULLY_REPARAMETERIZED,
@@ -169,6 +212,9 @@ class SkewGaussian(distribution.Distribution):
     h = tf.cast((x - self.loc)/scale,'float32')
     a = tf.cast(skewness,'float32')
 
+    if self.owens_t_nodes is not None:
+      return normal.Normal(loc=0.,scale=1.).cdf(h) - 2. * owens_t(h, a, self.owens_t_nodes)
+
     owens_t_eval = 0.5 * normal.Normal(loc=0.,scale=1.).cdf(h) + 0.5 * normal.Normal(loc=0.,scale=1.).cdf(a*h) - normal.Normal(loc=0.,scale=1.).cdf(h) * normal.Normal(loc=0.,scale=1.).cdf(a*h)
 
     return 0.5 * (1. + tf.math.erf(1./(np.sqrt(2.)*scale) * (x - self.loc))) - \
@@ -37,6 +37,7 @@ class TruncatedSkewGaussianCC(distribution.Distribution):
                skewness,
                limit,
                owens_t_terms=2,
+               owens_t_nodes=None,
                validate_args=False,
                allow_nan_stats=True,
                name='TruncatedSkewGaussianCC'):
@@ -56,6 +57,8 @@ class TruncatedSkewGaussianCC(distribution.Distribution):
         mass is zero-ed out and re-dumped into the the probability mass of
         limit.
       owens_t_terms: Number of terms to use in the expansion of Owen's T function
+      owens_t_nodes: If not None, compute Owen's T function by quadrature with
+        this many nodes instead, see `SkewGaussian`.
       validate_args: Python `bool`, default `False`. When `True` distribution
         parameters are checked for validity despite possibly degrading runtime
         performance. When `False` invalid inputs may silently render incorrect
@@ -81,6 +84,7 @@ class TruncatedSkewGaussianCC(distribution.Distribution):
       self._limit = tensor_util.convert_nonref_to_tensor(
           limit, dtype=dtype, name='limit')
       self.owens_t_terms = owens_t_terms
+      self.owens_t_nodes = owens_t_nodes
       super(TruncatedSkewGaussianCC, self).__init__(
           dtype=dtype,
           reparameterization_type=reparameterization.FULLY_REPARAMETERIZED,
@@ -140,7 +144,7 @@ class TruncatedSkewGaussianCC(distribution.Distribution):
     scale = tf.convert_to_tensor(self.scale)
     skewness = tf.convert_to_tensor(self.skewness)
     limit = tf.convert_to_tensor(self.limit)
-    skew_gauss = fd.tfp_files.SkewGaussian(loc=self.loc,scale=scale,skewness=skewness,owens_t_terms=self.owens_t_terms)
+    skew_gauss = fd.tfp_files.SkewGaussian(loc=self.loc,scale=scale,skewness=skewness,owens_t_terms=self.owens_t_terms,owens_t_nodes=self.owens_t_nodes)
 
     cdf_upper = skew_gauss.cdf(x+0.5)
     cdf_lower = skew_gauss.cdf(x-0.5)
@@ -1,11 +1,14 @@
+import itertools
 from pathlib import Path
 import subprocess
 
 import inspect
+from multihist import Hist1d
 import numpy as np
 import pandas as pd
 from scipy import stats
 import tensorflow as tf
+import tensorflow_probability as tfp
 
 lgamma = tf.math.lgamma
 o = tf.newaxis
@@ -81,6 +84,56 @@ def lookup_axis1(x, indices, fill_value=0):
                    dtype=float_type())
 
 
+@export
+def interpolation_bracket(grid, x, extrapolate=False):
+    """Return index of the grid point left of each x, and the distance
+    of x beyond it as a fraction of the distance to the next grid point.
+    Beyond the grid, the outermost grid interval is used, and the fraction
+    is clipped to [0, 1] unless extrapolate is True.
+
+    :param grid: 1d tensor of increasing values
+    :param x: 1d tensor
+    """
+    n = grid.shape[0]
+    if n < 2:
+        return tf.zeros_like(x, dtype=tf.int32), tf.zeros_like(x)
+    i_left = tf.clip_by_value(
+        tf.searchsorted(grid, x, side='right') - 1, 0, n - 2)
+    left, right = tf.gather(grid, i_left), tf.gather(grid, i_left + 1)
+    f = (x - left) / (right - left)
+    if not extrapolate:
+        f = tf.clip_by_value(f, 0., 1.)
+    return i_left, f
+
+
+@export
+def multilinear_interpolate(values, grid, coords, extrapolate=False):
+    """Return values on a grid multilinearly interpolated to coords
+
+    :param values: tensor of shape (len(grid[0]), len(grid[1]), ...),
+        possibly with further axes for array-valued values.
+    :param grid: list of 1d tensors with increasing grid coordinates
+    :param coords: list of 1d tensors, one per grid dimension,
+        with the coordinates of each point
+    :param extrapolate: If True, extrapolate linearly beyond the grid,
+        otherwise use the value at the nearest grid edge.
+    :return: tensor (n_points, ...)
+    """
+    brackets = [interpolation_bracket(g, x, extrapolate=extrapolate)
+                for g, x in zip(grid, coords)]
+    extra_axes = len(values.shape) - len(grid)
+    result = 0.
+    for corner in itertools.product((0, 1), repeat=len(grid)):
+        weight = tf.ones_like(coords[0])
+        index = []
+        for (i_left, f), c, g in zip(brackets, corner, grid):
+            weight *= f if c else 1 - f
+            index.append(tf.minimum(i_left + c, g.shape[0] - 1))
+        weight = tf.reshape(weight, [-1] + [1] * extra_axes)
+        result += weight * tf.gather_nd(values, tf.stack(index, axis=1))
+    return result
+
+
 @export
 def tf_to_np(x):
     """Convert (list/tuple of) tensors x to numpy"""
@@ -132,6 +185,17 @@ def safe_p(ps):
     return ps
 
 
+@export
+def safe_log(x):
+    """Return natural logarithm of x, or -inf where x <= 0.
+    Unlike tf.math.log, this does not give NaN gradients at x = 0.
+    """
+    positive = x > 0
+    return tf.where(positive,
+                    tf.math.log(tf.where(positive, x, tf.ones_like(x))),
+                    -np.inf * tf.ones_like(x))
+
+
 @export
 def beta_params(mean, sigma, force_valid=True):
     """Convert (p_mean, p_sigma) to (alpha, beta) params of beta distribution
@@ -173,6 +237,236 @@ def beta_binom_pmf(x, n, p_mean, p_sigma):
                     tf.zeros_like(res, dtype=float_type()))
 
 
+@export
+class BandedTensor:
+    """(n_events, n_rows, n_columns) tensor of which only a band is stored:
+    for each event and row, width consecutive columns starting at start.
+    Elsewhere, the tensor is zero.
+
+    :param band: (n_events, n_rows, width) tensor with the band
+    :param start: (n_events, n_rows) int tensor with the first column
+        of the band
+    :param n_columns: number of columns of the full tensor
+    """
+
+    def __init__(self, band, start, n_columns):
+        self.band = band
+        self.start = start
+        self.n_columns = n_columns
+
+    @property
+    def dtype(self):
+        return self.band.dtype
+
+    @property
+    def shape(self):
+        """Shape of the full tensor. The number of columns is None
+        if it is only known at runtime"""
+        return tf.TensorShape(self.band.shape[:2]).concatenate(
+            [tf.get_static_value(self.n_columns)])
+
+    def column_indices(self):
+        """Return (n_events, n_rows, width) tensor with the column
+        of each element of the band"""
+        return (self.start[:, :, o]
+                + tf.range(tf.shape(self.band)[2], dtype=self.start.dtype))
+
+    def gather(self, x):
+        """Return the band of x, a full (n_events, n_rows, n_columns) tensor
+        """
+        return tf.gather(x, self.column_indices(), batch_dims=2)
+
+    def with_band(self, band):
+        """Return BandedTensor with the same band position, but another band
+        """
+        return BandedTensor(band, self.start, self.n_columns)
+
+    def to_dense(self):
+        """Return the full (n_events, n_rows, n_columns) tensor"""
+        width = tf.shape(self.band)[2]
+        band_index = (tf.range(self.n_columns, dtype=self.start.dtype)[o, o, :]
+                      - self.start[:, :, o])
+        in_band = (band_index >= 0) & (band_index < width)
+        result = tf.gather(self.band,
+                           tf.clip_by_value(band_index, 0, width - 1),
+                           batch_dims=2)
+        return tf.where(in_band, result, tf.zeros_like(result))
+
+
+@export
+def banded_binomial_pmf(x, n, p, band_sigma):
+    """Return probability mass function of the binomial distribution,
+    computed only within band_sigma standard deviations of the mean,
+    as a BandedTensor. Elsewhere, the result is zero.
+
+    :param x: (n_events, n_n, n_x) tensor with number of successes,
+        evenly spaced along the last axis.
+    :param n: (n_events, n_n, n_x) tensor with number of trials,
+        constant along the last axis.
+    :param p: success probability, broadcastable to x and
+        constant along the last axis.
+    :param band_sigma: half-width of the band in standard deviations
+    """
+    p = tf.broadcast_to(tf.cast(p, dtype=float_type()), tf.shape(x))[:, :, :1]
+    n = n[:, :, :1]
+    n_x = tf.shape(x)[2]
+    x_first, x_last = x[:, :, :1], x[:, :, -1:]
+    x_step = tf.where(
+        n_x > 1,
+        (x_last - x_first) / tf.cast(tf.maximum(n_x - 1, 1),
+                                     dtype=float_type()),
+        tf.ones_like(x_first))
+
+    # Find the part of the band inside the x grid for each n.
+    # The stored band is wide enough to hold the widest of these.
+    mean = n * p
+    sigma = (n * p * (1 - p)) ** 0.5
+    low = tf.maximum(mean - band_sigma * sigma, x_first)
+    high = tf.minimum(mean + band_sigma * sigma, x_last)
+    width = tf.reduce_max(tf.where(
+        high >= low,
+        tf.math.ceil((high - low) / x_step) + 2,
+        tf.zeros_like(low)))
+    width = tf.clip_by_value(tf.cast(width, dtype=int_type()), 1, n_x)
+    start = tf.math.floor((low - x_first) / x_step)
+    start = tf.clip_by_value(start,
+                             0., tf.cast(n_x - width, dtype=float_type()))
+
+    # Compute the band
+    x_band = x_first + x_step * (
+        start + tf.range(width, dtype=float_type())[o, o, :])
+    valid = (x_band >= 0) & (x_band <= n)
+    band = tfp.distributions.Binomial(total_count=n, probs=p).prob(
+        tf.minimum(tf.maximum(x_band, 0.), n))
+    band = tf.where(valid, band, tf.zeros_like(band))
+    return BandedTensor(band, tf.cast(start[:, :, 0], dtype=int_type()), n_x)
+
+
+@export
+def batch_reduce(x, batch_size, ufunc=np.maximum, broadcast=True):
+    """Reduce x over each batch of batch_size consecutive events.
+    The last batch may be incomplete.
+
+    :param x: array with events along the first axis
+    :param batch_size: number of events per batch
+    :param ufunc: numpy ufunc to reduce with, e.g. np.maximum or np.minimum
+    :param broadcast: if True (default), return an array like x with each
+        element replaced by the result for its batch. Otherwise, return
+        the results per batch.
+    """
+    x = np.asarray(x)
+    result = ufunc.reduceat(x, np.arange(0, len(x), batch_size), axis=0)
+    if broadcast:
+        return np.repeat(result, batch_size, axis=0)[:len(x)]
+    return result
+
+
+@export
+def random_generator(seed=None):
+    """Return a numpy random generator to simulate with.
+
+    :param seed: None for a new Generator seeded from numpy's global
+        random state (so np.random.seed makes results reproducible),
+        an int or SeedSequence to seed a new Generator,
+        or a Generator or RandomState (returned as is).
+    """
+    if seed is None:
+        return np.random.default_rng(np.random.randint(2**32))
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.default_rng(seed)
+
+
+@export
+def spawn_random_generators(seed, n):
+    """Return n statistically independent random generators derived
+    from seed, e.g. for simulating toys in different processes.
+    The result only depends on seed and n, so the toys are reproducible
+    no matter how they are distributed.
+
+    :param seed: int or SeedSequence. If None, take fresh entropy
+        from the OS.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return [np.random.default_rng(s) for s in seed.spawn(n)]
+
+
+@export
+def alias_table(weights):
+    """Return (probabilities, aliases) arrays for drawing indices of
+    the flattened weights array with Walker's alias method,
+    see random_from_alias_table. NaN weights count as zero.
+
+    Building the table takes a loop over the weights, but afterwards
+    each draw takes constant time, regardless of the number of weights.
+    """
+    p = np.nan_to_num(np.asarray(weights, dtype=float).ravel())
+    n = len(p)
+    if not n or p.sum() <= 0 or np.any(p < 0):
+        raise ValueError("Weights must be non-negative, with a positive sum")
+    p = p * n / p.sum()
+
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = np.flatnonzero(p < 1).tolist()
+    large = np.flatnonzero(p >= 1).tolist()
+    while small and large:
+        i, j = small.pop(), large.pop()
+        # Index i is drawn with probability p[i], otherwise j.
+        # j donates the remainder.
+        prob[i] = p[i]
+        alias[i] = j
+        p[j] -= 1 - p[i]
+        (small if p[j] < 1 else large).append(j)
+    # Whatever remains has p = 1, up to rounding errors.
+    return prob, alias
+
+
+@export
+def random_from_alias_table(table, size, rng=None):
+    """Return random indices drawn using an alias_table
+
+    :param size: int or shape of the output
+    :param rng: Seed or numpy random generator, see random_generator.
+    """
+    prob, alias = table
+    rng = random_generator(rng)
+    # Use the integer part of one uniform variate to choose the index,
+    # and the fractional part to choose between it and its alias.
+    x = rng.random(size) * len(prob)
+    i = np.minimum(x.astype(int), len(prob) - 1)
+    return np.where(x - i < prob[i], i, alias[i])
+
+
+@export
+def random_from_histogram(hist, size, rng=None, table=None):
+    """Return random variates from a multihist histogram of events per
+    bin, uniformly distributed within bins. Like hist.get_random,
+    but drawing from rng (see random_generator).
+
+    :param table: alias_table of hist.histogram. Pass this to speed up
+        repeated draws from the same histogram.
+    :return: (size) array for a Hist1d, (size, n_dim) array for a Histdd
+    """
+    rng = random_generator(rng)
+    one_d = isinstance(hist, Hist1d)
+    bin_edges = [hist.bin_edges] if one_d else hist.bin_edges
+
+    if table is None:
+        p = hist.histogram.ravel().astype(float)
+        p /= np.nansum(p)
+        flat_indices = rng.choice(len(p), size=size, p=p)
+    else:
+        flat_indices = random_from_alias_table(table, size, rng=rng)
+    bin_indices = np.unravel_index(flat_indices, hist.histogram.shape)
+
+    result = np.stack([
+        edges[i] + rng.random(size) * np.diff(edges)[i]
+        for edges, i in zip(bin_edges, bin_indices)], axis=1)
+    return result[:, 0] if one_d else result
+
+
 @export
 def is_numpy_number(x):
     try:
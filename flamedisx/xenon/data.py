@@ -73,6 +73,26 @@ def get_nt_file(data_file_name):
     return fd.get_resource(f'{NTFD_PATH}/{data_file_name}')
 
 
+@export
+def get_nt_map(data_file_name):
+    """Return correction map data from file in XENONnT/Flamedisx/...
+    If a binary version of the map exists next to it (same name,
+    but extension .fdmap, see fd.save_map_binary), load that instead.
+
+    Do NOT call on import time --
+    that would make flamedisx unusable to non-XENON folks!
+    """
+    ensure_repo('XENONnT/Flamedisx.git', NTFD_PATH)
+    binary_name = data_file_name
+    for extension in ('.json.gz', '.json'):
+        if binary_name.endswith(extension):
+            binary_name = binary_name[:-len(extension)] + '.fdmap'
+            break
+    if os.path.exists(f'{NTFD_PATH}/{binary_name}'):
+        return fd.get_resource(f'{NTFD_PATH}/{binary_name}')
+    return get_nt_file(data_file_name)
+
+
 @export
 def refresh_nt(token=None):
     """Cloning latest version of XENONnT/Flamedisx (prompting for credentials) if we do not have it"""
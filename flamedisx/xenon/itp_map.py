@@ -3,14 +3,18 @@
 Adapted from https://github.com/XENONnT/straxen/blob/master/straxen/itp_map.py
 commit 156c5b1f0aad543ad5707911e2ee301a091a40a4
 """
+import hashlib
 import logging
 import gzip
 import json
+import os
+from pathlib import Path
 import re
 
 import numpy as np
 from scipy.spatial import cKDTree
 from scipy.interpolate import RectBivariateSpline, RegularGridInterpolator
+import tensorflow as tf
 
 import flamedisx as fd
 export, __all__ = fd.exporter()
@@ -23,12 +27,14 @@ class InterpolateAndExtrapolate:
     """
 
     def __init__(self, points, values,
-                 neighbours_to_use=None, array_valued=False):
+                 neighbours_to_use=None, array_valued=False, workers=1):
         """
         :param points: array (n_points, n_dims) of coordinates
         :param values: array (n_points) of values
         :param neighbours_to_use: Number of neighbouring points to use for
         averaging. Default is 2 * dimensions of points.
+        :param workers: Number of threads for neighbour queries,
+        -1 to use all CPUs.
         """
         self.kdtree = cKDTree(points)
         self.values = values
@@ -36,11 +42,15 @@ class InterpolateAndExtrapolate:
             neighbours_to_use = points.shape[1] * 2
         self.neighbours_to_use = neighbours_to_use
         self.array_valued = array_valued
+        self.workers = workers
         if array_valued:
             self.n_dim = self.values.shape[-1]
 
     def __call__(self, points):
-        distances, indices = self.kdtree.query(points, self.neighbours_to_use)
+        distances, indices = self.kdtree.query(
+            points, self.neighbours_to_use, workers=self.workers)
+        if self.neighbours_to_use == 1:
+            distances, indices = distances[:, None], indices[:, None]
 
         result = np.ones(len(points)) * float('nan')
         if self.array_valued:
@@ -54,13 +64,210 @@ class InterpolateAndExtrapolate:
         values = self.values[indices[valid]]
         weights = 1 / np.clip(distances[valid], 1e-6, float('inf'))
         if self.array_valued:
-            weights = np.repeat(weights, self.n_dim).reshape(values.shape)
+            weights = weights[..., None]
 
-        result[valid] = np.average(values, weights=weights,
-                                   axis=-2 if self.array_valued else -1)
+        result[valid] = (np.sum(weights * values, axis=1)
+                         / np.sum(weights, axis=1))
         return result
 
 
+@export
+class RasterizedInterpolateAndExtrapolate:
+    """InterpolateAndExtrapolate evaluated once on a regular raster
+    over the points' bounding box, then interpolated multilinearly.
+
+    Much faster for many queries, but not accurate on scales below
+    the raster spacing. Positions beyond the bounding box get the value
+    at the nearest point of the box.
+    """
+
+    def __init__(self, points, values, raster_shape,
+                 array_valued=False, cache_dir=None, **kwargs):
+        """
+        :param points: array (n_points, n_dims) of coordinates
+        :param values: array (n_points) of values
+        :param raster_shape: Number of raster points along each dimension,
+        or one number for all dimensions.
+        :param cache_dir: Directory in which to store rasters, so they
+        are computed only once for each map and raster shape.
+        For other arguments, see InterpolateAndExtrapolate.
+        """
+        points = np.asarray(points, dtype=float)
+        values = np.asarray(values, dtype=float)
+        n_dims = points.shape[1]
+        raster_shape = np.broadcast_to(raster_shape, n_dims).astype(int)
+        self.low, self.high = points.min(axis=0), points.max(axis=0)
+        grid = [np.linspace(l_, h_, n)
+                for l_, h_, n in zip(self.low, self.high, raster_shape)]
+
+        cache_path = None
+        if cache_dir is not None:
+            key = hashlib.sha1()
+            for x in (points, values, raster_shape):
+                key.update(np.ascontiguousarray(x).tobytes())
+            key.update(repr(sorted([
+                (k, v) for k, v in kwargs.items()
+                if k != 'workers'])).encode())
+            cache_path = Path(cache_dir) / f'raster_{key.hexdigest()}.npy'
+
+        if cache_path is not None and cache_path.exists():
+            raster = np.load(cache_path)
+        else:
+            itp = InterpolateAndExtrapolate(points, values,
+                                            array_valued=array_valued,
+                                            **kwargs)
+            raster_points = np.stack(
+                np.meshgrid(*grid, indexing='ij'), axis=-1).reshape(-1, n_dims)
+            raster = itp(raster_points).reshape(
+                tuple(raster_shape) + values.shape[1:])
+            if cache_path is not None:
+                # Write to a temporary file first, so an interrupted save
+                # leaves no corrupt cache file
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                temp_path = cache_path.with_suffix('.tmp')
+                with open(temp_path, 'wb') as f:
+                    np.save(f, raster)
+                os.replace(temp_path, cache_path)
+
+        self.raster = raster
+        self.itp = RegularGridInterpolator(tuple(grid), raster)
+
+    def __call__(self, points):
+        return self.itp(np.clip(points, self.low, self.high))
+
+
+@export
+class TFRegularGridInterpolator:
+    """Multilinear interpolation on a regular grid, in tensorflow,
+    so it can be used in model functions.
+
+    Like scipy's RegularGridInterpolator with bounds_error=False and
+    fill_value=None, positions beyond the grid are extrapolated linearly.
+    """
+
+    def __init__(self, grid, values):
+        """
+        :param grid: sequence of n_dims arrays of increasing grid coordinates
+        :param values: array of shape (len(grid[0]), len(grid[1]), ...),
+        with an additional last axis for array-valued maps.
+        """
+        self.grid = [fd.np_to_tf(np.asarray(g, dtype=float)) for g in grid]
+        self.values = fd.np_to_tf(np.asarray(values, dtype=float))
+
+    def __call__(self, positions):
+        """Return values at positions, a (n_points, n_dims) tensor"""
+        positions = tf.cast(positions, fd.float_type())
+        return fd.multilinear_interpolate(
+            self.values,
+            self.grid,
+            [positions[:, i] for i in range(len(self.grid))],
+            extrapolate=True)
+
+
+@export
+class TFInterpolateAndExtrapolate:
+    """Inverse-distance weighted averaging between nearby points,
+    like InterpolateAndExtrapolate, but in tensorflow,
+    so it can be used in model functions.
+
+    Rather than querying a k-d tree, we precompute candidate neighbours
+    for each cell of a regular raster over the points' bounding box:
+    all points that can be among the nearest neighbours of a position
+    in the cell. Within the bounding box, the result equals that of
+    InterpolateAndExtrapolate; beyond it, the candidates of the
+    nearest cell are used, so results can differ far outside the map.
+    """
+
+    def __init__(self, points, values,
+                 neighbours_to_use=None, array_valued=False,
+                 raster_shape=None):
+        """
+        :param points: array (n_points, n_dims) of coordinates
+        :param values: array (n_points) of values,
+        or (n_points, n_values) if array_valued
+        :param neighbours_to_use: Number of neighbouring points to use for
+        averaging. Default is 2 * dimensions of points.
+        :param raster_shape: Number of raster cells along each dimension.
+        Default is about one cell per point.
+        """
+        points = np.asarray(points, dtype=float)
+        n_points, n_dims = points.shape
+        if neighbours_to_use is None:
+            neighbours_to_use = n_dims * 2
+        self.neighbours_to_use = neighbours_to_use = min(
+            neighbours_to_use, n_points)
+        self.array_valued = array_valued
+        if raster_shape is None:
+            raster_shape = [max(1, int(round(n_points ** (1 / n_dims))))] * n_dims
+        raster_shape = np.asarray(raster_shape, dtype=int)
+
+        # Cell centers of the raster
+        low, high = points.min(axis=0), points.max(axis=0)
+        cell_size = np.where(high > low, high - low, 1) / raster_shape
+        centers = np.stack(np.meshgrid(
+            *[low[i] + cell_size[i] * (0.5 + np.arange(raster_shape[i]))
+              for i in range(n_dims)],
+            indexing='ij'), axis=-1).reshape(-1, n_dims)
+
+        # Any nearest neighbour of a position in a cell is no further
+        # from the cell center than the center's k-th nearest neighbour,
+        # plus twice the distance from the center to the cell's corner.
+        kdtree = cKDTree(points)
+        distances, _ = kdtree.query(centers, neighbours_to_use)
+        distances = distances.reshape(len(centers), -1)[:, -1]
+        candidates = kdtree.query_ball_point(
+            centers,
+            distances + np.sum(cell_size ** 2) ** 0.5 + 1e-6 * cell_size.max())
+        n_candidates = max([len(c) for c in candidates])
+        # Pad with index n_points, which marks a missing candidate
+        self.candidates = tf.constant(np.array(
+            [c + [n_points] * (n_candidates - len(c)) for c in candidates],
+            dtype=np.int32))
+
+        self.points = fd.np_to_tf(points)
+        self.values = fd.np_to_tf(np.asarray(values, dtype=float))
+        self.low = fd.np_to_tf(low)
+        self.cell_size = fd.np_to_tf(cell_size)
+        self.raster_shape = tf.constant(raster_shape, dtype=tf.int32)
+        self.raster_strides = tf.constant(
+            np.cumprod(raster_shape[::-1])[::-1] // raster_shape,
+            dtype=tf.int32)
+
+    def __call__(self, positions):
+        """Return values at positions, a (n_points, n_dims) tensor"""
+        positions = tf.cast(positions, fd.float_type())
+
+        # Find the raster cell of each position, and its candidates
+        cell = tf.clip_by_value(
+            tf.cast(tf.floor((positions - self.low) / self.cell_size),
+                    tf.int32),
+            0, self.raster_shape - 1)
+        candidates = tf.gather(
+            self.candidates,
+            tf.reduce_sum(cell * self.raster_strides, axis=1))
+
+        # Distances to candidates, infinite for padding candidates.
+        # Clip squared distances rather than distances, so gradients
+        # remain finite on top of a map point.
+        present = candidates < self.points.shape[0]
+        candidates = tf.where(present, candidates, 0)
+        delta = positions[:, None, :] - tf.gather(self.points, candidates)
+        distances = tf.sqrt(tf.maximum(
+            tf.reduce_sum(delta ** 2, axis=-1), 1e-12))
+        distances = tf.where(present, distances, float('inf'))
+
+        # Weighted average of the nearest neighbours
+        neg_distances, nearest = tf.math.top_k(
+            -distances, k=self.neighbours_to_use)
+        weights = 1 / -neg_distances
+        values = tf.gather(self.values,
+                           tf.gather(candidates, nearest, batch_dims=1))
+        if self.array_valued:
+            weights = weights[:, :, None]
+        return (tf.reduce_sum(weights * values, axis=1)
+                / tf.reduce_sum(weights, axis=1))
+
+
 @export
 class InterpolatingMap:
     """Correction map that computes values using inverse-weighted distance
@@ -95,6 +302,11 @@ class InterpolatingMap:
     RegularGridInterpolator in scipy by pass keyword argument like
     method='RectBivariateSpline'
 
+    For the default method, pass workers=-1 to query neighbours on all
+    CPUs, or raster_shape to evaluate the map once on a regular raster
+    and interpolate in that (see RasterizedInterpolateAndExtrapolate),
+    with cache_dir to store the raster on disk.
+
     The interpolators are called with
     'positions' :  [[x1, y1], [x2, y2], [x3, y3], [x4, y4], ...]
     'map_name'  :  key to switch to map interpolator other than
@@ -104,30 +316,9 @@ class InterpolatingMap:
                             'name', 'irregular', 'compressed', 'quantized']
 
     def __init__(self, data, method='WeightedNearestNeighbors', **kwargs):
-        if isinstance(data, bytes):
-            data = gzip.decompress(data).decode()
-        if isinstance(data, (str, bytes)):
-            data = json.loads(data)
-        assert isinstance(data, dict), f"Expected dictionary data, got {type(data)}"
-        self.data = data
-
-        # Decompress / dequantize the map
-        # We should support multiple map names!
-        if 'compressed' in self.data:
-            try:
-                import strax
-            except ImportError:
-                print("You must install strax to use compressed maps!\n")
-                raise
-
-            compressor, dtype, shape = self.data['compressed']
-            self.data['map'] = np.frombuffer(
-              strax.io.COMPRESSORS[compressor]['decompress'](self.data['map']),
-              dtype=dtype).reshape(*shape)
-            del self.data['compressed']
-        if 'quantized' in self.data:
-            self.data['map'] = self.data['quantized'] * self.data['map'].astype(np.float32)
-            del self.data['quantized']
+        self.data = _decode_map_data(data)
+        self.method = method
+        self._itp_kwargs = kwargs
 
         csys = self.data['coordinate_system']
         if not len(csys):
@@ -142,7 +333,8 @@ class InterpolatingMap:
             csys = np.array(csys).reshape((-1, len(grid)))
             self.dimensions = len(grid)
         else:
-            csys = np.array(csys)
+            # asarray, so memory-mapped coordinates are not copied
+            csys = np.asarray(csys)
             self.dimensions = len(csys[0])
 
         self.coordinate_system = csys
@@ -158,33 +350,39 @@ class InterpolatingMap:
                                                          "NO DESCRIPTION?!")))
         log.debug("Map names found: %s" % self.map_names)
 
+        #: Dictionary map_name -> array (n_dim) of scaling factors
+        #: of the coordinates, see scale_coordinates
+        self.scaling_factors = dict()
+        self._scaled_interpolators = dict()
+
         for map_name in self.map_names:
-            # Specify dtype float to set Nones to nan
-            map_data = np.array(self.data[map_name], dtype=np.float64)
-            if len(self.coordinate_system) == len(map_data):
-                array_valued = len(map_data.shape) == 2
-            else:
-                array_valued = len(map_data.shape) == self.dimensions + 1
+            self.interpolators[map_name] = self._make_interpolator(
+                map_name, csys)
 
-            if self.dimensions == 0:
-                # 0 D -- placeholder maps which take no arguments
-                # and always return a single value
-                def itp_fun(positions):
-                    return np.array([map_data])
+    def _make_interpolator(self, map_name, csys):
+        """Return interpolator of map_name, using coordinates csys"""
+        # Specify dtype float to set Nones to nan
+        map_data = np.asarray(self.data[map_name], dtype=np.float64)
+        method, kwargs = self.method, self._itp_kwargs
 
-            elif method == 'RectBivariateSpline':
-                itp_fun = self._rect_bivariate_spline(csys, map_data, array_valued, **kwargs)
+        if self.dimensions == 0:
+            # 0 D -- placeholder maps which take no arguments
+            # and always return a single value
+            def itp_fun(positions):
+                return np.array([map_data])
+            return itp_fun
 
-            elif method == 'RegularGridInterpolator':
-                itp_fun = self._regular_grid_interpolator(csys, map_data, array_valued, **kwargs)
+        array_valued = self._is_array_valued(map_data)
+        if method == 'RectBivariateSpline':
+            return self._rect_bivariate_spline(csys, map_data, array_valued, **kwargs)
 
-            elif method == 'WeightedNearestNeighbors':
-                itp_fun = self._weighted_nearest_neighbors(csys, map_data, array_valued, **kwargs)
+        elif method == 'RegularGridInterpolator':
+            return self._regular_grid_interpolator(csys, map_data, array_valued, **kwargs)
 
-            else:
-                raise ValueError(f'Interpolation method {method} is not supported')
+        elif method == 'WeightedNearestNeighbors':
+            return self._weighted_nearest_neighbors(csys, map_data, array_valued, **kwargs)
 
-            self.interpolators[map_name] = itp_fun
+        raise ValueError(f'Interpolation method {method} is not supported')
 
     def __call__(self, *args, map_name='map'):
         """Returns the value of the map at the position given by coordinates
@@ -193,6 +391,54 @@ class InterpolatingMap:
         """
         return self.interpolators[map_name](*args)
 
+    def _is_array_valued(self, map_data):
+        if len(self.coordinate_system) == len(map_data):
+            return len(map_data.shape) == 2
+        return len(map_data.shape) == self.dimensions + 1
+
+    def tf_interpolator(self, map_name='map', **kwargs):
+        """Return a tensorflow version of the interpolator of map_name,
+        for use in model functions. It takes a (n_points, n_dims) tensor
+        of positions, and is differentiable with respect to them.
+
+        RegularGridInterpolator maps give a TFRegularGridInterpolator,
+        WeightedNearestNeighbors maps a TFInterpolateAndExtrapolate.
+        RectBivariateSpline maps are interpolated multilinearly instead.
+
+        :param kwargs: Passed to TFInterpolateAndExtrapolate
+        """
+        map_data = np.array(self.data[map_name], dtype=np.float64)
+        if self.dimensions == 0:
+            value = fd.np_to_tf(map_data)
+            return lambda positions: value
+
+        array_valued = self._is_array_valued(map_data)
+        csys = (np.asarray(self.coordinate_system)
+                * self.scaling_factors.get(map_name, 1))
+        if self.method in ('RegularGridInterpolator', 'RectBivariateSpline'):
+            grid = [np.unique(csys[:, i]) for i in range(self.dimensions)]
+            grid_shape = [len(g) for g in grid]
+            if np.prod(grid_shape) != len(csys):
+                raise ValueError(
+                    f"Map {map_name} is not specified on a regular grid")
+            if array_valued:
+                map_data = map_data.reshape((*grid_shape, map_data.shape[-1]))
+            else:
+                map_data = map_data.reshape(*grid_shape)
+            return TFRegularGridInterpolator(grid, map_data)
+
+        if self.method == 'WeightedNearestNeighbors':
+            if array_valued:
+                map_data = map_data.reshape((-1, map_data.shape[-1]))
+            else:
+                map_data = map_data.flatten()
+            kwargs = fd.filter_kwargs(TFInterpolateAndExtrapolate, kwargs)
+            return TFInterpolateAndExtrapolate(
+                csys, map_data, array_valued=array_valued, **kwargs)
+
+        raise ValueError(
+            f'Interpolation method {self.method} is not supported')
+
     @staticmethod
     def _rect_bivariate_spline(csys, map_data, array_valued, **kwargs):
         dimensions = len(csys[0])
@@ -230,16 +476,26 @@ class InterpolatingMap:
         return RegularGridInterpolator(tuple(grid), map_data, **config)
 
     @staticmethod
-    def _weighted_nearest_neighbors(csys, map_data, array_valued, **kwargs):
+    def _weighted_nearest_neighbors(csys, map_data, array_valued,
+                                    raster_shape=None, **kwargs):
         if array_valued:
             map_data = map_data.reshape((-1, map_data.shape[-1]))
         else:
-            map_data = map_data.flatten()
+            map_data = map_data.reshape(-1)
+        cache_dir = kwargs.get('cache_dir')
         kwargs = fd.filter_kwargs(InterpolateAndExtrapolate, kwargs)
+        if raster_shape is not None:
+            return RasterizedInterpolateAndExtrapolate(
+                csys, map_data, raster_shape, array_valued=array_valued,
+                cache_dir=cache_dir, **kwargs)
         return InterpolateAndExtrapolate(csys, map_data, array_valued=array_valued, **kwargs)
 
     def scale_coordinates(self, scaling_factor, map_name='map'):
-        """Scales the coordinate system by the specified factor
+        """Scales the coordinate system of map_name by the specified factor,
+        relative to the original coordinates: self.coordinate_system is
+        not changed. Interpolators are cached by scaling factor,
+        so switching between factors is cheap.
+
         :params scaling_factor: array (n_dim) of scaling factors
         if different or single scalar.
         """
@@ -249,22 +505,97 @@ class InterpolatingMap:
             assert (len(scaling_factor) == self.dimensions), \
                 f"Scaling factor array dimension {len(scaling_factor)} " \
                 f"does not match grid dimension {self.dimensions}"
-            self._sf = scaling_factor
-        if isinstance(scaling_factor, (int, float)):
-            self._sf = [scaling_factor] * self.dimensions
+        scaling_factor = np.broadcast_to(
+            np.asarray(scaling_factor, dtype=float), self.dimensions)
+        if np.any(scaling_factor <= 0):
+            raise ValueError("Scaling factors must be positive")
+        self.scaling_factors[map_name] = scaling_factor
+
+        key = (map_name, tuple(scaling_factor.tolist()))
+        if key not in self._scaled_interpolators:
+            self._scaled_interpolators[key] = self._make_interpolator(
+                map_name, self.coordinate_system * scaling_factor)
+        self.interpolators[map_name] = self._scaled_interpolators[key]
+
+
+def _decode_map_data(data):
+    """Return dictionary of map data, from any format accepted by
+    InterpolatingMap. Compressed and quantized maps are decoded.
+    """
+    if isinstance(data, bytes):
+        data = gzip.decompress(data).decode()
+    if isinstance(data, (str, bytes)):
+        data = json.loads(data)
+    assert isinstance(data, dict), f"Expected dictionary data, got {type(data)}"
+
+    # Decompress / dequantize the map
+    # We should support multiple map names!
+    if 'compressed' in data:
+        try:
+            import strax
+        except ImportError:
+            print("You must install strax to use compressed maps!\n")
+            raise
+
+        compressor, dtype, shape = data['compressed']
+        data['map'] = np.frombuffer(
+          strax.io.COMPRESSORS[compressor]['decompress'](data['map']),
+          dtype=dtype).reshape(*shape)
+        del data['compressed']
+    if 'quantized' in data:
+        data['map'] = data['quantized'] * data['map'].astype(np.float32)
+        del data['quantized']
+    return data
 
-        alt_csys = self.coordinate_system
-        for i, gp in enumerate(self.coordinate_system):
-            alt_csys[i] = [gc * k for (gc, k) in zip(gp, self._sf)]
 
-        map_data = np.array(self.data[map_name])
-        if len(self.coordinate_system) == len(map_data):
-            array_valued = len(map_data.shape) == 2
-        else:
-            array_valued = len(map_data.shape) == self.dimensions + 1
-        if array_valued:
-            map_data = map_data.reshape((-1, map_data.shape[-1]))
-        itp_fun = InterpolateAndExtrapolate(points=np.array(alt_csys),
-                                            values=np.array(map_data),
-                                            array_valued=array_valued)
-        self.interpolators[map_name] = itp_fun
+@export
+def save_map_binary(data, path):
+    """Save map data in flamedisx's binary map format: a directory
+    with one .npy file per array, and a metadata.json with everything else.
+    Loading this with load_map_binary (or fd.get_resource, for paths
+    ending in .fdmap) memory-maps the arrays, rather than parsing them,
+    so processes using the same map share one copy in memory.
+
+    :param data: Map data in any format accepted by InterpolatingMap
+    :param path: Directory to create, by convention ending in .fdmap
+    """
+    data = _decode_map_data(data)
+    path = Path(path)
+    if path.exists():
+        raise FileExistsError(f"{path} already exists")
+
+    csys = data['coordinate_system']
+    # Gridspecs and empty coordinate systems are not worth an array file
+    csys_is_array = len(csys) and not isinstance(csys[0][0], str)
+    array_names = [
+        k for k in data
+        if (k not in InterpolatingMap.metadata_field_names
+            or (k == 'coordinate_system' and csys_is_array))]
+
+    # Write to a temporary directory first, so an interrupted save
+    # leaves no incomplete map
+    temp_path = path.with_name(path.name + '.tmp')
+    temp_path.mkdir(parents=True)
+    for k in array_names:
+        # Specify dtype float to set Nones to nan
+        np.save(temp_path / f'{k}.npy', np.asarray(data[k], dtype=np.float64))
+    with open(temp_path / 'metadata.json', mode='w') as f:
+        json.dump(dict(
+            arrays=array_names,
+            fields={k: v for k, v in data.items() if k not in array_names}),
+            f)
+    os.replace(temp_path, path)
+
+
+@export
+def load_map_binary(path):
+    """Return map data saved by save_map_binary, with arrays
+    memory-mapped read-only.
+    """
+    path = Path(path)
+    with open(path / 'metadata.json', mode='r') as f:
+        metadata = json.load(f)
+    data = metadata['fields']
+    for k in metadata['arrays']:
+        data[k] = np.load(path / f'{k}.npy', mmap_mode='r')
+    return data
@@ -122,6 +122,8 @@ def get_resource(x, fmt=None):
                 result = f.read()
         elif fmt == 'csv':
             result = pd.read_csv(x)
+        elif fmt == 'fdmap':
+            result = fd.load_map_binary(x)
         else:
             raise ValueError(f"Unsupported format {fmt}!")
 
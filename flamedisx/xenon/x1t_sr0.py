@@ -80,19 +80,16 @@ class SR0Source:
         super().add_extra_columns(d)
 
         d['s2_relative_ly'] = s2_map(
-            np.transpose([d['x_observed'].values,
-                          d['y_observed'].values]))
+            np.transpose([d['x_observed'], d['y_observed']]))
         d['s1_relative_ly'] = s1_map(
-            np.transpose([d['x'].values,
-                          d['y'].values,
-                          d['z'].values]))
+            np.transpose([d['x'], d['y'], d['z']]))
 
         # Add cS1 and cS2 following XENON conventions.
         # Skip this if s1/s2 are not known, since we're simulating
         # TODO: This is a kludge...
-        if 's1' in d.columns:
+        if 's1' in d:
             d['cs1'] = d['s1'] / d['s1_relative_ly']
-        if 's2' in d.columns:
+        if 's2' in d:
             d['cs2'] = (
                 d['s2']
                 / d['s2_relative_ly']
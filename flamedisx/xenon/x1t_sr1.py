@@ -218,8 +218,8 @@ class SR1Source:
         super().set_defaults(*args, **kwargs)
 
         # Yield maps
-        self.s1_map = fd.InterpolatingMap(fd.get_nt_file(self.path_s1_rly))
-        self.s2_map = fd.InterpolatingMap(fd.get_nt_file(self.path_s2_rly))
+        self.s1_map = fd.InterpolatingMap(fd.get_nt_map(self.path_s1_rly))
+        self.s2_map = fd.InterpolatingMap(fd.get_nt_map(self.path_s2_rly))
 
         # Loading combined cut acceptances
         self.cut_accept_map_s1, self.cut_accept_domain_s1 = \
@@ -242,17 +242,17 @@ class SR1Source:
             read_maps_tf(self.path_electron_lifetimes, is_bbf=False)
 
         # Field maps
-        self.field_map = fd.InterpolatingMap(fd.get_nt_file(self.path_drift_field))
+        self.field_map = fd.InterpolatingMap(fd.get_nt_map(self.path_drift_field))
 
         # Field distortion maps
         # cheap hack
-        aa = fd.get_nt_file(self.path_drift_field_distortion) 
+        aa = fd.get_nt_map(self.path_drift_field_distortion) 
         aa['map'] = aa['r_distortion_map']
         self.drift_field_distortion_map = fd.InterpolatingMap(aa, method='RectBivariateSpline')
         del aa
 
         # FDC maps
-        self.fdc_map = fd.InterpolatingMap(fd.get_nt_file(self.path_drift_field_distortion_correction))
+        self.fdc_map = fd.InterpolatingMap(fd.get_nt_map(self.path_drift_field_distortion_correction))
 
 
     def reconstruction_bias_s1(self,
@@ -298,8 +298,8 @@ class SR1Source:
         d['z_observed'] = d['z']
 
         # Adding some smear according to posrec resolution
-        d['x_observed'] = np.random.normal(d['x_observed'].values, scale=0.4) # 4 mm resolution)
-        d['y_observed'] = np.random.normal(d['y_observed'].values, scale=0.4) # 4 mm resolution)
+        d['x_observed'] = self.rng.normal(d['x_observed'].values, scale=0.4) # 4 mm resolution)
+        d['y_observed'] = self.rng.normal(d['y_observed'].values, scale=0.4) # 4 mm resolution)
         
         # applying fdc
         delta_r = self.fdc_map(
@@ -321,16 +321,13 @@ class SR1Source:
     def add_extra_columns(self, d):
         super().add_extra_columns(d)
         d['s2_relative_ly'] = self.s2_map(
-             np.transpose([d['x_observed'].values,
-                          d['y_observed'].values]))
+             np.transpose([d['x_observed'], d['y_observed']]))
         d['s1_relative_ly'] = self.s1_map(
-            np.transpose([d['x_fdc'].values,
-                          d['y_fdc'].values,
-                          d['z_fdc'].values]))
+            np.transpose([d['x_fdc'], d['y_fdc'], d['z_fdc']]))
 
         # Not too good. patchy. event_time should be int since event_time in actual
         # data is int64 in ns. But need this to be float32 to interpolate.
-        if 'elife' not in d.columns:
+        if 'elife' not in d:
             if self.variable_elife:
                 d['event_time'] = d['event_time'].astype('float32')
                 d['elife'] = interpolate_tf(d['event_time'], self.elife_tf[0],
@@ -340,17 +337,16 @@ class SR1Source:
 
         if self.variable_drift_field:
             d['drift_field'] = self.field_map(
-                np.transpose([d['r'].values,
-                              d['z'].values]))
+                np.transpose([d['r'], d['z']]))
         else:
             d['drift_field'] = self.default_drift_field
 
         # Add cS1 and cS2 following XENON conventions.
         # Skip this if s1/s2 are not known, since we're simulating
         # TODO: This is a kludge...
-        if 's1' in d.columns:
+        if 's1' in d:
             d['cs1'] = d['s1'] / d['s1_relative_ly']
-        if 's2' in d.columns:
+        if 's2' in d:
             d['cs2'] = (
                 d['s2']
                 / d['s2_relative_ly']
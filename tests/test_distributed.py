@@ -0,0 +1,64 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import flamedisx as fd
+from .test_source import xes   # Yes, it is used through pytest magic
+
+
+def test_distributed_likelihood(xes: fd.ERSource):
+    # Workers need to import the source class, test only the
+    # basic sources (and save time)
+    if xes.__class__ not in (fd.ERSource, fd.NRSource):
+        return
+
+    # Two batches, one for each worker
+    data = xes.data.iloc[[0, 1, 1, 0]].reset_index(drop=True)
+    kwargs = dict(
+        sources=dict(er=xes.__class__),
+        elife=(100e3, 500e3, 5),
+        free_rates='er',
+        batch_size=2)
+
+    lf = fd.LogLikelihood(data=data, **kwargs)
+    with fd.DistributedLogLikelihood(
+            data=data,
+            n_workers=2,
+            # Prevent jitter from mu interpolator simulation to fail test
+            mu_estimators=lf.mu_estimators,
+            **kwargs) as dlf:
+        assert dlf.param_names == lf.param_names
+        for k, v in lf.param_defaults.items():
+            np.testing.assert_allclose(dlf.param_defaults[k], v, rtol=1e-6)
+
+        params = dict(er_rate_multiplier=2., elife=300e3)
+        expected = lf.log_likelihood(second_order=True, **params)
+        result = dlf.log_likelihood(second_order=True, **params)
+        for x, y in zip(result, expected):
+            np.testing.assert_allclose(x, y, rtol=1e-5)
+
+        # Objectives work on top of the distributed likelihood
+        bestfit = dlf.bestfit(optimizer='scipy')
+        assert isinstance(bestfit, dict)
+
+        # New data is split again
+        dlf.set_data(data.iloc[:1])
+        lf.set_data(data.iloc[:1])
+        np.testing.assert_allclose(dlf(**params), lf(**params), rtol=1e-5)
+    assert not multiprocessing.active_children()
+
+
+def test_distributed_likelihood_init_failure():
+    class LocalSource(fd.ERSource):
+        # Cannot be sent to workers, since they cannot import it
+        pass
+
+    with pytest.raises(Exception):
+        fd.DistributedLogLikelihood(
+            sources=dict(er=LocalSource),
+            n_workers=2,
+            n_trials=int(1e3),
+            progress=False)
+    # Workers were started, but did not outlive the failure
+    assert not multiprocessing.active_children()
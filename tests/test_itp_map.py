@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import flamedisx as fd
+
+
+def grid_map(method, array_valued=False):
+    x, y = np.meshgrid(np.linspace(0, 1, 5), np.linspace(-1, 1, 7),
+                       indexing='ij')
+    values = np.sin(3 * x) + y ** 2
+    if array_valued:
+        values = np.stack([values, 2 * values], axis=-1)
+    return fd.InterpolatingMap(
+        dict(coordinate_system=[['x', [0, 1, 5]], ['y', [-1, 1, 7]]],
+             map=values.reshape(35, -1).squeeze().tolist()),
+        method=method)
+
+
+@pytest.mark.parametrize('array_valued', (False, True))
+def test_tf_regular_grid(array_valued):
+    itp_map = grid_map('RegularGridInterpolator', array_valued)
+    tf_map = itp_map.tf_interpolator()
+    positions = np.random.default_rng(1).uniform(-0.2, 1.2, size=(100, 2))
+    np.testing.assert_allclose(
+        tf_map(fd.np_to_tf(positions)).numpy(),
+        itp_map(positions),
+        rtol=1e-4, atol=1e-4)
+
+
+def test_tf_weighted_nearest_neighbors():
+    rng = np.random.default_rng(1)
+    points = rng.uniform(-1, 1, size=(300, 2))
+    itp_map = fd.InterpolatingMap(dict(
+        coordinate_system=points.tolist(),
+        map=(points[:, 0] + points[:, 1] ** 2).tolist()))
+    tf_map = itp_map.tf_interpolator()
+
+    positions = rng.uniform(-1, 1, size=(1000, 2))
+    positions[0] = points[0]
+    result = tf.function(tf_map)(fd.np_to_tf(positions))
+    np.testing.assert_allclose(result.numpy(), itp_map(positions),
+                               rtol=1e-4, atol=1e-4)
+
+    # Finite gradients, even on top of a map point
+    positions = fd.np_to_tf(positions)
+    with tf.GradientTape() as tape:
+        tape.watch(positions)
+        y = tf.reduce_sum(tf_map(positions))
+    assert np.all(np.isfinite(tape.gradient(y, positions).numpy()))
+
+
+def test_tf_multilinear_gradient():
+    tf_map = grid_map('RegularGridInterpolator').tf_interpolator()
+    positions = tf.constant([[0.1, 0.3]], dtype=fd.float_type())
+    with tf.GradientTape() as tape:
+        tape.watch(positions)
+        y = tf_map(positions)
+    # Within a grid cell the map is bilinear: check against finite differences
+    eps = 1e-3
+    numerical = [
+        (tf_map(positions + eps * tf.one_hot([i], 2)) - y).numpy()[0] / eps
+        for i in range(2)]
+    np.testing.assert_allclose(tape.gradient(y, positions).numpy()[0],
+                               numerical, rtol=1e-2)
+
+
+def test_rasterized_weighted_nearest_neighbors(tmp_path):
+    rng = np.random.default_rng(1)
+    points = rng.uniform(-1, 1, size=(300, 2))
+    data = dict(coordinate_system=points.tolist(),
+                map=(points[:, 0] + points[:, 1] ** 2).tolist())
+    itp_map = fd.InterpolatingMap(data, workers=-1)
+    raster_map = fd.InterpolatingMap(data, raster_shape=200,
+                                     cache_dir=tmp_path)
+    assert len(list(tmp_path.glob('raster_*.npy'))) == 1
+
+    positions = rng.uniform(-1.2, 1.2, size=(1000, 2))
+    inside = np.all(np.abs(positions) < 0.9, axis=1)
+    # The weighted nearest neighbours map jumps where the set of
+    # neighbours changes, the raster smooths such jumps.
+    diff = np.abs(raster_map(positions[inside]) - itp_map(positions[inside]))
+    assert np.median(diff) < 1e-3
+    assert np.mean(diff < 0.05) > 0.98
+    assert np.all(np.isfinite(raster_map(positions)))
+
+    # The raster is loaded from the cache
+    cached_map = fd.InterpolatingMap(data, raster_shape=200,
+                                     cache_dir=tmp_path)
+    np.testing.assert_array_equal(cached_map(positions),
+                                  raster_map(positions))
+    assert len(list(tmp_path.glob('raster_*.npy'))) == 1
+
+
+@pytest.mark.parametrize('method', ('WeightedNearestNeighbors',
+                                    'RegularGridInterpolator',
+                                    'RectBivariateSpline'))
+def test_scale_coordinates(method):
+    itp_map = grid_map(method)
+    csys = itp_map.coordinate_system.copy()
+    positions = np.random.default_rng(1).uniform(0, 1, size=(100, 2))
+    original = itp_map(positions)
+
+    itp_map.scale_coordinates([2, 2])
+    np.testing.assert_array_equal(itp_map.coordinate_system, csys)
+    np.testing.assert_allclose(itp_map(positions * 2), original)
+
+    # Scaling is relative to the original coordinates, not cumulative
+    itp_map.scale_coordinates(3)
+    np.testing.assert_allclose(itp_map(positions * 3), original)
+    itp_map.scale_coordinates(1)
+    np.testing.assert_allclose(itp_map(positions), original)
+
+    if method != 'RectBivariateSpline':
+        tf_map = itp_map.tf_interpolator()
+        itp_map.scale_coordinates(2)
+        np.testing.assert_allclose(
+            itp_map.tf_interpolator()(fd.np_to_tf(positions * 2)).numpy(),
+            tf_map(fd.np_to_tf(positions)).numpy(),
+            rtol=1e-4, atol=1e-4)
+
+
+def test_binary_map(tmp_path):
+    rng = np.random.default_rng(1)
+    points = rng.uniform(-1, 1, size=(300, 2))
+    positions = rng.uniform(-1, 1, size=(100, 2))
+    maps = dict(
+        points=dict(coordinate_system=points.tolist(),
+                    map=points[:, 0].tolist(),
+                    other_map=points[:, 1].tolist(),
+                    name='Test map'),
+        grid=dict(coordinate_system=[['x', [0, 1, 5]], ['y', [-1, 1, 7]]],
+                  map=np.arange(35.).tolist()),
+        placeholder=dict(coordinate_system=[], map=42))
+
+    for name, data in maps.items():
+        path = tmp_path / f'{name}.fdmap'
+        fd.save_map_binary(data, path)
+        with pytest.raises(FileExistsError):
+            fd.save_map_binary(data, path)
+
+        loaded = fd.get_resource(str(path))
+        assert isinstance(loaded['map'], np.memmap)
+        for map_name in ('map', 'other_map'):
+            if map_name not in data:
+                continue
+            np.testing.assert_array_equal(
+                fd.InterpolatingMap(loaded)(positions, map_name=map_name),
+                fd.InterpolatingMap(data)(positions, map_name=map_name))
+    assert loaded['map'] == 42
+    assert fd.get_resource(str(tmp_path / 'points.fdmap'))['name'] == 'Test map'
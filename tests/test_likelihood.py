@@ -103,6 +103,42 @@ def test_multisource_er_nr(xes: fd.ERSource):
     lf()
 
 
+def test_parallel_sources(xes: fd.ERSource):
+    class LogSpaceNRSource(fd.NRSource):
+        log_space = True
+
+    for nr_class in (fd.NRSource, LogSpaceNRSource):
+        lfs = []
+        for parallel_sources in (False, True):
+            lfs.append(fd.LogLikelihood(
+                sources=dict(er=xes.__class__, nr=nr_class),
+                elife=(100e3, 500e3, 5),
+                free_rates='nr',
+                batch_size=3,
+                parallel_sources=parallel_sources,
+                # Prevent jitter from mu interpolator simulation to fail test
+                mu_estimators=lfs[0].mu_estimators if lfs else None,
+                data=xes.data))
+
+        # Same likelihood and gradient, also with padding and omitted
+        # gradients. Second-order results still come from the single graph.
+        for kwargs in (dict(), dict(omit_grads=('elife',)),
+                       dict(second_order=True)):
+            results = [lf.log_likelihood(nr_rate_multiplier=2., elife=300e3,
+                                         **kwargs)
+                       for lf in lfs]
+            if not kwargs.get('second_order'):
+                # No Hessians
+                results = [r[:2] for r in results]
+            for x, y in zip(*results):
+                np.testing.assert_allclose(x, y, rtol=1e-5)
+        results = [lf._sum_log_likelihood(lf.prepare_params(dict()),
+                                          data_only=True)[:2]
+                   for lf in lfs]
+        for x, y in zip(*results):
+            np.testing.assert_allclose(x, y, rtol=1e-5)
+
+
 def test_columnsource(xes: fd.ERSource):
     class myColumnSource(fd.ColumnSource):
         column = "diffrate"
@@ -206,6 +242,13 @@ def test_simulate(xes):
     events = lf.simulate(er_rate_multiplier=2.)
     events = lf.simulate(fix_truth=dict(x=0., y=0., z=-50.))
 
+    # Simulations with spawned generators are reproducible
+    toys = [lf.simulate(rng=rng)
+            for rng in fd.spawn_random_generators(1, 2)]
+    assert not toys[0].equals(toys[1])
+    for toy, rng in zip(toys, fd.spawn_random_generators(1, 2)):
+        pd.testing.assert_frame_equal(toy, lf.simulate(rng=rng))
+
 
 def test_simulate_column(xes):
     # Test for issue #47, check if not crashing since ColumnSource has no
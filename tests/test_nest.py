@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import pytest
 
 def dummy_data():
     return pd.DataFrame(
@@ -28,6 +29,30 @@ def test_nest_source():
     # Mu estimation (based on simulation)
     s.estimate_mu()
 
+    # The MC reservoir for the energy bounds is reused for new data
+    reservoir = s.mc_reservoir
+    s.set_data(df_test)
+    assert s.mc_reservoir is reservoir
+
+    # ... but not when the spectrum changes
+    s.energies = s.energies + 1.
+    s.set_data(df_test)
+    assert s.mc_reservoir is not reservoir
+    np.testing.assert_allclose(s.mc_reservoir['energy'], 9.)
+    s.energies = s.energies - 1.
+    s.set_data(df_test)
+
+    # Array columns are stored outside the dataframe...
+    ions_min = s.array_data['ions_produced_min']
+    assert ions_min.shape == (len(s.data), s.array_columns['ions_produced_min'])
+    assert 'ions_produced_min' not in s.data.columns
+
+    # ... but annotated data carries them along
+    d_annotated = s.annotate_data(df_test.copy())
+    assert 'ions_produced_min' not in s.data.columns
+    s.set_data(d_annotated, data_is_annotated=True)
+    np.testing.assert_array_equal(s.array_data['ions_produced_min'], ions_min)
+
     # Differential rate
     dr = s.differential_rate(s.data_tensor[0])
     assert len(dr) == len(df_test)
@@ -43,3 +68,70 @@ def test_nest_source():
         [1.837623e-05, 4.047864e-05],
         # For some reason, we get different values on different machines
         rtol=5e-3)
+
+
+def test_energy_chunks():
+    import tensorflow as tf
+    import flamedisx.nest as fd_nest
+
+    class ChunkedERSource(fd_nest.nestERSource):
+        energy_chunk_size = 2
+
+    drs = []
+    for source_class in (fd_nest.nestERSource, ChunkedERSource):
+        np.random.seed(0)
+        tf.random.set_seed(0)
+        s = source_class(dummy_data(), energy_min=3, energy_max=8,
+                         num_energies=5, batch_size=2)
+        drs.append(s.differential_rate(s.data_tensor[0]).numpy())
+    np.testing.assert_allclose(drs[0], drs[1], rtol=1e-5)
+
+
+def test_energy_quadrature_nodes():
+    import flamedisx.nest as fd_nest
+
+    energies = np.linspace(0, 10, 1000)
+    rates = 0.01 + np.exp(-0.5 * ((energies - 3) / 0.1)**2)
+    indices, node_rates = fd_nest.energy_quadrature_nodes(energies, rates, 50)
+    assert len(indices) == len(node_rates) == 50
+    assert np.all(np.diff(indices) >= 0)
+    # Rates are conserved, and nodes concentrate at the peak
+    np.testing.assert_allclose(node_rates.sum(), rates.sum())
+    assert np.sum(np.abs(energies[indices] - 3) < 0.5) > 10
+
+    # Few energies: all are used
+    indices, node_rates = fd_nest.energy_quadrature_nodes(energies[:10], rates[:10], 50)
+    np.testing.assert_array_equal(indices, np.arange(10))
+    np.testing.assert_array_equal(node_rates, rates[:10])
+
+
+def test_uniform_step_indices():
+    import flamedisx.nest as fd_nest
+
+    n = np.array([1, 5, 5, 5, 1000, 7])
+    n_steps = np.array([1, 1, 3, 5, 4, 0])
+    result = fd_nest.uniform_step_indices(n, n_steps, 6)
+    for row, n_i, n_steps_i in zip(result, n, n_steps):
+        expected = np.round(np.linspace(0, n_i - 1, n_steps_i)).astype(int)
+        np.testing.assert_array_equal(row[:n_steps_i], expected)
+        assert np.all(row[n_steps_i:] == 0)
+
+
+def test_adaptive_energy_nodes():
+    import flamedisx.nest as fd_nest
+
+    class AdaptiveERSource(fd_nest.nestERSource):
+        adaptive_energy_nodes = True
+
+    # On the default flat spectrum, adaptive nodes and uniform stepping
+    # both approximate the full 1000-point comb. (Here, stepping is off by
+    # about 1.7%, adaptive nodes by less than 0.1%.)
+    drs = [source_class(dummy_data(), batch_size=2).batched_differential_rate()
+           for source_class in (fd_nest.nestERSource, AdaptiveERSource)]
+    np.testing.assert_allclose(drs[1], drs[0], rtol=0.03)
+
+    class AdaptiveWIMPSource(fd_nest.nestWIMPSource):
+        adaptive_energy_nodes = True
+
+    with pytest.raises(ValueError):
+        AdaptiveWIMPSource()
@@ -131,6 +131,18 @@ def test_simulate(xes: fd.ERSource):
     assert len(xes.data) == 2
     assert xes.n_batches == 1
 
+    # The data is not replaced, simulation works on separate columns
+    data = xes.data
+    xes.simulate(10)
+    assert xes.data is data
+
+    # Parameters only apply during the simulation
+    elife = xes.defaults['elife'].numpy()
+    simd_short_elife = xes.simulate(n_ev, rng=42, elife=elife / 10)
+    assert xes.defaults['elife'].numpy() == elife
+    assert (simd_short_elife['s2'].mean()
+            < xes.simulate(n_ev, rng=42)['s2'].mean())
+
     # Test simulate with fix_truth DataFrame
     fix_truth_df = simd.iloc[:1].copy()
     simd = xes.simulate(n_ev, fix_truth=fix_truth_df)
@@ -149,6 +161,34 @@ def test_simulate(xes: fd.ERSource):
     assert len(set(simd['energy'].values)) == 1
     assert simd['energy'].values[0] == e_test
 
+    # Test simulation with a seed is reproducible
+    simd = xes.simulate(n_ev, rng=42)
+    pd.testing.assert_frame_equal(simd, xes.simulate(n_ev, rng=42))
+    assert not simd['s1'].equals(xes.simulate(n_ev, rng=43)['s1'])
+
+
+def test_simulate_user_code():
+    # Blocks and sources defined outside flamedisx get DataFrames during
+    # simulation, as they may use the DataFrame API
+    class MakeS2(fd.MakeS2):
+        def _simulate(self, d):
+            assert isinstance(d, pd.DataFrame)
+            super()._simulate(d)
+            d.loc[:, 's2'] = d['s2'].values * 2
+
+    class UserERSource(fd.ERSource):
+        model_blocks = fd.ERSource.model_blocks[:-1] + (MakeS2,)
+
+        def add_extra_columns(self, d):
+            super().add_extra_columns(d)
+            d['extra'] = d['x'].values ** 2
+
+    s = UserERSource(batch_size=2)
+    d = s.simulate(100, rng=42)
+    d_builtin = fd.ERSource(batch_size=2).simulate(100, rng=42)
+    np.testing.assert_allclose(d['s2'], 2 * d_builtin['s2'])
+    np.testing.assert_allclose(d['extra'], d['x']**2)
+
 
 def test_bounds(xes: fd.ERSource):
     """Test bounds on nq_produced and _detected"""
@@ -344,6 +384,41 @@ def test_set_data(xes: fd.ERSource):
     assert x.shape == (3,)
 
 
+def test_batch_steps():
+    # Small max_dim_sizes, so the quanta dimensions need steps
+    class CoarseDetectPhotons(fd.DetectPhotons):
+        max_dim_size = {'photons_produced': 10}
+
+    class CoarseDetectElectrons(fd.DetectElectrons):
+        max_dim_size = {'electrons_produced': 10}
+
+    class CoarseERSource(fd.ERSource):
+        model_blocks = (
+            fd.FixedShapeEnergySpectrum,
+            fd.MakeERQuanta,
+            fd.MakePhotonsElectronsBetaBinomial,
+            CoarseDetectPhotons,
+            fd.MakeS1Photoelectrons,
+            fd.MakeS1,
+            CoarseDetectElectrons,
+            fd.MakeS2)
+
+    data = dummy_data().iloc[[0, 1, 0, 0, 0]].reset_index(drop=True)
+    event_steps = CoarseERSource(
+        data, batch_size=1).data['electrons_produced_steps'].values
+    np.testing.assert_array_equal(event_steps, [7, 12, 7, 7, 7])
+
+    # Steps are the maximum within each batch; the coarse steps of the
+    # first batch do not leak into the next one.
+    s = CoarseERSource(data, batch_size=2)
+    assert s.n_batches == 3
+    for dim in ('electrons_produced', 'photons_produced', 'quanta_produced'):
+        np.testing.assert_array_equal(s.data[dim + '_steps'].values,
+                                      [12, 12, 7, 7, 7, 7])
+    np.testing.assert_array_equal(s.dimsizes['quanta_produced'],
+                                  [41, 41, 70, 70, 70, 70])
+
+
 def test_clip(xes):
     if not isinstance(xes, fd.WIMPSource):
         return
@@ -409,3 +484,326 @@ def test_FrozenReservoirSource():
 
     assert (dr_data_nr_source_er == d_nr['er_diff_rate'].values).all()
     assert (dr_data_nr_source_nr == d_nr['nr_diff_rate'].values).all()
+
+
+def test_FrozenReservoirSource_anchors(tmp_path):
+    res = fd.frozen_reservoir.make_event_reservoir(
+        ntoys=1, rng=1, anchors=dict(elife=(300e3, 600e3, 4)),
+        er=fd.ERSource(batch_size=100))
+    elifes = np.linspace(300e3, 600e3, 4).tolist()
+
+    # Saved reservoirs keep their anchors
+    fd.save_event_reservoir(tmp_path / 'reservoir.npz', res)
+    res_loaded = fd.load_event_reservoir(tmp_path / 'reservoir.npz')
+    pd.testing.assert_frame_equal(res, res_loaded)
+    assert res_loaded.attrs == res.attrs
+    res = res_loaded
+
+    s = fd.FrozenReservoirSource(source_type=fd.ERSource, source_name='er',
+                                 reservoir=res)
+    assert s.anchors == dict(elife=(300e3, 600e3, 4))
+    assert 'elife' in s.defaults
+
+    # At the anchors, we get the differential rates computed there
+    d = s.simulate(50, rng=1)
+    s.set_data(d)
+    np.testing.assert_allclose(
+        s.batched_differential_rate(elife=elifes[1]),
+        d['er_diff_rate_elife_1'],
+        rtol=1e-5)
+
+    # Events are reweighted for simulation at other parameters
+    assert s.estimate_mu() == s.mu
+    mu = s.estimate_mu(elife=elifes[0])
+    assert mu != s.mu
+    np.testing.assert_allclose(
+        mu, s.mu * np.mean(res['er_diff_rate_elife_0'] / res['er_diff_rate']),
+        rtol=1e-5)
+    assert len(s.simulate(10, elife=elifes[0])) == 10
+
+
+def test_make_event_reservoir(tmp_path):
+    sources = dict(er=fd.ERSource(batch_size=50),
+                   nr=fd.NRSource(batch_size=50))
+    res = fd.frozen_reservoir.make_event_reservoir(
+        ntoys=1, rng=1, **sources)
+
+    # Chunks of whole batches give the same differential rates
+    res_chunked = fd.frozen_reservoir.make_event_reservoir(
+        ntoys=1, rng=1, chunk_size=100, cache_dir=tmp_path, **sources)
+    pd.testing.assert_frame_equal(res, res_chunked)
+    chunk_files = sorted(tmp_path.glob('diff_rates_*.npz'))
+    assert len(chunk_files) == np.ceil(len(res) / 100)
+
+    # Resume after losing some chunks: the simulated events and
+    # remaining chunks are loaded, the missing ones are recomputed
+    for f in chunk_files[:2]:
+        f.unlink()
+    res_resumed = fd.frozen_reservoir.make_event_reservoir(
+        ntoys=1, rng=2, chunk_size=100, cache_dir=tmp_path, n_workers=2,
+        **sources)
+    pd.testing.assert_frame_equal(res, res_resumed,
+                                  check_exact=False, rtol=1e-5)
+
+    # The cache cannot be reused with other settings or sources
+    with pytest.raises(ValueError):
+        fd.frozen_reservoir.make_event_reservoir(
+            ntoys=1, chunk_size=50, cache_dir=tmp_path, **sources)
+    with pytest.raises(ValueError):
+        fd.frozen_reservoir.make_event_reservoir(
+            ntoys=1, chunk_size=100, cache_dir=tmp_path,
+            er=fd.ERSource(batch_size=50, elife=300e3), nr=sources['nr'])
+    # ... nor can files without a key
+    (tmp_path / 'key.txt').unlink()
+    with pytest.raises(ValueError):
+        fd.frozen_reservoir.make_event_reservoir(
+            ntoys=1, chunk_size=100, cache_dir=tmp_path, **sources)
+
+    # An empty reservoir still has the differential rate columns
+    res_empty = fd.frozen_reservoir.make_event_reservoir(
+        ntoys=0, cache_dir=tmp_path / 'empty', **sources)
+    assert len(res_empty) == 0
+    assert list(res_empty.columns) == list(res.columns)
+
+
+def test_tabulated():
+    data = dummy_data()
+    # Tabulation is opt-in
+    exact = fd.ERSource(data.copy(), batch_size=2, fit_params=['elife'])
+    assert not exact._tables
+    # Sources fit all parameters by default, so they do not tabulate
+    assert not fd.TabulatedERSource(data.copy(), batch_size=2)._tables
+    tab = fd.TabulatedERSource(data.copy(), batch_size=2,
+                               fit_params=['elife'])
+    assert 'p_electron' in tab._tables
+    np.testing.assert_allclose(tab.batched_differential_rate(),
+                               exact.batched_differential_rate(),
+                               rtol=1e-4)
+
+    # Tables follow changes of the defaults
+    exact.set_defaults(er_pel_a=20.)
+    tab.set_defaults(er_pel_a=20.)
+    np.testing.assert_allclose(tab.batched_differential_rate(),
+                               exact.batched_differential_rate(),
+                               rtol=1e-4)
+
+    # Fitted parameters can be tabulated at anchors
+    anchored = fd.TabulatedERSource(
+        data.copy(), batch_size=2, fit_params=['er_pel_a'],
+        tabulation_anchors=dict(er_pel_a=np.linspace(10., 30., 5)))
+    assert 'p_electron' in anchored._tables
+    assert anchored._tables['p_electron'][0].shape == (5, 100000)
+    # p_electron is linear in er_pel_a (until clipped)
+    np.testing.assert_allclose(
+        anchored.batched_differential_rate(er_pel_a=17.),
+        exact.batched_differential_rate(er_pel_a=17.),
+        rtol=1e-4)
+
+    # A too coarse grid is noticed
+    class CoarseERSource(fd.ERSource):
+        @staticmethod
+        @fd.tabulated(0., 5000., n_points=3)
+        def p_electron(nq):
+            return fd.ERSource.p_electron(nq)
+
+    with pytest.warns(UserWarning, match='Lookup table'):
+        CoarseERSource(data.copy(), batch_size=2)
+
+    # Also for NR, including the Lindhard factor from a block
+    exact = fd.NRSource(data.copy(), batch_size=2, fit_params=['elife'])
+    tab = fd.TabulatedNRSource(data.copy(), batch_size=2,
+                               fit_params=['elife'])
+    assert set(tab._tables) == {'p_electron', 'lindhard_l'}
+    np.testing.assert_allclose(tab.batched_differential_rate(),
+                               exact.batched_differential_rate(),
+                               rtol=1e-4)
+
+
+def test_tabulated_rebuild():
+    n_calls = []
+
+    class CountingERSource(fd.ERSource):
+        @staticmethod
+        @fd.tabulated(1., 1e4, n_points=10000)
+        def p_electron(nq, *, er_pel_a=15.):
+            n_calls.append(1)
+            return fd.ERSource.p_electron(fd.np_to_tf(nq), er_pel_a=er_pel_a)
+
+    data = dummy_data()
+    s = CountingERSource(data.copy(), batch_size=2, fit_params=['elife'])
+    n_built = len(n_calls)
+    assert n_built > 0
+
+    # Only changes to the function's parameters rebuild the table
+    s.set_defaults(elife=500e3)
+    s.simulate(10, elife=400e3)
+    s.annotate_data(data.copy(), g2=20.)
+    s.batched_differential_rate()
+    n_exact = len(n_calls) - n_built
+    s.set_defaults(er_pel_a=16.)
+    assert len(n_calls) - n_built > n_exact
+    assert s._table_keys['p_electron'] == (16.,)
+
+    # Including temporary changes, which are undone afterwards
+    s.simulate(10, er_pel_a=14.)
+    assert s._table_keys['p_electron'] == (16.,)
+
+
+def test_cache_fixed_blocks():
+    class CachedERSource(fd.ERSource):
+        cache_fixed_blocks = True
+
+    data = pd.concat([dummy_data()] * 2, ignore_index=True)
+    exact = fd.ERSource(data.copy(), batch_size=2, fit_params=['elife'])
+    cached = CachedERSource(data.copy(), batch_size=2, fit_params=['elife'])
+
+    # Only electron detection depends on elife
+    cached_blocks = [cached.model_blocks[i].__class__
+                     for i in cached._block_cache]
+    assert fd.DetectElectrons not in cached_blocks
+    assert fd.MakeS2 in cached_blocks
+
+    np.testing.assert_allclose(cached.batched_differential_rate(elife=300e3),
+                               exact.batched_differential_rate(elife=300e3),
+                               rtol=1e-4)
+
+    for values, shapes in cached._block_cache.values():
+        assert values.dtype == fd.float_type()
+
+    # Parameters that are not fitted can still be passed explicitly;
+    # blocks that use them are then computed rather than looked up
+    np.testing.assert_allclose(
+        cached.batched_differential_rate(g2=25., elife=300e3),
+        exact.batched_differential_rate(g2=25., elife=300e3),
+        rtol=1e-4)
+    assert not np.allclose(cached.batched_differential_rate(g2=25.),
+                           cached.batched_differential_rate())
+
+    def cached_g2():
+        return [params['g2']
+                for params in cached._block_cache_defaults.values()
+                if 'g2' in params]
+
+    # Cached results follow changes of the defaults and model constants
+    for s in (exact, cached):
+        s.set_defaults(work=14e-3, g2=19.)
+        # Constants are compiled into the traced computation
+        s.trace_differential_rate()
+    assert cached_g2() == [19.]
+    np.testing.assert_allclose(cached.batched_differential_rate(),
+                               exact.batched_differential_rate(),
+                               rtol=1e-4)
+
+    # ... but not temporary changes for simulation or annotation
+    cached.simulate(10, g2=21.)
+    cached.annotate_data(data.copy(), g2=21.)
+    assert cached_g2() == [19.]
+    np.testing.assert_allclose(cached.batched_differential_rate(),
+                               exact.batched_differential_rate(),
+                               rtol=1e-4)
+
+    # Cached results are not used in log space, unless made there
+    for s in (exact, cached):
+        s.log_space = True
+        s.trace_differential_rate()
+    np.testing.assert_allclose(cached.batched_differential_rate(),
+                               exact.batched_differential_rate(),
+                               rtol=1e-4)
+    for s in (exact, cached):
+        s.set_data(data.copy())
+    assert cached._block_cache_log_space
+    np.testing.assert_allclose(cached.batched_differential_rate(),
+                               exact.batched_differential_rate(),
+                               rtol=1e-4)
+
+
+def test_contraction_path():
+    # Chain with a small dimension at the end: contract from there
+    operand_dims = [('a', 'b'), ('b', 'c'), ('c', 'd')]
+    dimsizes = dict(a=100, b=100, c=100, d=1)
+    path = fd.contraction_path(operand_dims, dimsizes)
+    assert path[0] == (1, 2, ('b', 'd'))
+    assert path[-1][2] == ('a', 'd')
+
+    # Same result with greedy planning
+    assert fd.contraction_path(operand_dims, dimsizes, max_optimal=1) == path
+
+    with pytest.raises(ValueError):
+        fd.contraction_path([('a',), ('b',)], dimsizes)
+
+    # Block results of rank > 2 can be multiplied
+    s = fd.ERSource(dummy_data(), batch_size=2)
+    r = tf.random.uniform((2, 3, 4, 5))
+    r2 = tf.random.uniform((2, 5, 3))
+    new_dims, result = s.multiply_block_results(
+        ('a', 'b', 'c'), ('c', 'a'), r, r2)
+    assert new_dims == ('b',)
+    np.testing.assert_allclose(result.numpy(),
+                               np.einsum('zabc,zca->zb', r, r2),
+                               rtol=1e-5)
+
+
+def test_binomial_band(xes: fd.ERSource):
+    banded = xes.__class__(dummy_data(), batch_size=2, max_sigma=8,
+                           binomial_band_sigma=8)
+    np.testing.assert_allclose(banded.batched_differential_rate(),
+                               xes.batched_differential_rate(),
+                               rtol=1e-5)
+
+    # Multiplying a banded result sums over the band only
+    x = fd.np_to_tf(np.arange(40.)[None, None, :] * np.ones((2, 30, 1)))
+    n = fd.np_to_tf(np.arange(30., 90., 2.)[None, :, None] * np.ones((2, 1, 40)))
+    r = fd.banded_binomial_pmf(x, n, 0.3, band_sigma=3)
+    assert r.band.shape[2] < 40
+    r2 = tf.random.uniform((2, 40, 5))
+    for b_dims, b2_dims, args in (
+            (('a', 'b'), ('b', 'c'), (r, r2)),
+            (('b', 'c'), ('a', 'b'), (r2, r))):
+        new_dims, result = xes.multiply_block_results(b_dims, b2_dims, *args)
+        dense_dims, dense_result = xes.multiply_block_results(
+            b_dims, b2_dims,
+            *[x.to_dense() if isinstance(x, fd.BandedTensor) else x
+              for x in args])
+        assert new_dims == dense_dims
+        np.testing.assert_allclose(result.numpy(), dense_result.numpy(),
+                                   rtol=1e-5)
+
+
+def test_log_space(xes: fd.ERSource):
+    class LogSpaceSource(xes.__class__):
+        log_space = True
+        log_prune_threshold = 20
+
+    s = LogSpaceSource(dummy_data(), batch_size=2, max_sigma=8)
+    np.testing.assert_allclose(s.batched_differential_rate(),
+                               xes.batched_differential_rate(),
+                               rtol=1e-4)
+
+    # Gradients are finite, despite log(0)'s in the block results
+    ptensor = s.ptensor_from_kwargs()
+    with tf.GradientTape() as t:
+        t.watch(ptensor)
+        dr = s._differential_rate(s.data_tensor[0], ptensor)
+    assert np.all(np.isfinite(t.gradient(dr, ptensor).numpy()))
+
+    # Log differential rates are returned without exponentiating
+    np.testing.assert_allclose(
+        s.log_differential_rate(s.data_tensor[0]).numpy(),
+        np.log(xes.batched_differential_rate()),
+        rtol=1e-4)
+
+    # The likelihood combines them in log space, to the same result
+    # (share the mu estimators, which are estimated from simulations)
+    lls = []
+    for source in (s, xes):
+        lls.append(fd.LogLikelihood(
+            sources=dict(er=source.__class__, bg=xes.__class__),
+            data=dummy_data(),
+            batch_size=2,
+            free_rates=('er',),
+            max_sigma=8,
+            mu_estimators=lls[0].mu_estimators if lls else None))
+    assert lls[0].sources['er'].log_space
+    np.testing.assert_allclose(lls[0](er_rate_multiplier=2.),
+                               lls[1](er_rate_multiplier=2.),
+                               rtol=1e-4)
@@ -1,5 +1,7 @@
 import flamedisx as fd
 import numpy as np
+import pandas as pd
+import tensorflow as tf
 
 from multihist import Histdd
 
@@ -30,3 +32,61 @@ def test_template():
 
     # Total events should equal the histogram sum
     assert np.isclose(st.estimate_mu().numpy(), mh.n)
+
+
+def test_template_morphing():
+    edges = [np.linspace(0, 4, 5), np.linspace(0, 2, 3)]
+    a = np.arange(1, 9, dtype=float).reshape(4, 2)
+    b = a[::-1] * 2
+    st = fd.TemplateSource(
+        [a, b], bin_edges=edges, axis_names=['s1', 's2'],
+        events_per_bin=True, morph_params=dict(mix=(0., 1.)), batch_size=4)
+    assert np.isclose(st.defaults['mix'].numpy(), 0.5)
+
+    d = pd.DataFrame(dict(s1=[0.5, 1.5, 3.9, 10.], s2=[0.5, 1.5, 1., -1.]))
+    st.set_data(d)
+
+    # Vertical morphing interpolates bin contents linearly
+    for mix in (0., 0.25, 1.):
+        expected = Histdd.from_histogram(
+            (1 - mix) * a + mix * b, bin_edges=edges).lookup(d['s1'], d['s2'])
+        np.testing.assert_allclose(
+            st.batched_differential_rate(progress=False, mix=mix),
+            expected,
+            rtol=1e-5)
+        assert np.isclose(st.estimate_mu(mix=mix).numpy(),
+                          (1 - mix) * a.sum() + mix * b.sum())
+
+    # The differential rate is differentiable in the morphing parameter
+    mix = tf.constant(0.25, dtype=fd.float_type())
+    with tf.GradientTape() as tape:
+        tape.watch(mix)
+        y = tf.reduce_sum(st._differential_rate(
+            st.data_tensor[0], tf.reshape(mix, [1])))
+    expected = np.sum(Histdd.from_histogram(b - a, bin_edges=edges).lookup(
+        d['s1'], d['s2']))
+    assert np.isclose(tape.gradient(y, mix).numpy(), expected)
+
+    # Simulation follows the morphed template
+    d2 = st.simulate(int(1e5), mix=1., rng=42)
+    mh2 = Histdd(d2, axis_names=['s1', 's2'], bins=edges)
+    assert np.abs(mh2.histogram / len(d2) - b / b.sum()).max() < 0.01
+
+    # Many toys can be drawn at once
+    toys = st.simulate_toys([10, 0, 5], rng=42)
+    assert [len(x) for x in toys] == [10, 0, 5]
+    assert list(toys[0].columns) == ['s1', 's2']
+
+
+def test_template_interpolation():
+    edges = [np.linspace(0, 4, 5), np.linspace(0, 2, 3)]
+    a = np.arange(1, 9, dtype=float).reshape(4, 2)
+    st = fd.TemplateSource(a, bin_edges=edges, axis_names=['s1', 's2'],
+                           interpolate=True)
+    d = pd.DataFrame(dict(s1=[0.5, 1., 1.25, -3.], s2=[0.5, 1., 0.5, 3.]))
+    st.set_data(d)
+    np.testing.assert_allclose(
+        st.batched_differential_rate(progress=False),
+        # Bin centers, midpoint of four bins, between two bins, edge
+        [1, (1 + 2 + 3 + 4) / 4, 0.25 * 1 + 0.75 * 3, 2],
+        rtol=1e-5)
@@ -1,5 +1,8 @@
 import numpy as np
 import pandas as pd
+import pytest
+import tensorflow as tf
+import tensorflow_probability as tfp
 import wimprates as wr
 import flamedisx as fd
 
@@ -13,3 +16,167 @@ def test_j2000_conversion():
     np.testing.assert_array_almost_equal(j2000_times,
                                          test_times,
                                          decimal=6)
+
+
+def test_banded_binomial_pmf():
+    n = np.arange(0., 300., 3.)[None, :, None] * np.ones((2, 1, 150))
+    x = np.arange(10., 160.)[None, None, :] * np.ones((2, 100, 1))
+    n, x = fd.np_to_tf(n), fd.np_to_tf(x)
+    p = tf.constant([0.3, 0.6])[:, None, None]
+
+    dense = tfp.distributions.Binomial(total_count=n, probs=p).prob(x)
+    banded = fd.banded_binomial_pmf(x, n, p, band_sigma=8)
+    assert banded.shape.as_list() == [2, 100, 150]
+    assert banded.band.shape[2] < 150
+    np.testing.assert_allclose(banded.to_dense().numpy(), dense.numpy(),
+                               atol=1e-6)
+    np.testing.assert_array_equal(banded.gather(x).numpy(),
+                                  10. + banded.column_indices().numpy())
+
+    # Narrow bands miss probability, but only far from the mean
+    banded = fd.banded_binomial_pmf(x, n, p, band_sigma=1).to_dense().numpy()
+    assert np.all(banded <= dense.numpy() + 1e-6)
+    assert np.sum(banded == 0) > np.sum(dense.numpy() < 1e-30)
+
+
+def test_owens_t():
+    from scipy import special, stats
+    h = np.linspace(-10, 10, 101)[:, None]
+    a = np.linspace(-10, 10, 51)[None, :]
+    np.testing.assert_allclose(
+        fd.tfp_files.owens_t(tf.constant(h, dtype=tf.float32),
+                             tf.constant(a, dtype=tf.float32)).numpy(),
+        special.owens_t(h, a),
+        atol=1e-6)
+
+    # Worst case of the quadrature is a = 1, after the reduction to |a| <= 1.
+    # Check in double precision, so the 1e-8 claim is not hidden by rounding.
+    h = np.concatenate([np.linspace(-10, 10, 2001), [-40., -20., 20., 40.]])
+    for a in (-1., 1., 0.5, 2., 50.):
+        for n_nodes, atol in ((4, 1e-6), (6, 1e-8)):
+            np.testing.assert_allclose(
+                fd.tfp_files.owens_t(tf.constant(h, dtype=tf.float64),
+                                     tf.constant(a, dtype=tf.float64),
+                                     n_nodes=n_nodes).numpy(),
+                special.owens_t(h, a),
+                rtol=0, atol=atol)
+
+    x = np.linspace(-6, 6, 51).astype(np.float32)
+    for skewness in (-3., 0., 1.4, 2.25):
+        np.testing.assert_allclose(
+            fd.tfp_files.SkewGaussian(loc=0.5, scale=1.3, skewness=skewness,
+                                      owens_t_nodes=6).cdf(x).numpy(),
+            stats.skewnorm.cdf(x, skewness, 0.5, 1.3),
+            atol=1e-6)
+
+
+def test_batch_reduce():
+    x = np.array([3, 1, 2, 5, 4, 0, 7])
+    np.testing.assert_array_equal(
+        fd.batch_reduce(x, 3),
+        [3, 3, 3, 5, 5, 5, 7])
+    np.testing.assert_array_equal(
+        fd.batch_reduce(x, 3, np.minimum, broadcast=False),
+        [1, 0, 7])
+
+
+def test_histogram_pdf():
+    from scipy import stats
+    np.random.seed(0)
+    data = np.random.exponential(size=1000)
+    counts, edges = np.histogram(data)
+    x = np.linspace(-1, edges[-1] + 1, 200)
+    x = np.concatenate([x, edges])
+    densities = counts / (counts.sum() * np.diff(edges))
+    np.testing.assert_allclose(
+        fd.bounds.histogram_pdf(x, edges, densities),
+        stats.rv_histogram((counts, edges)).pdf(x))
+
+
+@pytest.mark.parametrize('sort_min_batches', (1, 50))
+def test_get_priors(sort_min_batches):
+    from types import SimpleNamespace
+    rng = np.random.default_rng(0)
+    reservoir = rng.normal(size=(10000, 4))
+    reservoir[:5, 2] = np.nan
+    filter_dims_min = rng.normal(size=(7, 2)) - 1
+    filter_dims_max = rng.normal(size=(7, 2)) + 1
+    source = SimpleNamespace(prior_PDFs_LB=dict(), prior_PDFs_UB=dict())
+    fd.bounds.get_priors(source, reservoir, ('a', 'b'), [0, 1], [2, 3],
+                         filter_dims_min, filter_dims_max,
+                         sort_min_batches=sort_min_batches)
+
+    # Same as filtering the whole reservoir for each batch
+    for priors, bounds, keep in (
+            (source.prior_PDFs_LB, filter_dims_min, np.greater_equal),
+            (source.prior_PDFs_UB, filter_dims_max, np.less_equal)):
+        for batch, (bound_2, bound_3) in enumerate(bounds):
+            mask = (keep(reservoir[:, 2], bound_2)
+                    & keep(reservoir[:, 3], bound_3))
+            for prior_dim, col in (('a', 0), ('b', 1)):
+                counts, edges = np.histogram(reservoir[mask, col], bins=10)
+                np.testing.assert_array_equal(priors[prior_dim][0][batch],
+                                              edges)
+                np.testing.assert_allclose(
+                    priors[prior_dim][1][batch],
+                    counts / (counts.sum() * np.diff(edges)))
+
+
+def test_random_generators():
+    # Seeded from the global random state by default,
+    # so np.random.seed keeps working
+    np.random.seed(1)
+    x = fd.random_generator().random(3)
+    np.random.seed(1)
+    np.testing.assert_array_equal(x, fd.random_generator().random(3))
+    assert not np.array_equal(x, fd.random_generator().random(3))
+
+    rng = np.random.default_rng(1)
+    assert fd.random_generator(rng) is rng
+
+    rngs = fd.spawn_random_generators(1, 3)
+    x = [rng.random(3) for rng in rngs]
+    assert not np.array_equal(x[0], x[1])
+    np.testing.assert_array_equal(
+        x, [rng.random(3) for rng in fd.spawn_random_generators(1, 3)])
+
+
+def test_random_from_histogram():
+    from multihist import Hist1d, Histdd
+    rng = np.random.default_rng(1)
+    h = Hist1d.from_histogram(np.array([1, 3]), bin_edges=np.array([0, 1, 3]))
+    x = fd.random_from_histogram(h, 10000, rng=rng)
+    assert x.shape == (10000,)
+    assert 0 <= x.min() and x.max() <= 3
+    # The bins have equal density
+    np.testing.assert_allclose(np.mean(x < 1), 1/4, atol=0.02)
+
+    h = Histdd.from_histogram(np.array([[0], [1]]),
+                              bin_edges=[np.array([0, 1, 2]),
+                                         np.array([0, 10])])
+    x = fd.random_from_histogram(h, 100, rng=rng)
+    assert x.shape == (100, 2)
+    assert np.all((1 <= x[:, 0]) & (x[:, 0] <= 2))
+    assert np.all((0 <= x[:, 1]) & (x[:, 1] <= 10))
+
+    # Same, but with an alias table
+    x = fd.random_from_histogram(h, 100, rng=rng,
+                                 table=fd.alias_table(h.histogram))
+    assert x.shape == (100, 2)
+    assert np.all((1 <= x[:, 0]) & (x[:, 0] <= 2))
+
+
+def test_alias_table():
+    rng = np.random.default_rng(1)
+    w = np.array([[0, 1, 2], [3, np.nan, 14]])
+    table = fd.alias_table(w)
+    x = fd.random_from_alias_table(table, (2, 100000), rng=rng)
+    assert x.shape == (2, 100000)
+    np.testing.assert_allclose(
+        np.bincount(x.ravel(), minlength=6) / x.size,
+        [0, 1/20, 2/20, 3/20, 0, 14/20],
+        atol=0.005)
+
+    for w in ([0, 0], [-1, 2], []):
+        with pytest.raises(ValueError):
+            fd.alias_table(w)